@@ -1,113 +1,213 @@
-from data_loader import load_csv, load_url, load_pdf
-from text_splitter import recursive_splitter, txt_to_documents
-from vector_store import create_vector_store
-from chain import create_chain
-from ui import create_ui
-import os, subprocess, sys
+from metrics import REGISTRY, add_fields, add_metrics_route, log_event, span, trace, trace_aiter
+from warmup import Warmup
+import asyncio, logging, os, sys
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-from typing import List
-from langchain_core.documents import Document
-from langchain_core.vectorstores import VectorStoreRetriever
+from typing import Any, AsyncIterator, Dict, NamedTuple, Optional
+
+# langchain, Chroma, Nomic and Anthropic take several seconds to import. They are imported by start_engine, which
+# runs in the background while the UI is already serving (BACKGROUND_WARMUP=0 runs it before the UI starts instead).
+
+WARMING_UP_MESSAGE: str = "⏳ The SEO engine is still warming up, your question will be answered as soon as it's ready..."
+
+
+class Engine(NamedTuple):
+    chain: Any
+    response_cache: Any
+    coalescer: Any
+
+
+def start_engine(api_key: str, model_name: str, warmup: Optional[Warmup] = None) -> Engine:
+    """
+    Logs in to Nomic, opens the index and creates the chain and the response cache. This is the slow part of startup.
+
+    Args:
+        api_key (str): The API key for the ChatAnthropic model.
+        model_name (str): The name of the LLM model.
+        warmup (Optional[Warmup]): Receives the current step for the UI status.
+
+    Returns:
+        Engine: The chain, the response cache and the request coalescer.
+    """
+    step = warmup.set_step if warmup else (lambda _: None)
+
+    # Startup phases are timed like the stages of a request and logged as one startup_trace line
+    with trace("startup"):
+        step("importing libraries")
+        with span("imports"):
+            from ingest import build_index, open_snapshot
+            from snapshot import latest_snapshot, read_manifest
+            from vector_store import get_embeddings, nomic_login
+            from response_cache import ResponseCache
+            from coalesce import RequestCoalescer
+            from chain import create_chain
+            from context import load_pinned_pages, parse_budgets
+
+        # Login to nomic vector embedding model
+        step("logging in to Nomic")
+        with span("nomic_login"):
+            nomic_login()
+
+        # Open the snapshot built by ingest.py if there is one, otherwise load and embed the corpus in this process
+        snapshot_path: Optional[str] = latest_snapshot(os.getenv('SNAPSHOT_DIR', 'snapshots'))
+        if snapshot_path:
+            manifest = read_manifest(snapshot_path)
+            log_event("snapshot_opening", version=manifest['version'], built_at=manifest['built_at'])
+            step(f"opening index snapshot {manifest['version']}")
+            with span("open_snapshot"):
+                retrievers = open_snapshot(snapshot_path)
+            index_version: str = manifest['version']
+        else:
+            log_event("snapshot_missing", message="building the index in this process (run src/ingest.py to build one offline)")
+            step("building the index (no snapshot found)")
+            # Persisted to INDEX_DIR if set, so unchanged chunks are not embedded again on restart
+            with span("build_index"):
+                retrievers, _ = build_index(persist_directory=os.getenv('INDEX_DIR'))
+            index_version: str = "in-process-" + datetime.now(timezone.utc).isoformat()
+
+        # Create chain
+        step("creating the chain")
+        with span("create_chain"):
+            chain = create_chain(retrievers["csv_collection"], retrievers["url_collection"], retrievers["pdf_collection"],
+                                 retrievers["tag_collection"], api_key, model_name,
+                                 context_budgets=parse_budgets(os.getenv('CONTEXT_BUDGETS')),
+                                 pinned_context=load_pinned_pages(os.getenv('PINNED_STYLE_PAGES', '')) or None)
+
+        # Repeated and near-identical submissions are answered from this cache instead of a new RAG + Claude call.
+        # With RESPONSE_CACHE_PATH the cache and the in-flight requests are shared by every server process (serve.py)
+        response_cache = ResponseCache(
+            embeddings=get_embeddings(),
+            ttl=float(os.getenv('RESPONSE_CACHE_TTL', 24 * 3600)),
+            threshold=float(os.getenv('RESPONSE_CACHE_THRESHOLD', 0.97)),
+            index_version=index_version,
+            path=os.getenv('RESPONSE_CACHE_PATH'),
+        )
+        coalescer = RequestCoalescer(path=os.getenv('RESPONSE_CACHE_PATH'))
+    log_event("engine_ready", index_version=index_version)
+    return Engine(chain, response_cache, coalescer)
+
+
+async def answer(engine: Engine, input_text: str, dept: str, title: str, content: str,
+                 info: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+    """
+    Streams the response to an editor's question: from the response cache, by following an identical request that is
+    already in flight (in this process or, with a shared cache file, in another one), or from the chain.
+
+    Args:
+        engine (Engine): The started engine.
+        input_text (str): The editor's question.
+        dept (str): Department of the article.
+        title (str): Title of the article.
+        content (str): Content of the article.
+        info (Optional[Dict[str, Any]]): Receives "source": "cache", "coalesced" or "chain".
+
+    Yields:
+        str: The chunks of the response.
+    """
+    info = info if info is not None else {}
+    from prompt import article_text, editor_question
+    prompt_text = editor_question(dept, title, content, input_text)
+    key: str = engine.response_cache.key(dept, title, content, input_text)
+    # Near-duplicates are judged on the article, the question has to match (see response_cache.py)
+    article: str = article_text(title, content)
+
+    if not engine.coalescer.in_flight(key):
+        with span("response_cache"):
+            cached = await asyncio.to_thread(engine.response_cache.get, dept, title, content, input_text, article)
+        add_fields(cache_hit=cached is not None)
+        REGISTRY.increment("response_cache_hits" if cached is not None else "response_cache_misses")
+        if cached is not None:
+            info["source"] = "cache"
+            yield cached
+            return
+
+    info["source"] = "coalesced" if engine.coalescer.in_flight(key) else "chain"
+
+    async def produce() -> AsyncIterator[str]:
+        info["source"] = "chain"
+        # The department limits the style guide search to its own guide and the general ones
+        async for chunk in engine.chain.astream({"question": prompt_text, "dept": dept, "article": article, "editor_question": input_text}):
+            yield chunk
+
+    async def lookup() -> Optional[str]:
+        info["source"] = "coalesced"
+        return await asyncio.to_thread(engine.response_cache.get, dept, title, content, input_text)
+
+    async def store(response: str) -> None:
+        await asyncio.to_thread(engine.response_cache.put, dept, title, content, input_text, response, article)
+
+    add_fields(coalesced=engine.coalescer.in_flight(key))
+    async for chunk in engine.coalescer.stream(key, produce, lookup, store):
+        yield chunk
+
 
 def main():
     # Load environment variables
-    print("Loading environment variables...")
     load_dotenv()
     api_key = os.getenv('ANTHROPIC_API_KEY')
     model_name = os.getenv('LLM_MODEL_NAME')
-    print(f"The port will be: {os.getenv('PORT')}")
+    log_event("config_loaded", port=os.getenv('PORT'))
 
     # Validate environment variables
     if not api_key or not model_name:
-        print("VALIDATION ERROR: Please provide an API key and model name in env file")
+        log_event("validation_error", level=logging.ERROR, message="VALIDATION ERROR: Please provide an API key and model name in env file")
         sys.exit(1)
 
-    # Login to nomic vector embedding model
-    nomic_login_key = os.getenv('NOMIC_LOGIN_KEY')
-    if nomic_login_key:
-        try:
-            # executes nomic login key command in the terminal
-            subprocess.run(['nomic', 'login', nomic_login_key], check=True)
-        except subprocess.CalledProcessError:
-            print("VALIDATION ERROR: Nomic login key is invalid. Please provide a valid login key to use Nomic vector embeddings")
+    warmup: Warmup[Engine] = Warmup(lambda warmup: start_engine(api_key, model_name, warmup))
+
+    # A bad Nomic key or a broken snapshot must stop the process like it does without background warmup, instead of
+    # leaving a UI up that only says "Startup failed" (and passes health checks)
+    def exit_on_failure(warmup: Warmup[Engine]) -> None:
+        if warmup.error is not None:
+            log_event("validation_error", level=logging.ERROR, message=f"VALIDATION ERROR: {warmup.error}")
+            sys.stdout.flush()
+            # sys.exit would only end the warmup thread
+            os._exit(1)
+    background: bool = os.getenv('BACKGROUND_WARMUP', '1').lower() not in ('0', 'false', 'no')
+    if not background:
+        warmup.run()
+        if warmup.error is not None:
+            log_event("validation_error", level=logging.ERROR, message=f"VALIDATION ERROR: {warmup.error}")
             sys.exit(1)
-    else:
-        print("VALIDATION ERROR: Nomic login key not found in env file. Please provide a login key to use Nomic vector embeddings")
-        sys.exit(1)
 
-    # Load data
-    print("Loading data from csv, pdf, urls...")
-    csv_data: List[Document] = load_csv("files/organic_search.csv")
-    pdf_list: List[str] = [
-        'files/34_Style.pdf',
-        'files/All_Style.pdf',
-        'files/DEI_Style.pdf',
-        'files/Sports_Style.pdf'
-    ]
-    pdfs_list: List[Document] = load_pdf(pdf_list)
-    urls: List[str] = [
-    'https://yoast.com/slug/',
-    'https://www.semrush.com/blog/what-is-a-url-slug/?kw=&cmp=US_SRCH_DSA_Blog_EN&label=dsa_pagefeed&Network=g&Device=c&kwid=dsa-2185834088336&cmpid=18348486859&agpid=156019556762&BU=Core&extid=97592280163&adpos=',
-    'https://www.upwork.com/resources/how-to-write-seo-content','https://authorservices.wiley.com/author-resources/Journal-Authors/Prepare/writing-for-seo.html',
-    'https://www.semrush.com/blog/seo-writing/','https://www.semrush.com/kb/839-how-to-write-seo-articles-four-steps',
-    'https://www.flowmatters.com/blog/a-practical-guide-on-how-to-write-seo-articles/',
-    'https://www.maropost.com/how-to-combine-seo-and-email-marketing-for-better-rankings/',
-    'https://www.webfx.com/seo/learn/email-marketing-tips-to-improve-seo/',
-    'https://sendgrid.com/en-us/blog/seo-and-email-marketing','https://www.emailonacid.com/blog/article/email-marketing/seo-connections/',
-    'https://coalitiontechnologies.com/blog/strategic-seo-tips-for-email-marketing',
-    'https://optinmonster.com/101-email-subject-lines-your-subscribers-cant-resist/',
-    'https://www.wordstream.com/blog/ws/2014/03/31/email-subject-lines',
-    'https://www.constantcontact.com/blog/good-email-subject-lines/',
-    'https://blog.hubspot.com/marketing/best-email-subject-lines-list',
-    'https://www.google.com/search/howsearchworks/how-search-works/ranking-results/#:~:text=To%20give%20you%20the%20most,the%20nature%20of%20your%20query.',
-    'https://www.semrush.com/blog/google-search-algorithm/',
-    'https://www.seomechanic.com/google-search-algorithm-work/',
-    'https://developers.google.com/search/docs/fundamentals/how-search-works',
-    'https://ahrefs.com/blog/google-search-algorithm/',
-    'https://www.shopify.com/blog/google-algorithm',
-    'https://www.webfx.com/seo/glossary/what-is-a-google-algorithm/',
-    'https://www.purplepublish.com/en/blog/seo-for-publishers',
-    'https://www.webceo.com/blog/how-to-do-seo-for-news-websites/',
-    'https://www.stanventures.com/blog/seo-for-journalist/',
-    'https://blog.replug.io/what-is-a-url-slug-and-how-to-optimize-it/'
-]
-    docs_list: List[Document] = load_url(urls)
-
-    # Split data
-    print("Splitting data using recursive splitter...")
-    doc_splits: List[Document] = recursive_splitter(csv_data)
-    url_splits: List[Document] = recursive_splitter(docs_list)
-    pdf_splits: List[Document] = recursive_splitter(pdfs_list)
-    tag_splits: List[Document] = txt_to_documents('files/final_tags.txt')
-
-    print("\n**********************************************************************************")
-    print(f"Doc_split length: {len(doc_splits)}\nurl_split length: {len(url_splits)}\npdf_splits length: {len(pdf_splits)}\ntag_split length: {len(tag_splits)}")
-    print("**********************************************************************************")
-
-    # Create vector stores
-    print("Storing data in vector stores...")
-    csv_retriever: VectorStoreRetriever = create_vector_store(doc_splits, "csv_collection")
-    url_retriever: VectorStoreRetriever = create_vector_store(url_splits, "url_collection")
-    pdf_retriever: VectorStoreRetriever = create_vector_store(pdf_splits, "pdf_collection")
-    tag_retriever: VectorStoreRetriever = create_vector_store(tag_splits, "tag_collection")
-    print("Data stored in vector stores ✅")
-
-    # Create chain
-    chain = create_chain(csv_retriever, url_retriever, pdf_retriever, tag_retriever, api_key, model_name)
-    
-    # Define chat function
-    def chat(input_text, dept, title, content, chat_history):
+    # Define chat function. It streams the response into the chat as tokens arrive, and being async
+    # it doesn't hold a worker thread while waiting on Claude, so many editors can be served at once.
+    # Every call is traced: its stages are logged as one chat_trace line and added to the /metrics histograms
+    async def chat(input_text, dept, title, content, chat_history):
+        if not warmup.ready:
+            waiting = (chat_history or []) + [(input_text, WARMING_UP_MESSAGE)]
+            yield waiting, waiting, "", "", "", ""
+        try:
+            engine: Engine = await warmup.await_ready()
+        except RuntimeError as e:
+            failed = (chat_history or []) + [(input_text, f"⚠️ {e}")]
+            yield failed, failed, "", "", "", ""
+            return
+        async for outputs in trace_aiter("chat", _chat(engine, input_text, dept, title, content, chat_history), dept=dept):
+            yield outputs
+
+    async def _chat(engine, input_text, dept, title, content, chat_history):
         chat_history = chat_history or []
-        prompt_text = f""" I am a student journalist who writes for this department: {dept} so use the writing guide that is meant for: {dept}.
-        The title of the article that I'm thinking of is: {title}, the content of the article is: {content}. My question is: {input_text}"""
-        response = chain.invoke(prompt_text)
+        response = ""
         chat_history.append((input_text, response))
-        return chat_history, chat_history, "", "", "", ""
+        # Cached and coalesced responses arrive as one chunk, the chain streams them token by token
+        async for chunk in answer(engine, input_text, dept, title, content):
+            response += chunk
+            chat_history[-1] = (input_text, response)
+            yield chat_history, chat_history, "", "", "", ""
+
+    # Create and launch the UI, then serve the latency histograms at /metrics on the same server
+    from ui import create_ui
 
-    # Create and launch the UI
-    print("Launching UI...")
-    demo = create_ui(chat)
-    demo.launch(server_name="0.0.0.0", server_port=int(os.getenv('PORT', 7860)), debug=True, share=True)
+    log_event("ui_launching", port=int(os.getenv('PORT', 7860)))
+    demo = create_ui(chat, concurrency_limit=int(os.getenv('CONCURRENCY_LIMIT', 16)), status_fn=warmup.status)
+    demo.launch(server_name="0.0.0.0", server_port=int(os.getenv('PORT', 7860)), share=True, prevent_thread_lock=True)
+    add_metrics_route(demo.app)
+    # The port is bound, now load the index behind the "warming up" status
+    if background:
+        warmup.add_done_callback(exit_on_failure)
+        warmup.start()
+    demo.block_thread()
 
 if __name__ == "__main__":
     main()
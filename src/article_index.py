@@ -0,0 +1,383 @@
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+from bm25 import BM25Index
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import csv, os, re
+import numpy as np
+
+"""
+Columnar index of the article search analytics (files/organic_search.csv).
+
+Instead of embedding every row as a key/value text chunk, the CSV is read once into typed NumPy columns (URL, title,
+clicks, impressions, CTR, position, date), one row per URL. Rows of the same URL (a multi-year export has one per
+period) are merged: clicks and impressions are summed, CTR is recomputed and the position is averaged weighted by
+impressions. A BM25 index over slug and title words finds the articles on a topic, and the numeric columns rank them.
+Results reach the prompt as a compact table instead of stringified rows.
+"""
+
+# Accepted header names (lower-cased) of each column, the first one found is used
+COLUMN_ALIASES: Dict[str, List[str]] = {
+    "url": ["url", "page", "top pages", "landing page", "address", "link"],
+    "title": ["title", "page title", "headline"],
+    "clicks": ["clicks", "url clicks"],
+    "impressions": ["impressions", "impr", "impr."],
+    "ctr": ["ctr", "url ctr"],
+    "position": ["position", "average position", "avg. position", "avg position"],
+    "date": ["date", "published", "publish date", "pub date"],
+}
+REQUIRED_COLUMNS: Tuple[str, ...] = ("url", "clicks", "impressions")
+
+# Sort order of a query: (column, descending)
+SORTS: Dict[str, Tuple[str, bool]] = {
+    "clicks": ("clicks", True),
+    "impressions": ("impressions", True),
+    "ctr": ("ctr", True),
+    "position": ("position", False),
+}
+
+# Articles ranked by CTR or position need this many impressions, a page seen twice at position 1 says nothing
+MIN_IMPRESSIONS_FOR_RATES: int = 100
+
+ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}$")
+
+# Slugs like penn-dining-hall-hours mentioned in a question are looked up directly
+SLUG_PATTERN = re.compile(r"\b[a-z0-9]+(?:-[a-z0-9]+){2,}\b")
+
+
+def _number(value: str) -> float:
+    # Analytics exports write "1,234", "2.5%" or leave the cell empty
+    value = (value or "").strip().replace(",", "").rstrip("%")
+    return float(value) if value else 0.0
+
+
+def slug_of(url: str) -> str:
+    """
+    Returns the last path segment of a URL, e.g. "penn-dining-hall-hours" for https://www.thedp.com/article/2024/05/penn-dining-hall-hours.
+    """
+    return url.split("?")[0].split("#")[0].rstrip("/").rsplit("/", 1)[-1].lower()
+
+
+class StringColumn:
+    """
+    Strings stored as one UTF-8 buffer plus offsets, so millions of URLs cost their bytes and not a Python object each.
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, strings: List[str]) -> "StringColumn":
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(data) for data in encoded])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8).copy(), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.blob[self.offsets[i] : self.offsets[i+1]].tobytes().decode('utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        return (self[i] for i in range(len(self)))
+
+
+class ArticleIndex:
+    """
+    Typed columns of the article analytics, one row per URL, with topic search and filtered top-N queries.
+    """
+
+    def __init__(self, urls: StringColumn, titles: StringColumn, clicks: np.ndarray, impressions: np.ndarray,
+                 ctr: np.ndarray, position: np.ndarray, dates: np.ndarray, text_index: BM25Index, slug_order: np.ndarray):
+        """
+        Args:
+            urls (StringColumn): URL of every article.
+            titles (StringColumn): Title of every article, empty if the CSV has none.
+            clicks (np.ndarray): Total clicks (int64).
+            impressions (np.ndarray): Total impressions (int64).
+            ctr (np.ndarray): Click-through rate as a fraction (float32).
+            position (np.ndarray): Average search position, impression-weighted (float32, 0 if unknown).
+            dates (np.ndarray): Latest date of the article (datetime64[D], NaT if unknown).
+            text_index (BM25Index): BM25 over slug and title words, ids are row numbers.
+            slug_order (np.ndarray): Rows sorted by slug, for binary search by slug.
+        """
+        self.urls = urls
+        self.titles = titles
+        self.clicks = clicks
+        self.impressions = impressions
+        self.ctr = ctr
+        self.position = position
+        self.dates = dates
+        self.text_index = text_index
+        self.slug_order = slug_order
+
+    def __len__(self) -> int:
+        return len(self.clicks)
+
+    @classmethod
+    def from_csv(cls, csv_path: str) -> "ArticleIndex":
+        """
+        Reads an analytics CSV row by row and builds the index. Rows of the same URL are merged.
+
+        Args:
+            csv_path (str): Path to the CSV file.
+
+        Returns:
+            ArticleIndex: The index.
+
+        Raises:
+            ValueError: If the CSV has no URL, clicks or impressions column (see COLUMN_ALIASES).
+        """
+        rows: Dict[str, int] = {}
+        titles: List[str] = []
+        clicks: List[int] = []
+        impressions: List[int] = []
+        ctr: List[float] = []
+        weighted_position: List[float] = []
+        dates: List[str] = []
+
+        with open(csv_path, 'r', encoding='utf-8', newline='') as file:
+            reader = csv.reader(file)
+            header = [name.strip().lower() for name in next(reader, [])]
+            columns: Dict[str, int] = {}
+            for column, aliases in COLUMN_ALIASES.items():
+                found = [header.index(alias) for alias in aliases if alias in header]
+                if found:
+                    columns[column] = found[0]
+            missing = [column for column in REQUIRED_COLUMNS if column not in columns]
+            if missing:
+                raise ValueError(f"{csv_path} has no {', '.join(missing)} column (found: {', '.join(header)})")
+
+            def cell(row: List[str], column: str) -> str:
+                return row[columns[column]] if column in columns and columns[column] < len(row) else ""
+
+            for row in reader:
+                url = cell(row, "url").strip()
+                if not url:
+                    continue
+                row_clicks, row_impressions = int(_number(cell(row, "clicks"))), int(_number(cell(row, "impressions")))
+                i = rows.get(url)
+                if i is None:
+                    i = rows[url] = len(titles)
+                    titles.append(cell(row, "title").strip())
+                    clicks.append(0)
+                    impressions.append(0)
+                    ctr.append(_number(cell(row, "ctr")) / 100)
+                    weighted_position.append(0.0)
+                    dates.append("")
+                clicks[i] += row_clicks
+                impressions[i] += row_impressions
+                # Rows without impressions still carry their position
+                weighted_position[i] += _number(cell(row, "position")) * max(row_impressions, 1)
+                date = cell(row, "date").strip()[:10]
+                if ISO_DATE.match(date):
+                    dates[i] = max(dates[i], date)
+
+        urls: List[str] = list(rows)
+        clicks_array = np.asarray(clicks, dtype=np.int64)
+        impressions_array = np.asarray(impressions, dtype=np.int64)
+        weights = np.maximum(impressions_array, 1).astype(np.float64)
+        # Exports without duplicate rows keep their CTR where impressions are missing
+        ctr_array = np.where(impressions_array > 0, clicks_array / np.maximum(impressions_array, 1), np.asarray(ctr, dtype=np.float64))
+        date_array = np.array([date or "NaT" for date in dates], dtype="datetime64[D]") if dates else np.array([], dtype="datetime64[D]")
+        slugs: List[str] = [slug_of(url) for url in urls]
+        text_index = BM25Index.build([str(i) for i in range(len(urls))],
+                                     [f"{slug.replace('-', ' ')} {title}" for slug, title in zip(slugs, titles)])
+        # sorted is stable, of two URLs with the same slug the first one in the CSV is found
+        slug_order = np.asarray(sorted(range(len(slugs)), key=slugs.__getitem__), dtype=np.int64)
+        return cls(StringColumn.build(urls), StringColumn.build(titles), clicks_array, impressions_array,
+                   ctr_array.astype(np.float32), (np.asarray(weighted_position) / weights).astype(np.float32), date_array,
+                   text_index, slug_order)
+
+    def save(self, path: str) -> None:
+        """
+        Saves the columns to a .npz file and the text index next to it (<path>.bm25.npz). Files are replaced atomically.
+
+        Args:
+            path (str): Path of the .npz file.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            np.savez(
+                file, url_blob=self.urls.blob, url_offsets=self.urls.offsets, title_blob=self.titles.blob,
+                title_offsets=self.titles.offsets, clicks=self.clicks, impressions=self.impressions, ctr=self.ctr,
+                position=self.position, dates=self.dates, slug_order=self.slug_order,
+            )
+        self.text_index.save(f"{os.path.splitext(path)[0]}.bm25.npz")
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "ArticleIndex":
+        """
+        Loads an index saved with save.
+
+        Args:
+            path (str): Path of the .npz file.
+
+        Returns:
+            ArticleIndex: The index.
+        """
+        with np.load(path) as data:
+            return cls(StringColumn(data["url_blob"], data["url_offsets"]), StringColumn(data["title_blob"], data["title_offsets"]),
+                       data["clicks"], data["impressions"], data["ctr"], data["position"], data["dates"],
+                       BM25Index.load(f"{os.path.splitext(path)[0]}.bm25.npz"), data["slug_order"])
+
+    def lookup(self, slug_or_url: str) -> Optional[int]:
+        """
+        Finds the row of an article by its URL or slug.
+
+        Args:
+            slug_or_url (str): e.g. "penn-dining-hall-hours" or the full URL.
+
+        Returns:
+            Optional[int]: The row, None if the article is unknown.
+        """
+        # Binary search over the rows sorted by slug, about 20 string comparisons for a million articles
+        slug: str = slug_of(slug_or_url.strip())
+        # bisect's key= needs Python 3.10
+        position, end = 0, len(self.slug_order)
+        while position < end:
+            middle = (position + end) // 2
+            if slug_of(self.urls[self.slug_order[middle]]) < slug:
+                position = middle + 1
+            else:
+                end = middle
+        if position < len(self.slug_order) and slug_of(self.urls[self.slug_order[position]]) == slug:
+            return int(self.slug_order[position])
+        return None
+
+    def topic_rows(self, query: str, relative_score: float = 0.5) -> np.ndarray:
+        """
+        Returns the rows on the topic of a query: articles whose slug and title match the query with at least
+        relative_score times the best BM25 score. Words common to many slugs weigh little, so filler words in the
+        question barely matter.
+
+        Args:
+            query (str): Question or topic words.
+            relative_score (float): Fraction of the best score an article needs.
+
+        Returns:
+            np.ndarray: Row numbers, unordered. Empty if no article matches.
+        """
+        scores = self.text_index.scores(query)
+        best = float(scores.max()) if len(scores) else 0.0
+        if best <= 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(scores >= best * relative_score)
+
+    def top(self, n: int = 10, by: str = "clicks", rows: Optional[np.ndarray] = None, min_impressions: int = 0,
+            since: Optional[str] = None) -> np.ndarray:
+        """
+        Returns the best n rows by a column, optionally among given rows and filtered by impressions and date.
+
+        Args:
+            n (int): Number of rows.
+            by (str): One of SORTS: clicks, impressions, ctr or position (lower position is better).
+            rows (Optional[np.ndarray]): Rows to choose from, e.g. from topic_rows. All rows if None.
+            min_impressions (int): Skip articles with fewer impressions.
+            since (Optional[str]): Skip articles dated before this day (YYYY-MM-DD). Articles without a date are kept.
+
+        Returns:
+            np.ndarray: Row numbers, best first.
+        """
+        column, descending = SORTS[by]
+        candidates = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        mask = self.impressions[candidates] >= min_impressions
+        if by == "position":
+            mask &= self.position[candidates] > 0
+        if since is not None:
+            dates = self.dates[candidates]
+            mask &= np.isnat(dates) | (dates >= np.datetime64(since, "D"))
+        candidates = candidates[mask]
+
+        values = getattr(self, column)[candidates]
+        keys = -values if descending else values
+        if len(candidates) > n:
+            chosen = np.argpartition(keys, n - 1)[:n]
+            candidates, keys = candidates[chosen], keys[chosen]
+        return candidates[np.argsort(keys, kind="stable")]
+
+    def table(self, rows: np.ndarray, caption: str) -> str:
+        """
+        Formats rows as a compact pipe table: URL path, title, clicks, impressions, CTR, position and date.
+        """
+        has_titles, has_dates = self.titles.offsets[-1] > 0, bool(len(self.dates)) and not np.isnat(self.dates).all()
+        header = ["path"] + (["title"] if has_titles else []) + ["clicks", "impr", "ctr", "pos"] + (["date"] if has_dates else [])
+        lines: List[str] = [caption, " | ".join(header)]
+        for i in rows:
+            url = self.urls[i]
+            cells = [re.sub(r"^https?://[^/]+", "", url) or url]
+            if has_titles:
+                cells.append(self.titles[i])
+            cells += [f"{self.clicks[i]:,}", f"{self.impressions[i]:,}", f"{self.ctr[i]:.1%}",
+                      f"{self.position[i]:.1f}" if self.position[i] > 0 else "-"]
+            if has_dates:
+                cells.append("" if np.isnat(self.dates[i]) else str(self.dates[i]))
+            lines.append(" | ".join(cells))
+        return "\n".join(lines)
+
+    def as_retriever(self, n: int = 10) -> "ArticleRetriever":
+        return ArticleRetriever(index=self, n=n)
+
+
+def sort_for(question: str) -> str:
+    """
+    Picks the column a question asks to rank by: position for "rank"/"position", CTR for "ctr"/"click-through", else clicks.
+    Whole words only, so "electric" doesn't ask for CTR.
+    """
+    text = question.lower()
+    if re.search(r"\b(ctr|click-through|click through)\b", text):
+        return "ctr"
+    if re.search(r"\b(rank|ranks|ranking|ranked|position)\b", text):
+        return "position"
+    if re.search(r"\bimpressions?\b", text):
+        return "impressions"
+    return "clicks"
+
+
+class ArticleRetriever(BaseRetriever):
+    """
+    Retriever over an ArticleIndex for the "context" prompt section. Returns at most two table documents: the
+    articles whose slugs are mentioned in the question, and the best articles on the article's topic (the question's if
+    there is no article), ranked by what the question asks for.
+    Tables are marked with {"table": True} so context assembly keeps their line breaks.
+
+    Given the editor's question and the article apart from the templated query (see retriever.search_by_vector), only
+    the question decides the ranking and the mentioned slugs, and only the article the topic. Words of the article
+    ("electric", "ranked") or of the template ("student journalist") would otherwise steer both.
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    index: Any
+    n: int = 10
+
+    def search_by_vector(self, query: str, vector: List[float], article: Optional[str] = None,
+                         editor_question: Optional[str] = None) -> List[Document]:
+        # The vector is not needed, the articles are found by words and ranked by their numbers
+        return self._search(query, article, editor_question)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self._search(query)
+
+    def _search(self, query: str, article: Optional[str] = None, editor_question: Optional[str] = None) -> List[Document]:
+        question: str = editor_question if editor_question is not None else query
+        documents: List[Document] = []
+        mentioned = [row for row in dict.fromkeys(self.index.lookup(slug) for slug in SLUG_PATTERN.findall(question.lower())) if row is not None]
+        if mentioned:
+            documents.append(self._document(self.index.table(np.asarray(mentioned[: self.n]), "Articles mentioned in the question:")))
+
+        by = sort_for(question)
+        topic = self.index.topic_rows(article if article and article.strip() else question)
+        min_impressions = MIN_IMPRESSIONS_FOR_RATES if by in ("ctr", "position") else 0
+        rows = self.index.top(self.n, by=by, rows=topic if len(topic) else None, min_impressions=min_impressions)
+        scope = "on this topic" if len(topic) else "overall"
+        documents.append(self._document(self.index.table(rows, f"Top {len(rows)} of {len(self.index):,} articles {scope} by {by}:")))
+        return documents
+
+    @staticmethod
+    def _document(table: str) -> Document:
+        return Document(page_content=table, metadata={"source": "organic_search.csv", "table": True})
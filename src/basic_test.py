@@ -1,6 +1,47 @@
 import unittest
-from data_loader import load_pdf, load_csv, load_url
-import os, re
+from unittest import mock
+from data_loader import load_pdf, load_csv, load_url, iter_pdf
+import data_loader
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+import vector_store, snapshot, http_cache
+from embedding_cache import CachedEmbeddings
+from retriever import DepartmentRetriever, create_multi_retriever, search_by_vector, search_by_vectors
+from sources import guides_for
+from bm25 import BM25Index, reciprocal_rank_fusion
+from reranker import LexicalReranker, RerankedRetriever
+from context import ContextAssembler, parse_budgets
+from article_index import ArticleIndex
+from tokens import estimate_tokens
+from prompt import article_text, get_prompt, editor_question as get_editor_question
+from chain import UsageTracker
+import metrics
+from chain import create_chain, create_generation_chain
+from batch import iter_articles, run_batch
+from stubs import CANNED_RESPONSE, HashEmbeddings, StubChatModel
+from benchmark import compare_reports
+from dedup import Deduplicator, lsh_bands
+from quantized_store import QuantizedVectorStore, quantized_path
+from warmup import Warmup
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+from response_cache import ResponseCache
+from coalesce import RequestCoalescer
+from tag_index import TagIndex
+import tag_cleaner
+from langchain_core.runnables import RunnableLambda
+import numpy as np
+from langchain_core.vectorstores import InMemoryVectorStore
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import asyncio, json, os, shutil, tempfile, threading, time
+
+def make_temp_dir(test: unittest.TestCase) -> str:
+    """
+    Creates a temporary directory that is removed once the test finished.
+    """
+    folder = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, folder, ignore_errors=True)
+    return folder
 
 class TestDataLoader(unittest.TestCase):
 
@@ -18,6 +59,18 @@ class TestDataLoader(unittest.TestCase):
         pdfs_list = load_pdf(pdf_list)
         self.assertEqual(len(pdfs_list), 89, "Expected 89 documents from PDF files")
 
+    def test_pdf_page_cache(self):
+        '''
+        Test that an unchanged PDF is read from the page cache without starting any extraction.
+        '''
+
+        with mock.patch.dict(os.environ, {"PDF_CACHE_DIR": make_temp_dir(self)}):
+            pages = load_pdf(['files/34_Style.pdf'])
+            with mock.patch.object(data_loader, '_extract_pages', side_effect=AssertionError("PDF was parsed again")), \
+                 mock.patch.object(data_loader, 'PdfReader', side_effect=AssertionError("PDF was opened again")):
+                streamed = list(iter_pdf(['files/34_Style.pdf']))
+        self.assertEqual([(doc.page_content, doc.metadata) for doc in streamed], [(doc.page_content, doc.metadata) for doc in pages])
+
     def test_load_csv(self):
         '''
         Test basic functionality of load_csv function. Checks if it outputs the correct number of documents from the CSV file.
@@ -36,11 +89,11 @@ class TestDataLoader(unittest.TestCase):
         docs_list = load_url(urls)
         self.assertEqual(len(docs_list), 2, "Expected 2 documents from URLs")
 
-# test the regex pattern for tag cleaning
+# test the date pattern used for tag cleaning
 class TestRegexPattern(unittest.TestCase):
 
     def setUp(self):
-        self.pattern = re.compile(r'\d+[/-]\d+|\d+\.\d+')
+        self.pattern = tag_cleaner.DATE_PATTERN
         self.true_strings = ['12.5.2013', '3.28.2012', '4-16-15', '04-21-2', '10/15/2014', '02-25-', '02/25/16']
         self.false_strings = ['34st-Ego', 'top 10']
 
@@ -54,6 +107,986 @@ class TestRegexPattern(unittest.TestCase):
             with self.subTest(string=string):
                 self.assertIsNone(self.pattern.search(string), f"Error: {string} should not match the pattern.")
 
+    def test_filter_tags_drops_dates(self):
+        self.assertEqual(tag_cleaner.filter_tags(self.true_strings + self.false_strings), self.false_strings)
+
+class CountingEmbeddings(Embeddings):
+    """Offline embedding function that counts how many texts it embedded."""
+
+    def __init__(self):
+        self.calls = 0
+        self.batches = []
+
+    def embed_documents(self, texts):
+        self.calls += len(texts)
+        self.batches.append(len(texts))
+        return [[float(len(text)), float(sum(map(ord, text)) % 97), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        self.queries = getattr(self, "queries", 0) + 1
+        return self.embed_documents([text])[0]
+
+class TestPersistentVectorStore(unittest.TestCase):
+
+    def setUp(self):
+        self.index_dir = make_temp_dir(self)
+        self.embeddings = CountingEmbeddings()
+        patcher = mock.patch.object(vector_store, 'get_embeddings', return_value=self.embeddings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_document_id_is_stable(self):
+        doc = Document(page_content="Penn beats Princeton", metadata={"source": "a.pdf", "page": 1})
+        same = Document(page_content="Penn beats Princeton", metadata={"page": 1, "source": "a.pdf"})
+        self.assertEqual(vector_store.document_id(doc), vector_store.document_id(same))
+        self.assertNotEqual(vector_store.document_id(doc), vector_store.document_id(doc, model="other-model"))
+
+    def test_unchanged_corpus_is_not_embedded_again(self):
+        docs = [Document(page_content=f"chunk {i}", metadata={"source": "a.pdf"}) for i in range(5)]
+        vector_store.create_vector_store(docs, "test_collection", persist_directory=self.index_dir)
+        self.assertEqual(self.embeddings.calls, 5)
+
+        self.embeddings.calls = 0
+        vector_store.create_vector_store(docs, "test_collection", persist_directory=self.index_dir)
+        self.assertEqual(self.embeddings.calls, 0, "Expected no embedding calls for an unchanged corpus")
+
+    def test_changed_and_removed_chunks(self):
+        docs = [Document(page_content=f"chunk {i}", metadata={"source": "a.pdf"}) for i in range(5)]
+        vector_store.create_vector_store(docs, "test_collection", persist_directory=self.index_dir)
+
+        self.embeddings.calls = 0
+        changed = docs[:3] + [Document(page_content="new chunk", metadata={"source": "b.pdf"})]
+        retriever = vector_store.create_vector_store(changed, "test_collection", persist_directory=self.index_dir)
+        self.assertEqual(self.embeddings.calls, 1, "Expected only the new chunk to be embedded")
+        stored = retriever.vectorstore.get()["documents"]
+        self.assertEqual(sorted(stored), sorted(doc.page_content for doc in changed))
+
+    def test_streamed_documents_are_batched(self):
+        docs = (Document(page_content=f"chunk {i % 5}", metadata={"source": "a.pdf"}) for i in range(7))
+        retriever = vector_store.create_vector_store([], "test_collection", persist_directory=self.index_dir)
+        added, deleted = vector_store.sync_documents(retriever.vectorstore, docs, batch_size=2)
+        self.assertEqual((added, deleted), (5, 0), "Expected duplicate chunks to be skipped")
+        self.assertEqual(self.embeddings.batches, [2, 2, 1])
+        self.assertEqual(len(retriever.vectorstore.get()["ids"]), 5)
+
+    def test_hybrid_retrieval_finds_exact_terms(self):
+        docs = [Document(page_content=f"General style rule number {i} about commas", metadata={"page": i}) for i in range(30)]
+        docs.append(Document(page_content="Wharton: refer to it as the Wharton School on first reference", metadata={"page": 99}))
+        retriever = vector_store.create_vector_store(docs, "test_collection", k_pre=3, persist_directory=self.index_dir, hybrid=True)
+        self.assertTrue(os.path.isfile(os.path.join(self.index_dir, "test_collection.bm25.npz")))
+
+        reopened = vector_store.open_vector_store(self.index_dir, "test_collection", k_pre=3)
+        for hybrid in (retriever, reopened):
+            results = search_by_vector(hybrid, "How do we write Wharton?", self.embeddings.embed_query("How do we write Wharton?"))
+            self.assertEqual(len(results), 3)
+            self.assertIn({"page": 99}, [doc.metadata for doc in results])
+
+        vector_store.create_vector_store(docs, "test_collection", persist_directory=self.index_dir)
+        self.assertFalse(os.path.isfile(os.path.join(self.index_dir, "test_collection.bm25.npz")), "Expected the stale BM25 index to be removed")
+
+    def test_bm25_ranking(self):
+        index = BM25Index.build(["a", "b", "c"], ["penn football penn", "football coach", "dining hall menu"])
+        self.assertEqual([doc_id for doc_id, _ in index.search("Penn football", k=5)], ["a", "b"])
+        path = os.path.join(self.index_dir, "index.bm25.npz")
+        index.save(path)
+        self.assertEqual(BM25Index.load(path).search("penn football", k=5), index.search("penn football", k=5))
+        self.assertEqual(reciprocal_rank_fusion([["x", "y"], ["y", "z"]], k=2), ["y", "x"])
+
+class TestEmbeddingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(make_temp_dir(self), "embeddings.sqlite3")
+        self.model = CountingEmbeddings()
+
+    def test_memory_and_disk_hits(self):
+        cache = CachedEmbeddings(self.model, model="test-model", path=self.path)
+        first = cache.embed_documents(["penn", "wharton", "penn"])
+        self.assertEqual(self.model.calls, 2, "Expected each distinct text to be embedded once")
+        self.assertEqual(cache.embed_documents(["wharton"])[0], first[1])
+        self.assertEqual(cache.stats()["memory_hits"], 1)
+
+        restarted = CachedEmbeddings(self.model, model="test-model", path=self.path)
+        self.assertEqual(restarted.embed_documents(["penn", "wharton"]), first[:2])
+        self.assertEqual(self.model.calls, 2, "Expected the disk tier to survive a restart")
+        self.assertEqual(restarted.stats()["disk_hits"], 2)
+
+    def test_key_includes_model_and_task(self):
+        cache = CachedEmbeddings(self.model, model="test-model")
+        cache.embed_documents(["penn"])
+        cache.embed_query("penn")
+        CachedEmbeddings(self.model, model="other-model").embed_documents(["penn"])
+        self.assertEqual(self.model.calls, 3)
+
+    def test_eviction(self):
+        cache = CachedEmbeddings(self.model, model="test-model", path=self.path, max_memory_items=2, max_disk_items=10)
+        cache.embed_documents(["a", "b", "c", "d"])
+        self.assertEqual(cache.stats()["memory_items"], 2)
+        cache._memory.clear()
+        cache.embed_documents(["a", "b", "c", "d"])
+        self.assertEqual(cache.stats()["disk_hits"], 4)
+
+        cache.embed_documents([str(i) for i in range(7)])
+        rows = cache._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.assertEqual(rows, 9, "Expected the disk tier to be trimmed to 90% of 10 vectors once it held 11")
+        cache._memory.clear()
+        cache.embed_documents(["a", "b"])
+        self.assertEqual(cache.stats()["disk_hits"], 4, "Expected the least recently used vectors to be evicted")
+
+class TestMultiRetriever(unittest.TestCase):
+
+    def test_query_is_embedded_once(self):
+        embeddings = CountingEmbeddings()
+        retrievers = {}
+        for name in ["context", "context1", "context2", "context3"]:
+            store = InMemoryVectorStore(embeddings)
+            store.add_texts([f"{name} doc {i}" for i in range(6)])
+            retrievers[name] = store.as_retriever(search_kwargs={"k": 2})
+
+        contexts = create_multi_retriever(retrievers, embeddings).invoke("context2 doc 3")
+        self.assertEqual(embeddings.queries, 1, "Expected one query embedding for all retrievers")
+        self.assertEqual(sorted(contexts), ["context", "context1", "context2", "context3"])
+        self.assertEqual([len(docs) for docs in contexts.values()], [2, 2, 2, 2])
+        self.assertEqual(contexts["context2"], retrievers["context2"].invoke("context2 doc 3"))
+
+    def test_async_retrieval(self):
+        embeddings = CountingEmbeddings()
+        store = InMemoryVectorStore(embeddings)
+        store.add_texts(["penn", "wharton", "quakers"])
+        retrievers = {name: store.as_retriever(search_kwargs={"k": 1}) for name in ["context", "context1"]}
+
+        contexts = asyncio.run(create_multi_retriever(retrievers, embeddings).ainvoke("wharton"))
+        self.assertEqual(embeddings.queries, 1)
+        self.assertEqual([docs[0].page_content for docs in contexts.values()], ["wharton", "wharton"])
+
+    def test_batch_retrieval_matches_single_queries(self):
+        embeddings = HashEmbeddings(size=64)
+        docs = [Document(page_content=f"{topic} article {i}", metadata={"source": topic}) for topic in ["wharton", "football", "dining"] for i in range(4)]
+        hybrid = vector_store.create_vector_store(docs, f"batch_{os.getpid()}_{time.time_ns()}", k_pre=3, hybrid=True, embeddings=embeddings)
+        tags = ["Wharton", "Football", "Dining", "Student Life"]
+        tag_index = TagIndex(tags, np.asarray(embeddings.embed_documents(tags), dtype=np.float32), embeddings)
+        multi_retriever = create_multi_retriever({"context": hybrid, "context3": tag_index.as_retriever(k=2)}, embeddings)
+
+        queries = ["wharton article 2", "football tickets", "dining hall hours"]
+        batch = multi_retriever.retrieve_batch(queries)
+        self.assertEqual(len(batch), 3)
+        for query, contexts in zip(queries, batch):
+            single = multi_retriever.invoke(query)
+            self.assertEqual([doc.page_content for doc in contexts["context"]], [doc.page_content for doc in single["context"]])
+            self.assertEqual([doc.page_content for doc in contexts["context3"]], [doc.page_content for doc in single["context3"]])
+        self.assertEqual(batch[1]["context3"][0].page_content, "Football")
+
+    def test_department_only_searches_its_guides(self):
+        embeddings = HashEmbeddings(size=64)
+        docs = [Document(page_content=f"Spell out numbers under ten in {guide} rule {i}", metadata={"guide": guide})
+                for guide in ["34_Style.pdf", "All_Style.pdf", "DEI_Style.pdf", "Sports_Style.pdf"] for i in range(3)]
+        store = vector_store.create_vector_store(docs, f"guides_{os.getpid()}_{time.time_ns()}", k_pre=4, hybrid=True, embeddings=embeddings)
+        store = RerankedRetriever(base_retriever=store, reranker=LexicalReranker(budget=None), top_n=4)
+        multi_retriever = create_multi_retriever({"context2": DepartmentRetriever(base_retriever=store)}, embeddings)
+
+        self.assertEqual(guides_for("DP Sports"), ["Sports_Style.pdf", "All_Style.pdf", "DEI_Style.pdf"])
+        self.assertIsNone(guides_for("Unknown desk"))
+        question = "How do I write numbers in 34_Style.pdf?"
+        sports = multi_retriever.invoke({"question": question, "dept": "DP Sports"})["context2"]
+        self.assertEqual(len(sports), 4)
+        self.assertTrue(all(doc.metadata["guide"] != "34_Style.pdf" for doc in sports))
+        self.assertIn("34_Style.pdf", {doc.metadata["guide"] for doc in multi_retriever.invoke(question)["context2"]})
+
+        batch = multi_retriever.retrieve_batch([{"question": question, "dept": "DP Sports"}, {"question": question, "dept": "34th Street"}])
+        self.assertEqual([doc.page_content for doc in batch[0]["context2"]], [doc.page_content for doc in sports])
+        self.assertLessEqual({doc.metadata["guide"] for doc in batch[1]["context2"]}, {"34_Style.pdf", "All_Style.pdf", "DEI_Style.pdf"})
+
+class CountingReranker(LexicalReranker):
+    """Lexical reranker that records its scoring calls and can be made slow."""
+
+    def __init__(self, delay=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.delay = delay
+        self.calls = []
+
+    def score(self, query, texts):
+        self.calls.append(len(texts))
+        time.sleep(self.delay)
+        return super().score(query, texts)
+
+class TestReranker(unittest.TestCase):
+
+    def setUp(self):
+        self.docs = [Document(page_content=text) for text in ["dining hall hours", "sports desk rules", "abbreviate wharton as wharton school"]]
+
+    def test_rerank_keeps_top_n(self):
+        reranker = CountingReranker()
+        reranked = reranker.rerank("how to write wharton", self.docs, top_n=2)
+        self.assertEqual([doc.page_content for doc in reranked], ["abbreviate wharton as wharton school", "dining hall hours"])
+
+        reranker.rerank("how to write wharton", self.docs, top_n=2)
+        self.assertEqual(reranker.calls, [3], "Expected the second call to be served from the cache")
+
+    def test_budget_falls_back_to_vector_order(self):
+        reranker = CountingReranker(delay=0.3, budget=0.05)
+        self.assertEqual(reranker.rerank("wharton", self.docs, top_n=2), self.docs[:2])
+        self.assertEqual(reranker.stats()["timeouts"], 1)
+        time.sleep(0.4)
+        self.assertEqual(reranker.rerank("wharton", self.docs, top_n=1)[0], self.docs[2], "Expected the late scores to be cached")
+
+    def test_concurrent_requests_dont_queue_behind_each_other(self):
+        reranker = CountingReranker(delay=0.1, budget=0.5, workers=4)
+        threads = [threading.Thread(target=reranker.rerank, args=(f"wharton {i}", self.docs, 2)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(reranker.stats()["timeouts"], 0)
+
+        # A scoring still queued at its deadline is dropped instead of delaying the next request
+        reranker = CountingReranker(delay=0.2, budget=0.05, workers=1)
+        threads = [threading.Thread(target=reranker.rerank, args=(f"dining {i}", self.docs, 2)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        time.sleep(0.3)
+        self.assertEqual(reranker.stats()["timeouts"], 3)
+        self.assertEqual(len(reranker.calls), 1)
+
+    def test_collections_are_reranked_in_one_call(self):
+        embeddings = CountingEmbeddings()
+        reranker = CountingReranker()
+        retrievers = {}
+        for name in ["context", "context1"]:
+            store = InMemoryVectorStore(embeddings)
+            store.add_texts([f"{name} doc {i}" for i in range(6)] + [f"{name} wharton"])
+            retrievers[name] = RerankedRetriever(base_retriever=store.as_retriever(search_kwargs={"k": 7}), reranker=reranker, top_n=2)
+
+        contexts = create_multi_retriever(retrievers, embeddings).invoke("wharton")
+        self.assertEqual(reranker.calls, [14], "Expected all candidates to be scored in a single call")
+        self.assertEqual([docs[0].page_content for docs in contexts.values()], ["context wharton", "context1 wharton"])
+        self.assertEqual([len(docs) for docs in contexts.values()], [2, 2])
+        self.assertEqual(contexts["context"], retrievers["context"].invoke("wharton"))
+
+class TestContextAssembler(unittest.TestCase):
+
+    def test_dedupe_and_budget(self):
+        advice = "Keep URL slugs short, use hyphens between words and put the main keyword first in the slug."
+        inputs = {
+            "context1": [Document(page_content=advice, metadata={"source": "https://moz.com/learn/seo/url"}),
+                         Document(page_content=advice + " Avoid stop words.", metadata={"source": "https://www.semrush.com/blog/url/"})],
+            "context2": [Document(page_content="Wharton: the Wharton School on first reference. " * 40, metadata={"source": "files/All_Style.pdf", "page": 11}),
+                         Document(page_content="Never reached", metadata={"source": "files/All_Style.pdf", "page": 12})],
+            "context3": [Document(page_content=tag, metadata={"tag": tag}) for tag in ["football", "wharton"]],
+            "question": "How do I write Wharton?",
+        }
+        assembler = ContextAssembler({"context1": 100, "context2": 100, "context3": 10})
+        outputs = assembler.assemble(inputs)
+
+        self.assertEqual(outputs["context1"], f"- [moz.com/learn/seo/url] {advice}")
+        self.assertTrue(outputs["context2"].startswith("- [All_Style.pdf p.12] Wharton:"))
+        self.assertNotIn("Never reached", outputs["context2"])
+        self.assertLessEqual(estimate_tokens(outputs["context2"]), 100)
+        self.assertEqual(outputs["context3"], "football, wharton")
+        self.assertEqual(outputs["question"], "How do I write Wharton?")
+
+        stats = assembler.stats()
+        self.assertEqual(stats["duplicates"], 1)
+        self.assertGreater(stats["tokens_saved_per_request"], 0)
+
+    def test_parse_budgets(self):
+        budgets = parse_budgets("context=800, context2=2000")
+        self.assertEqual((budgets["context"], budgets["context1"], budgets["context2"]), (800, 1000, 2000))
+
+class TestArticleIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.folder, "organic_search.csv")
+        with open(self.csv_path, "w", encoding="utf-8") as file:
+            file.write("Top pages,Title,Clicks,Impressions,CTR,Position,Published\n"
+                       "https://www.thedp.com/article/2024/05/penn-dining-hall-hours,Dining hall hours,\"1,000\",20000,5%,4.0,2024-05-01\n"
+                       "https://www.thedp.com/article/2024/05/penn-dining-hall-hours,Dining hall hours,500,10000,5%,10.0,2024-06-01\n"
+                       "https://www.thedp.com/article/2023/09/penn-football-season-preview,Football season preview,800,4000,20%,2.0,2023-09-01\n"
+                       "https://www.thedp.com/article/2022/01/wharton-dining-review,Wharton dining review,50,200,25%,1.5,2022-01-10\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_rows_of_a_url_are_merged(self):
+        index = ArticleIndex.from_csv(self.csv_path)
+        row = index.lookup("penn-dining-hall-hours")
+        self.assertEqual(len(index), 3)
+        self.assertEqual((index.clicks[row], index.impressions[row]), (1500, 30000))
+        self.assertAlmostEqual(float(index.ctr[row]), 0.05)
+        self.assertAlmostEqual(float(index.position[row]), 6.0)
+        self.assertEqual(str(index.dates[row]), "2024-06-01")
+        self.assertEqual(index.lookup("https://www.thedp.com/article/2023/09/penn-football-season-preview/"), 1)
+        self.assertIsNone(index.lookup("penn-unknown-article"))
+
+    def test_top_articles_on_a_topic(self):
+        index = ArticleIndex.from_csv(self.csv_path)
+        dining = index.topic_rows("dining")
+        self.assertEqual(sorted(dining.tolist()), [0, 2])
+        self.assertEqual(index.top(2, by="clicks", rows=dining).tolist(), [0, 2])
+        self.assertEqual(index.top(3, by="position").tolist(), [2, 1, 0])
+        self.assertEqual(index.top(3, by="position", min_impressions=1000).tolist(), [1, 0])
+        self.assertEqual(index.top(3, since="2023-01-01").tolist(), [0, 1])
+
+    def test_save_load_and_retriever(self):
+        path = os.path.join(self.folder, "articles.npz")
+        ArticleIndex.from_csv(self.csv_path).save(path)
+        index = ArticleIndex.load(path)
+        self.assertEqual(index.urls[2], "https://www.thedp.com/article/2022/01/wharton-dining-review")
+        self.assertEqual(index.lookup("wharton-dining-review"), 2)
+
+        docs = index.as_retriever(n=5).invoke("Which dining articles rank best, like wharton-dining-review?")
+        self.assertEqual(len(docs), 2)
+        self.assertIn("/article/2022/01/wharton-dining-review | Wharton dining review | 50 | 200 | 25.0% | 1.5", docs[0].page_content)
+
+        docs = index.as_retriever(n=5).invoke("Which dining articles rank best?")
+        self.assertEqual(len(docs), 1)
+        self.assertTrue(docs[0].page_content.startswith("Top 2 of 3 articles on this topic by position:"))
+        self.assertLess(docs[0].page_content.index("wharton-dining-review"), docs[0].page_content.index("penn-dining-hall-hours"))
+
+        # Tables keep their line breaks in the prompt and are cut after a whole row
+        context = ContextAssembler({"context": 70}).assemble({"context": docs, "question": "q"})["context"]
+        self.assertTrue(context.startswith("Top 2 of 3 articles on this topic by position:\npath | title"))
+        self.assertLessEqual(estimate_tokens(context), 70)
+        self.assertEqual(context.count("\n"), 2)
+        self.assertTrue(context.endswith("2022-01-10"))
+
+    def test_templated_prompt_through_multi_retriever(self):
+        multi_retriever = create_multi_retriever({"context": ArticleIndex.from_csv(self.csv_path).as_retriever(n=5)}, HashEmbeddings())
+        title, content = "Football season preview", "The electric atmosphere at Franklin Field, unlike the wharton-dining-review crowd."
+
+        def retrieve(question):
+            return multi_retriever.invoke({"question": get_editor_question("DP Sports", title, content, question), "dept": "DP Sports",
+                                           "article": article_text(title, content), "editor_question": question})
+
+        docs = retrieve("Suggest a slug")
+        self.assertEqual(len(docs["context"]), 1, "Expected slugs in the article body not to count as mentioned")
+        lines = docs["context"][0].page_content.splitlines()
+        self.assertTrue(lines[0].endswith("articles on this topic by clicks:"), "Expected \"electric\" in the body not to sort by CTR")
+        self.assertIn("penn-football-season-preview", lines[2], "Expected the article's topic to come first")
+        self.assertNotIn("penn-dining-hall-hours", docs["context"][0].page_content)
+
+        docs = retrieve("How does wharton-dining-review rank?")
+        self.assertTrue(docs["context"][0].page_content.startswith("Articles mentioned in the question:"))
+        self.assertIn("by position:", docs["context"][1].page_content)
+
+    def test_missing_columns(self):
+        with open(self.csv_path, "w", encoding="utf-8") as file:
+            file.write("Query,Clicks\npenn dining,10\n")
+        with self.assertRaises(ValueError):
+            ArticleIndex.from_csv(self.csv_path)
+
+class TestPromptCaching(unittest.TestCase):
+
+    def test_static_instructions_are_a_cached_system_prefix(self):
+        prompt = get_prompt(pinned_context="- [All_Style.pdf p.1] Spell out numbers under 10.")
+        messages = prompt.invoke({"context": "a", "context1": "b", "context2": "c", "context3": "d", "question": "q"}).to_messages()
+        self.assertEqual([message.type for message in messages], ["system", "human"])
+        self.assertEqual(messages[0].content, get_prompt(pinned_context="- [All_Style.pdf p.1] Spell out numbers under 10.").messages[0].content)
+        self.assertEqual(messages[0].content[-1]["cache_control"], {"type": "ephemeral"})
+        self.assertNotIn("{", messages[0].content[0]["text"])
+        self.assertIn("Question by the editor: q.", messages[1].content)
+
+    def test_usage_tracker_splits_cached_tokens(self):
+        tracker = UsageTracker()
+        message = AIMessage(content="ok", usage_metadata={"input_tokens": 1500, "output_tokens": 200, "total_tokens": 1700,
+                                                          "input_token_details": {"cache_read": 1200, "cache_creation": 0}})
+        tracker.on_llm_end(LLMResult(generations=[[ChatGeneration(message=message)]]))
+        self.assertEqual(tracker.stats(), {"requests": 1, "cache_read": 1200, "cache_creation": 0, "uncached": 300, "output": 200})
+
+class TestMetrics(unittest.TestCase):
+
+    def test_stages_are_collected_in_the_trace(self):
+        embeddings = CountingEmbeddings()
+        store = InMemoryVectorStore(embeddings)
+        store.add_texts(["penn", "wharton", "quakers"])
+        retriever = create_multi_retriever({"context": store.as_retriever(search_kwargs={"k": 1})}, embeddings)
+
+        with mock.patch.object(metrics, "log_event") as log_event:
+            with metrics.trace("chat", dept="news") as current:
+                retriever.invoke("wharton")
+                metrics.add_fields(cache_hit=False)
+        fields = log_event.call_args.kwargs
+        self.assertEqual(log_event.call_args.args[0], "chat_trace")
+        self.assertEqual(set(fields["stages_ms"]), {"embed_query", "search.context"}, "Expected the search thread to add to the trace")
+        self.assertEqual((fields["dept"], fields["cache_hit"], fields["request_id"]), ("news", False, current["request_id"]))
+        self.assertIn('dp_stage_duration_seconds_count{stage="search.context"}', metrics.REGISTRY.render())
+
+    def test_async_generator_trace_survives_task_switches(self):
+        async def handler():
+            for stage in ["first", "second"]:
+                with metrics.span(stage):
+                    await asyncio.sleep(0)
+                yield stage
+
+        async def consume():
+            # Resumed from a new task on every step, like the UI does
+            iterator = metrics.trace_aiter("chat", handler()).__aiter__()
+            items = [await asyncio.create_task(iterator.__anext__()) for _ in range(2)]
+            with self.assertRaises(StopAsyncIteration):
+                await asyncio.create_task(iterator.__anext__())
+            return items
+
+        with mock.patch.object(metrics, "log_event") as log_event:
+            self.assertEqual(asyncio.run(consume()), ["first", "second"])
+        self.assertEqual(set(log_event.call_args.kwargs["stages_ms"]), {"first", "second"})
+
+    def test_timed_iter_excludes_nested_stages(self):
+        def slow(items, delay):
+            for item in items:
+                time.sleep(delay)
+                yield item
+
+        with mock.patch.object(metrics, "log_event") as log_event:
+            with metrics.trace("ingest"):
+                list(metrics.timed_iter("split", slow(metrics.timed_iter("load", slow(range(3), 0.02)), 0.01)))
+        stages = log_event.call_args.kwargs["stages_ms"]
+        self.assertGreaterEqual(stages["load"], 60)
+        self.assertLess(stages["split"], 50, "Expected the loading time not to be counted as splitting")
+
+    def test_histogram_render(self):
+        registry = metrics.Registry()
+        for seconds in [0.003, 0.2, 0.2, 3.0]:
+            registry.observe("llm.total", seconds)
+        registry.increment("response_cache_hits")
+        page = registry.render()
+        self.assertIn('dp_stage_duration_seconds_bucket{stage="llm.total",le="0.25"} 3', page)
+        self.assertIn('dp_stage_duration_seconds_bucket{stage="llm.total",le="+Inf"} 4', page)
+        self.assertIn("dp_response_cache_hits_total 1", page)
+        self.assertEqual(registry.histograms["llm.total"].quantile(0.5), 0.25)
+
+class TestOfflineStubs(unittest.TestCase):
+
+    def test_chain_runs_with_stub_llm_and_embeddings(self):
+        embeddings = HashEmbeddings(size=64)
+        self.assertEqual(embeddings.embed_query("Wharton dining"), HashEmbeddings(size=64).embed_query("wharton  DINING"))
+        retrievers = []
+        for name in ["articles", "seo", "style", "tags"]:
+            store = InMemoryVectorStore(embeddings)
+            store.add_texts([f"{name} wharton {i}" for i in range(3)])
+            retrievers.append(store.as_retriever(search_kwargs={"k": 2}))
+
+        chain = create_chain(*retrievers, api_key="", model_name="stub", embeddings=embeddings, llm=StubChatModel(first_token_delay=0.01))
+        self.assertEqual(chain.invoke("How do I write Wharton?"), CANNED_RESPONSE)
+        chunks = list(chain.stream("How do I write Wharton?"))
+        self.assertGreater(len(chunks), 10, "Expected the response to be streamed word by word")
+        self.assertEqual("".join(chunks), CANNED_RESPONSE)
+
+    def test_compare_reports_lists_regressions(self):
+        baseline = {"results": {"load_csv": {"1x": {"seconds": 1.0}}, "chain_invoke": {"1x": {"p50_ms": 100.0}}}}
+        report = {"results": {"load_csv": {"1x": {"seconds": 1.05}, "10x": {"seconds": 9.0}}, "chain_invoke": {"1x": {"p50_ms": 150.0}}}}
+        self.assertEqual(compare_reports(baseline, report), ["chain_invoke 1x: 100.00ms -> 150.00ms (+50%)"])
+
+class FailingChatModel(StubChatModel):
+    """Stub chat model that fails for questions containing a marker."""
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if "FAIL" in str(messages[-1].content):
+            raise ValueError("overloaded")
+        return super()._generate(messages, stop, run_manager, **kwargs)
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.output_path = os.path.join(self.folder, "results.jsonl")
+        self.input_path = os.path.join(self.folder, "articles.csv")
+        with open(self.input_path, "w", encoding="utf-8") as file:
+            file.write("id,Dept,Title,Content\n" + "".join(f"a{i},news,Title {i},Content about Penn {i}\n" for i in range(5)))
+        embeddings = HashEmbeddings(size=64)
+        store = InMemoryVectorStore(embeddings)
+        store.add_texts(["Use hyphens in slugs", "Penn, not UPenn"])
+        self.retrieve_batch = create_multi_retriever({name: store.as_retriever(search_kwargs={"k": 1}) for name in
+                                                      ["context", "context1", "context2", "context3"]}, embeddings).retrieve_batch
+        self.generate = create_generation_chain("", "stub", llm=FailingChatModel())
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def read_output(self):
+        with open(self.output_path, encoding="utf-8") as file:
+            return [json.loads(line) for line in file]
+
+    def test_results_in_input_order_and_resume(self):
+        stats = run_batch(iter_articles(self.input_path), self.output_path, self.retrieve_batch, self.generate,
+                          batch_size=2, max_concurrency=3, requests_per_minute=6000)
+        self.assertEqual((stats["skipped"], stats["written"]), (0, 5))
+        rows = self.read_output()
+        self.assertEqual([row["id"] for row in rows], ["a0", "a1", "a2", "a3", "a4"])
+        self.assertEqual(rows[0]["slug"], "penn-wharton-dining-hall-hours")
+        self.assertEqual(rows[0]["tags"], ["Wharton", "Dining", "Student Life"])
+
+        # A crash left two rows and half of the third, the rerun answers the rest
+        with open(self.output_path, "w", encoding="utf-8") as file:
+            file.write("".join(json.dumps(row) + "\n" for row in rows[:2]) + json.dumps(rows[2])[:20])
+        stats = run_batch(iter_articles(self.input_path), self.output_path, self.retrieve_batch, self.generate, batch_size=2)
+        self.assertEqual((stats["skipped"], stats["written"]), (2, 3))
+        self.assertEqual([row["row"] for row in self.read_output()], [0, 1, 2, 3, 4])
+
+    def test_failed_row_stops_the_run(self):
+        articles = list(iter_articles(self.input_path))
+        articles[3]["content"] = "FAIL"
+        with self.assertRaises(RuntimeError):
+            run_batch(articles, self.output_path, self.retrieve_batch, self.generate, batch_size=2, retries=1)
+        self.assertEqual([row["row"] for row in self.read_output()], [0, 1, 2])
+
+class TestWarmup(unittest.TestCase):
+
+    def test_requests_wait_for_background_startup(self):
+        release = threading.Event()
+
+        def start(warmup):
+            warmup.set_step("opening the index")
+            release.wait(5)
+            return "engine"
+
+        warmup = Warmup(start).start()
+        text, final = warmup.status()
+        self.assertFalse(final)
+        self.assertIn("opening the index", text)
+        with self.assertRaises(TimeoutError):
+            warmup.wait(timeout=0.01)
+
+        async def request():
+            return await warmup.await_ready()
+
+        finished = threading.Event()
+        warmup.add_done_callback(lambda done: done.ready and finished.set())
+        threading.Timer(0.05, release.set).start()
+        self.assertEqual(asyncio.run(request()), "engine")
+        self.assertTrue(finished.wait(1), "Expected the callback to run once startup finished")
+        self.assertTrue(warmup.ready)
+        self.assertEqual(warmup.status(), ("", True))
+
+    def test_failed_startup_is_reported(self):
+        warmup = Warmup(lambda warmup: (_ for _ in ()).throw(EnvironmentError("Nomic login key is invalid")))
+        with mock.patch("warmup.log_event"):
+            warmup.run()
+        self.assertFalse(warmup.ready)
+        self.assertEqual(warmup.status(), ("⚠️ Startup failed: Nomic login key is invalid", True))
+        errors = []
+        warmup.add_done_callback(lambda done: errors.append(done.error))
+        self.assertIsInstance(errors[0], EnvironmentError, "Expected a callback added after the failure to run right away")
+        with self.assertRaises(RuntimeError):
+            warmup.wait()
+
+class SimilarityEmbeddings(Embeddings):
+    """Maps a few phrases to fixed vectors so similarity is predictable."""
+    vectors = {"penn wins": [1.0, 0.0, 0.0], "penn won": [0.99, 0.1, 0.0], "budget cuts": [0.0, 1.0, 0.0]}
+
+    def embed_documents(self, texts):
+        return [self.vectors[text] for text in texts]
+
+    def embed_query(self, text):
+        return self.vectors[text]
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.cache = ResponseCache(embeddings=SimilarityEmbeddings(), max_items=2, ttl=60, threshold=0.95,
+                                   index_version="v1", clock=lambda: self.now)
+        self.cache.put("DP Sports", "Penn wins", "body", "Suggest a slug", "penn-wins", query_text="penn wins")
+
+    def test_exact_hit_is_normalized(self):
+        self.assertEqual(self.cache.get("dp sports", "  Penn   wins ", "body", "suggest a slug"), "penn-wins")
+        self.assertEqual(self.cache.stats()["exact_hits"], 1)
+
+    def test_near_duplicate_hit(self):
+        self.assertEqual(self.cache.get("DP Sports", "Penn won", "body", "Suggest a slug", query_text="penn won"), "penn-wins")
+        self.assertIsNone(self.cache.get("DP Sports", "Budget", "body", "Suggest a slug", query_text="budget cuts"))
+        self.assertIsNone(self.cache.get("34th Street", "Penn won", "body", "Suggest a slug", query_text="penn won"),
+                          "Expected no near-duplicate hits across departments")
+        self.assertEqual(self.cache.stats()["semantic_hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+    def test_near_duplicate_needs_same_question(self):
+        self.assertIsNone(self.cache.get("DP Sports", "Penn won", "body", "Is my title too long?", query_text="penn won"),
+                          "Expected a follow-up question about the same article not to get the earlier answer")
+
+    def test_ttl_lru_and_index_version(self):
+        self.now = 61
+        self.assertIsNone(self.cache.get("DP Sports", "Penn wins", "body", "Suggest a slug"), "Expected the entry to expire")
+
+        for i in range(3):
+            self.cache.put("DP Sports", f"title {i}", "body", "q", f"response {i}")
+        self.assertIsNone(self.cache.get("DP Sports", "title 0", "body", "q"), "Expected the oldest entry to be evicted")
+        self.assertEqual(self.cache.get("DP Sports", "title 2", "body", "q"), "response 2")
+
+        self.cache.set_index_version("v2")
+        self.assertIsNone(self.cache.get("DP Sports", "title 2", "body", "q"))
+
+    def test_shared_between_processes(self):
+        # Two caches on one file stand in for two server workers
+        path = os.path.join(make_temp_dir(self), "responses.sqlite3")
+        first = ResponseCache(embeddings=SimilarityEmbeddings(), threshold=0.95, index_version="v1", path=path)
+        second = ResponseCache(embeddings=SimilarityEmbeddings(), threshold=0.95, index_version="v1", path=path)
+        first.put("DP Sports", "Penn wins", "body", "Suggest a slug", "penn-wins", query_text="penn wins")
+        self.assertEqual(second.get("DP Sports", "Penn wins", "body", "Suggest a slug"), "penn-wins")
+        self.assertEqual(second.get("DP Sports", "Penn won", "body", "Suggest a slug", query_text="penn won"), "penn-wins")
+
+        second.set_index_version("v2")
+        self.assertIsNone(ResponseCache(embeddings=SimilarityEmbeddings(), index_version="v2", path=path).get("DP Sports", "Penn wins", "body", "Suggest a slug"))
+
+class TestCoalescer(unittest.TestCase):
+
+    def test_identical_requests_share_one_call(self):
+        calls = []
+
+        async def produce():
+            calls.append(1)
+            for token in ["penn", "-", "wins"]:
+                await asyncio.sleep(0.01)
+                yield token
+
+        async def collect(coalescer):
+            return "".join([chunk async for chunk in coalescer.stream("key", produce)])
+
+        async def burst():
+            coalescer = RequestCoalescer()
+            return await asyncio.gather(*(collect(coalescer) for _ in range(5)))
+
+        self.assertEqual(asyncio.run(burst()), ["penn-wins"] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_waits_for_the_lease_of_another_worker(self):
+        path = os.path.join(make_temp_dir(self), "responses.sqlite3")
+        holder, waiter = RequestCoalescer(path=path), RequestCoalescer(path=path, poll_interval=0.01)
+        stored = {}
+
+        async def produce():
+            raise AssertionError("Expected the waiting worker not to call the LLM")
+            yield
+
+        async def lookup():
+            return stored.get("key")
+
+        async def wait():
+            return "".join([chunk async for chunk in waiter.stream("key", produce, lookup=lookup)])
+
+        self.assertTrue(holder._acquire("key"))
+        threading.Timer(0.05, lambda: stored.update(key="penn-wins")).start()
+        self.assertEqual(asyncio.run(wait()), "penn-wins")
+        holder._release("key")
+        self.assertTrue(waiter._acquire("key"), "Expected the lease to be free once released")
+
+    def test_response_stored_between_two_polls(self):
+        path = os.path.join(make_temp_dir(self), "responses.sqlite3")
+        holder, waiter = RequestCoalescer(path=path), RequestCoalescer(path=path, poll_interval=0.05)
+        stored = {}
+
+        async def produce():
+            raise AssertionError("Expected the waiting worker not to call the LLM")
+            yield
+
+        async def lookup():
+            return stored.get("key")
+
+        def finish():
+            stored.update(key="penn-wins")
+            holder._release("key")
+
+        async def wait():
+            return "".join([chunk async for chunk in waiter.stream("key", produce, lookup=lookup)])
+
+        self.assertTrue(holder._acquire("key"))
+        threading.Timer(0.02, finish).start()
+        self.assertEqual(asyncio.run(wait()), "penn-wins")
+
+class TestTagIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tag_path = os.path.join(make_temp_dir(self), "final_tags.txt")
+        with open(self.tag_path, 'w') as file:
+            file.write("football\nmen's basketball\nwharton\nfootball coach\n\nprovost\n")
+        self.embeddings = CountingEmbeddings()
+
+    def test_saved_next_to_tag_file(self):
+        index = TagIndex.load_or_build(self.tag_path, self.embeddings, "test-model")
+        self.assertTrue(os.path.isfile(self.tag_path.replace(".txt", ".npy")))
+        self.assertEqual(self.embeddings.calls, 5)
+
+        reloaded = TagIndex.load_or_build(self.tag_path, self.embeddings, "test-model")
+        self.assertEqual(self.embeddings.calls, 5, "Expected the saved matrix to be reused")
+        self.assertEqual(reloaded.tags, index.tags)
+
+        with open(self.tag_path, 'a') as file:
+            file.write("admissions\n")
+        self.assertIn("admissions", TagIndex.load_or_build(self.tag_path, self.embeddings, "test-model").tags)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.tag_path))), ["final_tags.json", "final_tags.npy", "final_tags.txt"],
+                         "Expected no temporary files left behind")
+
+    def test_dense_search_matches_brute_force(self):
+        index = TagIndex.load_or_build(self.tag_path, self.embeddings, "test-model")
+        query = self.embeddings.embed_query("wharton")
+        vectors = np.asarray(self.embeddings.embed_documents(index.tags))
+        cosine = vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query))
+        expected = [index.tags[i] for i in np.argsort(-cosine)[:3]]
+        self.assertEqual([tag for tag, _ in index.search(query, 3)], expected)
+
+    def test_lexical_lookups(self):
+        index = TagIndex(["football", "football coach", "Wharton", "men's basketball"], np.eye(4, dtype=np.float32))
+        self.assertEqual(index.prefix("foot"), ["football", "football coach"])
+        self.assertEqual(index.fuzzy("footbal", limit=1)[0][0], "football")
+        self.assertEqual(index.find_in_text("The Wharton football coach resigned"), ["Wharton", "football", "football coach"])
+
+        docs = index.as_retriever(k=2).search_by_vector("I write for DP Sports. My question is: suggest tags", [0.0, 0.0, 0.0, 1.0],
+                                                        article="a wharton story")
+        self.assertEqual([doc.page_content for doc in docs], ["Wharton", "men's basketball"])
+        self.assertEqual(docs[0].metadata, {"tag": "Wharton"})
+
+        # Tags in the prompt wording are not article tags
+        docs = index.as_retriever(k=2).search_by_vector("a football coach asks about a wharton story", [0.0, 0.0, 0.0, 1.0])
+        self.assertEqual(docs[0].page_content, "men's basketball")
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot_dir = make_temp_dir(self)
+
+    def _build(self, version, base=None):
+        path = snapshot.prepare_snapshot(self.snapshot_dir, version, base=base)
+        with open(os.path.join(path, "chroma.sqlite3"), 'w') as file:
+            file.write(version)
+        snapshot.write_manifest(path, {"version": version})
+        return path
+
+    def test_unfinished_snapshot_is_ignored(self):
+        self._build("20240101T000000Z")
+        snapshot.prepare_snapshot(self.snapshot_dir, "20240102T000000Z")  # no manifest yet
+        self.assertEqual(snapshot.list_snapshots(self.snapshot_dir), ["20240101T000000Z"])
+        self.assertTrue(snapshot.latest_snapshot(self.snapshot_dir).endswith("20240101T000000Z"))
+
+    def test_activate_and_rollback(self):
+        first = self._build("20240101T000000Z")
+        self._build("20240102T000000Z", base=first)
+        snapshot.activate_snapshot(self.snapshot_dir, "20240102T000000Z")
+        self.assertTrue(snapshot.latest_snapshot(self.snapshot_dir).endswith("20240102T000000Z"))
+
+        snapshot.activate_snapshot(self.snapshot_dir, "20240101T000000Z")
+        self.assertEqual(snapshot.read_manifest(snapshot.latest_snapshot(self.snapshot_dir))["version"], "20240101T000000Z")
+        with self.assertRaises(ValueError):
+            snapshot.activate_snapshot(self.snapshot_dir, "missing")
+
+    def test_chroma_collections_of_a_snapshot(self):
+        from ingest import chroma_collections
+
+        path = self._build("20240101T000000Z")
+        snapshot.write_manifest(path, {"version": "20240101T000000Z", "chunk_counts": dict.fromkeys(
+            ["csv_collection", "url_collection", "pdf_collection", "tag_collection"], 1)})
+        for name in ["articles.npz", "tags.npy"]:
+            open(os.path.join(path, name), 'w').close()
+        os.makedirs(quantized_path(path, "pdf_collection"))
+        self.assertEqual(chroma_collections(path), ["url_collection"], "Expected only the collection without a quantized index")
+
+class TestTagCleaner(unittest.TestCase):
+
+    def setUp(self):
+        folder = make_temp_dir(self)
+        self.output_path = os.path.join(folder, "filtered_tags.txt")
+        self.checkpoint_path = os.path.join(folder, "checkpoint.jsonl")
+        self.sent = []
+        self.fail_on = None
+
+    def _clean(self, batch):
+        if self.fail_on in batch:
+            raise RuntimeError("overloaded")
+        self.sent.extend(batch)
+        return ", ".join(tag.lower() for tag in batch if "junk" not in tag)
+
+    def _run(self, tags):
+        return tag_cleaner.clean_tags_concurrently(
+            tags, output_path=self.output_path, checkpoint_path=self.checkpoint_path, max_concurrency=4,
+            requests_per_minute=60000, max_batch_tokens=20, retries=1, chain=RunnableLambda(self._clean))
+
+    def test_batches_fit_token_budget(self):
+        tags = ["ab", "a much longer tag than the others", "cd", "ef"]
+        batches = tag_cleaner.make_batches(tags, max_batch_tokens=12, max_batch_size=2)
+        self.assertEqual([tag for batch in batches for tag in batch], tags)
+        self.assertTrue(all(len(batch) <= 2 for batch in batches))
+        self.assertEqual(batches[1], ["a much longer tag than the others"])
+
+    def test_resume_sends_each_tag_once(self):
+        tags = [f"Tag {i}" for i in range(40)] + ["junk tag", "Tag 3"]
+        self.fail_on = "Tag 17"
+        self._run(tags)
+        self.assertNotIn("Tag 17", self.sent)
+
+        self.fail_on = None
+        self._run(tags)
+        self.assertEqual(sorted(self.sent), sorted(set(tags)), "Expected every distinct tag to be sent exactly once")
+        with open(self.output_path) as file:
+            accepted = [line.strip() for line in file if line.strip()]
+        self.assertEqual(sorted(accepted), sorted(f"tag {i}" for i in range(40)))
+
+        self.assertEqual(self._run(tags), [])
+        self.assertEqual(len(self.sent), 41)
+
+    def test_streaming_extraction_matches_in_memory(self):
+        text = "['', 'Art. Contrapposto', '11.6.2013', 'app of the week', 'x', '12-4-2014', 'Kimmel  Center', 'kimmel center', 'Penn Band']"
+        path = os.path.join(os.path.dirname(self.output_path), "tags.txt")
+        with open(path, 'w') as file:
+            file.write(text)
+        expected = tag_cleaner.extract_tags_from_text(text)
+        for chunk_size in (1, 7, 1 << 20):
+            raw = list(tag_cleaner.iter_raw_tags(path, chunk_size=chunk_size))
+            self.assertEqual(tag_cleaner.filter_tags(raw), expected)
+
+        written = tag_cleaner.write_unique_tags(tag_cleaner.iter_extract_tags(path, batch_size=2), self.output_path)
+        with open(self.output_path) as file:
+            self.assertEqual(file.read(), "art. contrapposto\napp of the week\nkimmel center\n")
+        self.assertEqual(written, 3)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.output_path))), ["filtered_tags.txt", "tags.txt"], "Expected no temporary files left")
+
+    def test_disk_set_persists(self):
+        path = os.path.join(os.path.dirname(self.output_path), "seen.sqlite3")
+        seen = tag_cleaner.DiskSet(path)
+        self.assertEqual(seen.add_new(["a", "b", "a"]), ["a", "b"])
+        seen.close()
+        seen = tag_cleaner.DiskSet(path)
+        self.assertEqual(seen.add_new(["b", "c"]), ["c"])
+        self.assertEqual(len(seen), 3)
+
+class CachingHandler(BaseHTTPRequestHandler):
+    """Serves one HTML page with an ETag and answers conditional requests with 304."""
+    requests_seen = []
+
+    def do_GET(self):
+        CachingHandler.requests_seen.append((self.path, self.headers.get("If-None-Match")))
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        if self.path == "/gone":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = b"<html lang='en'><head><title>Slugs</title></head><body>Keep slugs short.</body></html>"
+        self.send_response(200)
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestHttpCache(unittest.TestCase):
+
+    def setUp(self):
+        CachingHandler.requests_seen = []
+        self.server = HTTPServer(("127.0.0.1", 0), CachingHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.shutdown)
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+        self.cache_dir = make_temp_dir(self)
+
+    def test_revalidates_with_etag(self):
+        urls = [f"{self.base}/a", f"{self.base}/b"]
+        first = http_cache.fetch_urls(urls, self.cache_dir)
+        second = http_cache.fetch_urls(urls, self.cache_dir)
+        self.assertEqual(first, second)
+        etags = [etag for _, etag in CachingHandler.requests_seen]
+        self.assertEqual(etags.count(None), 2, "Expected one full download per URL")
+        self.assertEqual(etags.count('"v1"'), 2, "Expected a conditional request per URL on the second fetch")
+
+    def test_offline_mode_uses_cache_only(self):
+        http_cache.fetch_urls([f"{self.base}/a"], self.cache_dir)
+        CachingHandler.requests_seen = []
+        pages = http_cache.fetch_urls([f"{self.base}/a", f"{self.base}/missing"], self.cache_dir, offline=True)
+        self.assertIn("Keep slugs short.", pages[0])
+        self.assertIsNone(pages[1])
+        self.assertEqual(CachingHandler.requests_seen, [])
+
+    def test_load_url_documents(self):
+        with mock.patch.dict(os.environ, {"URL_CACHE_DIR": self.cache_dir}):
+            docs = load_url([f"{self.base}/a", f"{self.base}/gone"])
+        self.assertEqual(len(docs), 1, "Expected the 404 page to be skipped")
+        self.assertEqual(docs[0].metadata, {"source": f"{self.base}/a", "title": "Slugs", "language": "en"})
+        self.assertIn("Keep slugs short.", docs[0].page_content)
+
+
+class TestDedup(unittest.TestCase):
+
+    ARTICLE = ("The Daily Pennsylvanian style guide asks writers to spell out numbers one through nine, use numerals for 10 "
+               "and above, and refer to the university as Penn on every reference after the first one in a story")
+
+    def test_near_duplicates_are_dropped_with_provenance(self):
+        docs = [
+            Document(page_content=self.ARTICLE, metadata={"source": "a.pdf", "page": 0}),
+            Document(page_content="Football beats Princeton in overtime at Franklin Field", metadata={"source": "a.pdf", "page": 1}),
+            Document(page_content=self.ARTICLE + " too", metadata={"source": "b.pdf", "page": 4}),
+        ]
+        dedup = Deduplicator(threshold=0.85)
+        retriever = vector_store.create_vector_store(docs, "dedup_collection", embeddings=HashEmbeddings(), dedup=dedup)
+        self.assertEqual((dedup.seen, dedup.removed), (3, 1))
+
+        stored = retriever.vectorstore.get()
+        self.assertEqual(len(stored["ids"]), 2)
+        metadata = stored["metadatas"][stored["documents"].index(self.ARTICLE)]
+        self.assertEqual((metadata["duplicate_sources"], metadata["duplicates"]), ("b.pdf p.5", 1))
+        retriever.vectorstore.delete_collection()
+
+    def test_distinct_chunks_are_kept(self):
+        dedup = Deduplicator(threshold=0.85)
+        docs = [Document(page_content=f"Rule {i}: {' '.join(str(i * j) for j in range(20))}") for i in range(50)]
+        self.assertEqual(len(list(dedup.filter(docs, vector_store.document_id))), 50)
+        self.assertEqual(dedup.provenance(), {})
+
+    def test_lsh_bands(self):
+        bands, rows = lsh_bands(128, 0.85)
+        self.assertLessEqual(bands * rows, 128)
+        self.assertLessEqual((1 / bands) ** (1 / rows), 0.85)
+
+
+class TestQuantizedStore(unittest.TestCase):
+
+    def setUp(self):
+        self.index_dir = make_temp_dir(self)
+        self.embeddings = HashEmbeddings()
+        patcher = mock.patch.object(vector_store, 'get_embeddings', return_value=self.embeddings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        guides = {"sports": "Sports_Style.pdf", "commas": "All_Style.pdf", "street": "34_Style.pdf"}
+        self.docs = [Document(page_content=f"{topic} style rule{i} example{i}", metadata={"guide": guides[topic], "page": i})
+                     for i, topic in enumerate(list(guides) * 20)]
+
+    def test_matches_chroma_results(self):
+        chroma = vector_store.create_vector_store(self.docs, "quantized_collection", k_pre=3, persist_directory=self.index_dir)
+        quantized = vector_store.create_vector_store(self.docs, "quantized_collection", k_pre=3, persist_directory=self.index_dir, quantized=True)
+        self.assertIsInstance(quantized.vectorstore, QuantizedVectorStore)
+        self.assertTrue(os.path.isdir(quantized_path(self.index_dir, "quantized_collection")))
+
+        # Only the best match is unique, the others tie
+        queries = ["sports rule3 example3", "commas rule40 example40", "street rule11"]
+        vectors = [self.embeddings.embed_query(query) for query in queries]
+        for query, vector in zip(queries, vectors):
+            expected = search_by_vector(chroma, query, vector)[0]
+            self.assertEqual(search_by_vector(quantized, query, vector)[0], expected)
+        self.assertEqual(search_by_vectors(quantized, queries, vectors), [search_by_vector(quantized, q, v) for q, v in zip(queries, vectors)])
+
+        vector_store.create_vector_store(self.docs, "quantized_collection", persist_directory=self.index_dir)
+        self.assertFalse(os.path.isdir(quantized_path(self.index_dir, "quantized_collection")), "Expected the stale quantized index to be removed")
+
+    def test_reopened_index_filters_by_department(self):
+        vector_store.create_vector_store(self.docs, "quantized_collection", k_pre=4, persist_directory=self.index_dir, hybrid=True, quantized=True)
+        reopened = vector_store.open_vector_store(self.index_dir, "quantized_collection", k_pre=4)
+        self.assertIsInstance(reopened.vectorstore, QuantizedVectorStore)
+
+        sports = DepartmentRetriever(base_retriever=reopened).for_department("DP Sports")
+        query = "street style rule"
+        results = search_by_vector(sports, query, self.embeddings.embed_query(query))
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(doc.metadata["guide"] in guides_for("DP Sports") for doc in results))
+
+    def test_search_leaves_query_vector_unchanged(self):
+        quantized = vector_store.create_vector_store(self.docs, "quantized_collection", persist_directory=self.index_dir, quantized=True)
+        vector = np.array(self.embeddings.embed_query("sports rule3"), dtype=np.float32) * 3
+        before = vector.copy()
+        quantized.vectorstore._collection.search(vector, k=2)
+        np.testing.assert_array_equal(vector, before)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
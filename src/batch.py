@@ -0,0 +1,272 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from langchain_core.documents import Document
+from langchain_core.runnables import Runnable
+from metrics import REGISTRY, log_event, trace
+from prompt import article_text, editor_question
+from rate_limit import RateLimiter
+from collections import deque
+from dotenv import load_dotenv
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+import argparse, csv, json, logging, os, re, sys, time
+
+"""
+Bulk slug and tag generation, e.g. for the nightly run over archived and wire articles.
+
+Reads (dept, title, content) rows from a JSONL or CSV file and answers them in batches: the questions of a batch are
+embedded in one call and every collection is searched once for the whole batch. The LLM calls are sent concurrently
+under a rate limit while the next batch is retrieved. Results are written as one JSON line per article, in input
+order, as soon as they are ready; a rerun with the same output file resumes after the last row written.
+
+Usage (from the project root):
+    python src/batch.py articles.jsonl results.jsonl [--batch-size 32] [--concurrency 4] [--requests-per-minute 50]
+"""
+
+# Asked for every article that has no "question" of its own
+DEFAULT_QUESTION: str = "Suggest a URL slug and tags for this article, and improvements to its title."
+
+INPUT_FIELDS: Tuple[str, ...] = ("dept", "title", "content")
+
+
+def iter_articles(input_path: str) -> Iterator[Dict[str, str]]:
+    """
+    Reads the articles of a batch file. JSONL files have one object per line, CSV files a header row.
+    Both need dept, title and content; optional fields are question (the editor's question) and id (copied to the output).
+
+    Args:
+        input_path (str): Path to a .jsonl or .csv file.
+
+    Yields:
+        Dict[str, str]: One article, with dept, title, content and question.
+
+    Raises:
+        ValueError: If an article lacks one of dept, title or content.
+    """
+    def article(fields: Dict[str, Any], line: int) -> Dict[str, str]:
+        fields = {str(key).strip().lower(): value for key, value in fields.items() if key is not None}
+        missing = [field for field in INPUT_FIELDS if field not in fields]
+        if missing:
+            raise ValueError(f"{input_path}:{line} has no {', '.join(missing)}")
+        result = {field: str(fields[field] or "").strip() for field in INPUT_FIELDS}
+        result["question"] = str(fields.get("question") or "").strip() or DEFAULT_QUESTION
+        if fields.get("id") not in (None, ""):
+            result["id"] = str(fields["id"])
+        return result
+
+    with open(input_path, 'r', encoding='utf-8', newline='') as file:
+        if input_path.lower().endswith(".csv"):
+            for line, row in enumerate(csv.DictReader(file), start=2):
+                yield article(row, line)
+        else:
+            for line, text in enumerate(file, start=1):
+                if text.strip():
+                    yield article(json.loads(text), line)
+
+
+def parse_response(response: str) -> Dict[str, Any]:
+    """
+    Extracts the suggested URL slug and tags from a response in the format the prompt asks for.
+
+    Args:
+        response (str): The LLM response.
+
+    Returns:
+        Dict[str, Any]: {"slug": str, "tags": List[str]}, empty if the response doesn't have them.
+    """
+    slug = re.search(r"URL SLUG:\s*\n\s*(?:\[)?([a-z0-9][a-z0-9-]*)", response, re.IGNORECASE)
+    tags = re.search(r"Suggested TAGS:[ \t]*\[?([^\n\]]*)", response, re.IGNORECASE)
+    return {
+        "slug": slug.group(1).lower() if slug else "",
+        "tags": [tag.strip() for tag in tags.group(1).split(",") if tag.strip()] if tags else [],
+    }
+
+
+def completed_rows(output_path: str) -> int:
+    """
+    Counts the rows already written to an output file. A last line cut off by a crash is removed, so it is answered again.
+
+    Args:
+        output_path (str): The JSONL output of an earlier run.
+
+    Returns:
+        int: Number of complete rows, the row to resume from.
+    """
+    if not os.path.exists(output_path):
+        return 0
+    rows, valid_bytes = 0, 0
+    with open(output_path, 'rb') as file:
+        for line in file:
+            try:
+                json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            rows += 1
+            valid_bytes += len(line)
+    if valid_bytes < os.path.getsize(output_path):
+        with open(output_path, 'r+b') as file:
+            file.truncate(valid_bytes)
+    return rows
+
+
+def _batched(items: Iterable[Any], batch_size: int) -> Iterator[List[Any]]:
+    batch: List[Any] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_batch(articles: Iterable[Dict[str, str]], output_path: str,
+              retrieve_batch: Callable[[List[Dict[str, str]]], List[Dict[str, List[Document]]]], generate: Runnable,
+              batch_size: int = 32, max_concurrency: int = 4, requests_per_minute: float = 50, retries: int = 3) -> Dict[str, float]:
+    """
+    Answers every article and appends the results to output_path in input order. Rows already in output_path are skipped.
+
+    Args:
+        articles (Iterable[Dict[str, str]]): The articles, e.g. from iter_articles.
+        output_path (str): JSONL file the results are appended to.
+        retrieve_batch (Callable): Returns the retrieved documents for a list of {"question": ..., "dept": ..., "article": ..., "editor_question": ...}, see
+            retriever.create_multi_retriever.
+        generate (Runnable): Takes the documents plus the question and returns the response, see chain.create_generation_chain.
+        batch_size (int): Articles retrieved together.
+        max_concurrency (int): Maximum number of LLM calls in flight.
+        requests_per_minute (float): Maximum request rate to the LLM.
+        retries (int): Attempts per article before the run stops.
+
+    Returns:
+        Dict[str, float]: Rows skipped (resumed), rows written, seconds and articles per minute.
+
+    Raises:
+        RuntimeError: If an article failed after all retries. Every row before it is written, a rerun resumes from it.
+    """
+    skipped: int = completed_rows(output_path)
+    log_event("batch_started", output_path=output_path, resume_from=skipped)
+    limiter = RateLimiter(requests_per_minute, burst=max_concurrency)
+    started: float = time.perf_counter()
+    written: int = 0
+
+    def answer(row: int, article: Dict[str, str], question: str, contexts: Dict[str, List[Document]]) -> str:
+        with trace("batch_article", row=row, dept=article["dept"]):
+            for attempt in range(retries):
+                limiter.acquire()
+                try:
+                    return generate.invoke({**contexts, "question": question})
+                except Exception as e:
+                    if attempt == retries - 1:
+                        raise
+                    log_event("batch_retry", level=logging.WARNING, row=row, error=repr(e))
+                    time.sleep(2 ** attempt)
+
+    rows = ((row, article) for row, article in enumerate(articles) if row >= skipped)
+    pending: Deque[Tuple[int, Dict[str, str], Future]] = deque()
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+
+    with open(output_path, 'a', encoding='utf-8') as output, ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="batch") as pool:
+        def write_next() -> None:
+            nonlocal written
+            row, article, future = pending.popleft()
+            try:
+                response: str = future.result()
+            except Exception as e:
+                for _, _, later in pending:
+                    later.cancel()
+                log_event("batch_failed", level=logging.ERROR, row=row, error=repr(e))
+                raise RuntimeError(f"Row {row} failed after {retries} attempts ({e}), rerun to resume from it") from e
+            result = {"row": row, **({"id": article["id"]} if "id" in article else {}), "dept": article["dept"],
+                      "title": article["title"], **parse_response(response), "response": response}
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            written += 1
+            REGISTRY.increment("batch_rows")
+
+        for batch in _batched(rows, batch_size):
+            questions: List[str] = [editor_question(article["dept"], article["title"], article["content"], article["question"])
+                                    for _, article in batch]
+            with trace("batch_retrieval", rows=len(batch)):
+                contexts: List[Dict[str, List[Document]]] = retrieve_batch(
+                    [{"question": question, "dept": article["dept"], "article": article_text(article["title"], article["content"]),
+                      "editor_question": article["question"]}
+                     for question, (_, article) in zip(questions, batch)])
+            for (row, article), question, documents in zip(batch, questions, contexts):
+                pending.append((row, article, pool.submit(answer, row, article, question, documents)))
+            # The next batch is retrieved while this one is answered, older rows are written as they finish
+            while len(pending) > batch_size:
+                write_next()
+        while pending:
+            write_next()
+
+    seconds: float = time.perf_counter() - started
+    stats = {
+        "skipped": skipped,
+        "written": written,
+        "seconds": round(seconds, 2),
+        "articles_per_minute": round(written / seconds * 60, 1) if seconds else 0.0,
+    }
+    log_event("batch_finished", **stats)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Suggest URL slugs and tags for a file of articles.")
+    parser.add_argument("input", help="JSONL or CSV file with dept, title and content (optional: question, id).")
+    parser.add_argument("output", help="JSONL file the results are appended to. Rerunning with the same file resumes.")
+    parser.add_argument("--batch-size", type=int, default=32, help="Articles retrieved together (default: 32).")
+    parser.add_argument("--concurrency", type=int, default=4, help="LLM calls in flight (default: 4).")
+    parser.add_argument("--requests-per-minute", type=float, default=None, help="LLM rate limit (default: BATCH_REQUESTS_PER_MINUTE env or 50).")
+    args = parser.parse_args()
+
+    load_dotenv()
+    api_key = os.getenv('ANTHROPIC_API_KEY')
+    model_name = os.getenv('LLM_MODEL_NAME')
+    if not api_key or not model_name:
+        print("VALIDATION ERROR: Please provide an API key and model name in env file")
+        sys.exit(1)
+    if not os.path.isfile(args.input):
+        print(f"VALIDATION ERROR: {args.input} does not exist")
+        sys.exit(1)
+
+    from ingest import open_snapshot
+    from snapshot import latest_snapshot
+    from vector_store import get_embeddings, nomic_login
+    from retriever import create_multi_retriever
+    from chain import create_generation_chain
+    from context import load_pinned_pages, parse_budgets
+
+    try:
+        nomic_login()
+    except EnvironmentError as e:
+        print(f"VALIDATION ERROR: {e}")
+        sys.exit(1)
+    snapshot_path: Optional[str] = latest_snapshot(os.getenv('SNAPSHOT_DIR', 'snapshots'))
+    if not snapshot_path:
+        print("VALIDATION ERROR: No index snapshot found, run src/ingest.py first")
+        sys.exit(1)
+
+    retrievers = open_snapshot(snapshot_path)
+    multi_retriever = create_multi_retriever(
+        {"context": retrievers["csv_collection"], "context1": retrievers["url_collection"],
+         "context2": retrievers["pdf_collection"], "context3": retrievers["tag_collection"]},
+        get_embeddings(),
+    )
+    generate = create_generation_chain(api_key, model_name, context_budgets=parse_budgets(os.getenv('CONTEXT_BUDGETS')),
+                                       pinned_context=load_pinned_pages(os.getenv('PINNED_STYLE_PAGES', '')) or None)
+    requests_per_minute: float = args.requests_per_minute or float(os.getenv('BATCH_REQUESTS_PER_MINUTE', 50))
+
+    try:
+        stats = run_batch(iter_articles(args.input), args.output, multi_retriever.retrieve_batch, generate,
+                          batch_size=args.batch_size, max_concurrency=args.concurrency, requests_per_minute=requests_per_minute)
+    except ValueError as e:
+        print(f"VALIDATION ERROR: {e}")
+        sys.exit(1)
+    except RuntimeError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    print(f"Wrote {stats['written']} rows ({stats['skipped']} done earlier) at {stats['articles_per_minute']} articles per minute ✅")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,695 @@
+from typing import Any, Callable, Dict, List
+from datetime import datetime, timezone
+from functools import partial
+import argparse, asyncio, csv, json, logging, os, platform, random, re, shutil, subprocess, sys, tempfile, time
+import numpy as np
+
+"""
+Throughput benchmarks for the offline pipelines. Run from the src directory, e.g.:
+
+    python benchmark.py tags --tags 5000000
+    python benchmark.py suite --scales 1,10 --output ../benchmarks/report.json --baseline ../benchmarks/main.json
+    python benchmark.py startup --output ../benchmarks/startup.json
+    python benchmark.py vectors --vectors 100000
+    python benchmark.py serve --workers 1,2,4
+
+The suite runs without keys or network: embeddings are stubs.HashEmbeddings and the LLM is stubs.StubChatModel.
+It times load_pdf, load_csv, recursive_splitter, create_vector_store and chain.invoke at multiples of the corpus size
+and writes a JSON report. Given a baseline report it lists the benchmarks that got slower.
+"""
+
+# The corpus paths in sources.py are relative to the project root
+PROJECT_ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Rows of the articles CSV (files/organic_search.csv) at 1x
+CSV_ROWS: int = 1573
+
+WORDS = ["football", "wharton", "provost", "dining", "basketball", "admissions", "protest", "art", "music", "research",
+         "housing", "election", "philadelphia", "startup", "review", "guide", "coach", "senate", "library", "fling"]
+
+# Departments of the editor form, as chosen in the UI
+DEPARTMENTS: List[str] = ["Under the Button", "34th Street", "DP Sports", "DP General"]
+
+
+def write_synthetic_tag_export(path: str, n_tags: int, seed: int = 0) -> None:
+    """
+    Writes a tag export in the CMS format (['tag1', 'tag2', ...]) with the quirks of the real one:
+    duplicates in different case and spacing, dates, single letters, empty tags and unicode.
+
+    Args:
+        path (str): The file to write.
+        n_tags (int): Number of tags in the export.
+        seed (int): Random seed, the same seed gives the same file.
+    """
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write("[")
+        for start in range(0, n_tags, 100_000):
+            tags = []
+            for _ in range(min(100_000, n_tags - start)):
+                kind = rng.random()
+                if kind < 0.05:
+                    tags.append(f"{rng.randint(1, 12)}.{rng.randint(1, 31)}.20{rng.randint(10, 24)}")
+                elif kind < 0.07:
+                    tags.append(rng.choice(["", "a", "x"]))
+                else:
+                    words = rng.choices(WORDS, k=rng.randint(1, 3))
+                    if kind < 0.2:
+                        words = [word.upper() for word in words]
+                    elif kind < 0.22:
+                        words.append("café")
+                    tags.append(("  " if kind < 0.3 else " ").join(words) + str(rng.randint(0, 5000)))
+            file.write(", ".join(f"'{tag}'" for tag in tags))
+            file.write(", " if start + 100_000 < n_tags else "]")
+
+
+def bench_tags(n_tags: int, batch_size: int = 10_000) -> Dict[str, float]:
+    """
+    Times the streaming tag pipeline (parse, clean, normalize, dedupe, write) on a synthetic export.
+
+    Args:
+        n_tags (int): Number of tags in the synthetic export.
+        batch_size (int): Number of tags cleaned and deduplicated at once.
+
+    Returns:
+        Dict[str, float]: Input size, unique tags written, elapsed seconds, throughput and peak memory.
+    """
+    # Unix only, imported here so the rest of the module (and the tests that use it) also load on Windows
+    import resource
+    from tag_cleaner import iter_extract_tags, write_unique_tags
+
+    folder = tempfile.mkdtemp()
+    export_path = os.path.join(folder, "tags.txt")
+    write_synthetic_tag_export(export_path, n_tags)
+
+    start = time.perf_counter()
+    written = write_unique_tags(iter_extract_tags(export_path, batch_size=batch_size), os.path.join(folder, "final_tags.txt"))
+    elapsed = time.perf_counter() - start
+    return {
+        "tags": n_tags,
+        "file_mb": os.path.getsize(export_path) / 1e6,
+        "unique_tags": written,
+        "seconds": elapsed,
+        "tags_per_second": n_tags / elapsed,
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def write_synthetic_articles_csv(path: str, n_rows: int, seed: int = 0) -> None:
+    """
+    Writes an articles CSV shaped like the search analytics export: one row per article with its URL, title and traffic.
+
+    Args:
+        path (str): The file to write.
+        n_rows (int): Number of articles.
+        seed (int): Random seed, the same seed gives the same file.
+    """
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["Page", "Title", "Section", "Published", "Clicks", "Impressions", "CTR", "Position"])
+        for i in range(n_rows):
+            words = rng.choices(WORDS, k=rng.randint(4, 9))
+            clicks, impressions = rng.randint(0, 5000), rng.randint(5000, 200_000)
+            writer.writerow([
+                f"https://www.thedp.com/article/20{rng.randint(10, 24)}/{rng.randint(1, 12):02d}/{'-'.join(words)}-{i}",
+                " ".join(words).capitalize(), rng.choice(["news", "sports", "opinion", "arts"]),
+                f"20{rng.randint(10, 24)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                clicks, impressions, f"{clicks / impressions:.2%}", f"{rng.uniform(1, 40):.1f}",
+            ])
+
+
+def copy_pdfs(folder: str, scale: int) -> List[str]:
+    """
+    Copies the style guides `scale` times into numbered folders, so load_pdf parses scale x the pages.
+    The file names are kept, they name the guide of every chunk (sources.guide_name).
+    """
+    from sources import PDF_LIST
+
+    paths: List[str] = []
+    for copy in range(scale):
+        os.makedirs(os.path.join(folder, str(copy)), exist_ok=True)
+        for pdf in PDF_LIST:
+            path = os.path.join(folder, str(copy), os.path.basename(pdf))
+            shutil.copyfile(os.path.join(PROJECT_ROOT, pdf), path)
+            paths.append(path)
+    return paths
+
+
+def _timed(func: Callable[[], Any]) -> Any:
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def _throughput(items: int, seconds: float, unit: str) -> Dict[str, float]:
+    return {"items": items, "seconds": round(seconds, 4), f"{unit}_per_second": round(items / seconds, 1) if seconds else 0.0}
+
+
+def bench_corpus(scale: int, queries: int = 20, first_token_delay: float = 0.0, token_delay: float = 0.0) -> Dict[str, Dict[str, float]]:
+    """
+    Times every ingestion step and the full chain on the corpus multiplied by scale, with stub embeddings and LLM.
+    PDFs are parsed without the page cache. URL pages need the network, so the PDF collection stands in for them.
+
+    Args:
+        scale (int): Corpus size as a multiple of the real one (CSV rows and style guide copies).
+        queries (int): Number of chain.invoke calls timed.
+        first_token_delay (float): Seconds the stub LLM waits before its first token.
+        token_delay (float): Seconds the stub LLM waits between tokens.
+
+    Returns:
+        Dict[str, Dict[str, float]]: Results of each benchmark.
+    """
+    from data_loader import load_csv, load_pdf
+    from text_splitter import recursive_splitter
+    from vector_store import create_vector_store, document_id
+    from dedup import Deduplicator
+    from tag_index import TagIndex
+    from article_index import ArticleIndex
+    from chain import create_chain, create_generation_chain
+    from retriever import DepartmentRetriever, create_multi_retriever
+    from ingest import with_guides
+    from batch import DEFAULT_QUESTION, run_batch
+    from sources import TAG_PATH
+    from stubs import HashEmbeddings, StubChatModel
+
+    folder = tempfile.mkdtemp()
+    os.environ['PDF_CACHE_DIR'] = os.path.join(folder, "pdf_cache")
+    csv_path = os.path.join(folder, "articles.csv")
+    write_synthetic_articles_csv(csv_path, CSV_ROWS * scale)
+    pdf_paths = copy_pdfs(folder, scale)
+    embeddings = HashEmbeddings()
+    results: Dict[str, Dict[str, float]] = {}
+
+    try:
+        pages, seconds = _timed(lambda: load_pdf(pdf_paths))
+        results["load_pdf"] = _throughput(len(pages), seconds, "pages")
+        rows, seconds = _timed(lambda: load_csv(csv_path))
+        results["load_csv"] = _throughput(len(rows), seconds, "rows")
+        article_index, seconds = _timed(lambda: ArticleIndex.from_csv(csv_path))
+        results["article_index"] = _throughput(CSV_ROWS * scale, seconds, "rows")
+
+        pdf_chunks, pdf_seconds = _timed(lambda: recursive_splitter(list(with_guides(pages))))
+        csv_chunks, csv_seconds = _timed(lambda: recursive_splitter(rows))
+        results["recursive_splitter"] = _throughput(len(pages) + len(rows), pdf_seconds + csv_seconds, "documents")
+        results["recursive_splitter"]["chunks"] = len(pdf_chunks) + len(csv_chunks)
+
+        # The guide copies repeat each other, so all but one copy of every chunk is dropped
+        dedup = Deduplicator()
+        kept, seconds = _timed(lambda: list(dedup.filter(pdf_chunks, document_id)))
+        results["dedup"] = _throughput(len(pdf_chunks), seconds, "chunks")
+        results["dedup"]["removed_ratio"] = round(dedup.removed / len(pdf_chunks), 4) if pdf_chunks else 0.0
+
+        # Collection names are unique per run, in-memory Chroma collections live as long as the process
+        run = f"bench_{scale}x_{os.path.basename(folder)}"
+        csv_retriever, csv_seconds = _timed(lambda: create_vector_store(csv_chunks, f"{run}_csv", hybrid=True, embeddings=embeddings))
+        pdf_retriever, pdf_seconds = _timed(lambda: create_vector_store(pdf_chunks, f"{run}_pdf", hybrid=True, embeddings=embeddings))
+        results["create_vector_store"] = _throughput(len(csv_chunks) + len(pdf_chunks), csv_seconds + pdf_seconds, "chunks")
+
+        tag_retriever = TagIndex.load_or_build(os.path.join(PROJECT_ROOT, TAG_PATH), embeddings, "hash", index_dir=os.path.join(folder, "tags")).as_retriever()
+        # The chain reads the CSV through the article index like the app, csv_retriever only times the --csv-as-vectors path
+        guide_retriever = DepartmentRetriever(base_retriever=pdf_retriever)
+        chain = create_chain(article_index.as_retriever(), pdf_retriever, guide_retriever, tag_retriever, api_key="", model_name="stub",
+                             embeddings=embeddings, llm=StubChatModel(first_token_delay=first_token_delay, token_delay=token_delay))
+        rng = random.Random(scale)
+        latencies: List[float] = []
+        for _ in range(queries):
+            question = f"How should I title an article about {' '.join(rng.choices(WORDS, k=3))}?"
+            dept = rng.choice(DEPARTMENTS)
+            latencies.append(_timed(lambda: chain.invoke({"question": question, "dept": dept}))[1])
+        results["chain_invoke"] = {
+            "queries": queries,
+            "mean_ms": round(float(np.mean(latencies)) * 1000, 2),
+            "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+            "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+        }
+
+        # The same number of articles through batch.py: batched retrieval and concurrent LLM calls
+        multi_retriever = create_multi_retriever({"context": article_index.as_retriever(), "context1": pdf_retriever,
+                                                  "context2": guide_retriever, "context3": tag_retriever}, embeddings)
+        generate = create_generation_chain("", "stub", llm=StubChatModel(first_token_delay=first_token_delay, token_delay=token_delay))
+        articles = [{"dept": rng.choice(DEPARTMENTS), "title": f"Penn {' '.join(rng.choices(WORDS, k=3))}", "content": " ".join(rng.choices(WORDS, k=200)),
+                     "question": DEFAULT_QUESTION} for _ in range(queries)]
+        stats = run_batch(articles, os.path.join(folder, "batch.jsonl"), multi_retriever.retrieve_batch, generate, requests_per_minute=1e6)
+        results["batch"] = _throughput(stats["written"], stats["seconds"], "articles")
+        results["batch"]["articles_per_minute"] = stats["articles_per_minute"]
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def run_suite(scales: List[int], queries: int = 20, first_token_delay: float = 0.0, token_delay: float = 0.0) -> Dict[str, Any]:
+    """
+    Runs bench_corpus at every scale and returns the report.
+
+    Args:
+        scales (List[int]): Corpus multiples, e.g. [1, 10, 100].
+        queries (int): Number of chain.invoke calls timed per scale.
+        first_token_delay (float): Seconds the stub LLM waits before its first token.
+        token_delay (float): Seconds the stub LLM waits between tokens.
+
+    Returns:
+        Dict[str, Any]: The machine, the commit and the results by benchmark and scale ({"load_pdf": {"1x": {...}}, ...}).
+    """
+    from metrics import get_logger
+
+    # The chain logs every retrieval, which would drown the benchmark output
+    get_logger().setLevel(logging.WARNING)
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for scale in scales:
+        for name, result in bench_corpus(scale, queries, first_token_delay, token_delay).items():
+            results.setdefault(name, {})[f"{scale}x"] = result
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "commit": commit or None,
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "settings": {"queries": queries, "first_token_delay": first_token_delay, "token_delay": token_delay},
+        "results": results,
+    }
+
+
+def compare_reports(baseline: Dict[str, Any], report: Dict[str, Any], tolerance: float = 0.1) -> List[str]:
+    """
+    Lists the benchmarks that are slower than in the baseline report by more than the tolerance.
+    Throughput benchmarks are compared by seconds, chain_invoke by p50_ms.
+
+    Args:
+        baseline (Dict[str, Any]): An earlier report, e.g. from the main branch.
+        report (Dict[str, Any]): The new report.
+        tolerance (float): Allowed slowdown, 0.1 = 10%.
+
+    Returns:
+        List[str]: One line per regression, e.g. "create_vector_store 10x: 12.10s -> 15.30s (+26%)". Empty if none.
+    """
+    regressions: List[str] = []
+    for name, scales in report["results"].items():
+        for scale, result in scales.items():
+            old = baseline.get("results", {}).get(name, {}).get(scale)
+            if not old:
+                continue
+            key, unit = ("p50_ms", "ms") if "p50_ms" in result else ("seconds", "s")
+            if old[key] and result[key] > old[key] * (1 + tolerance):
+                regressions.append(f"{name} {scale}: {old[key]:.2f}{unit} -> {result[key]:.2f}{unit} ({result[key] / old[key] - 1:+.0%})")
+    return regressions
+
+
+def write_synthetic_vectors(n_vectors: int, dim: int, n_queries: int, seed: int = 0) -> Any:
+    """
+    Returns clustered unit vectors that look like document embeddings (topics plus noise), and queries near them.
+    """
+    rng = np.random.RandomState(seed)
+    topics = rng.randn(max(10, n_vectors // 200), dim).astype(np.float32)
+    vectors = topics[rng.randint(0, len(topics), n_vectors)] + 0.6 * rng.randn(n_vectors, dim).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = vectors[rng.randint(0, n_vectors, n_queries)] + 0.3 * rng.randn(n_queries, dim).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return vectors, queries
+
+
+# Runs in a fresh interpreter: opens one backend, runs the queries and prints the resident memory it added and the hits.
+# Heap memory (RssAnon) is what the index costs; memory-mapped file pages (RssFile) are page cache the OS can drop.
+OPEN_AND_QUERY = """
+import json, os, sys, time
+import numpy as np
+def rss():
+    fields = dict(line.split(':', 1) for line in open('/proc/self/status') if line.startswith('Rss'))
+    return np.array([int(fields['RssAnon'].split()[0]), int(fields['RssFile'].split()[0])]) / 1024
+backend, path, k, nprobe = sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4])
+queries = np.load(os.path.join(path, 'queries.npy'))
+import chromadb
+from quantized_store import QuantizedVectorStore
+before = rss()
+if backend == 'chroma':
+    collection = chromadb.PersistentClient(path=os.path.join(path, 'chroma')).get_collection('bench_vectors')
+    search = lambda query: collection.query(query_embeddings=[query.tolist()], n_results=k, include=[])['ids'][0]
+else:
+    collection = QuantizedVectorStore.load(os.path.join(path, 'bench_vectors.quantized'), nprobe=nprobe)._collection
+    search = lambda query: [collection.document(row)[0] for row, _ in collection.search(query, k)]
+latencies, hits = [], []
+for query in queries:
+    start = time.perf_counter()
+    hits.append(search(query))
+    latencies.append(time.perf_counter() - start)
+anon, file = rss() - before
+print(json.dumps({'heap_mb': anon, 'mapped_mb': file, 'latencies': latencies, 'hits': hits}))
+"""
+
+
+def bench_vectors(n_vectors: int, dim: int = 768, queries: int = 200, k: int = 10, nprobes: List[int] = [4, 16, 64]) -> Dict[str, Dict[str, float]]:
+    """
+    Compares the Chroma collection with the quantized index (quantized_store.py) on synthetic embeddings: build time,
+    size on disk, memory added by opening and querying it (in a fresh process, heap and memory-mapped file pages),
+    query latency and recall@k against exact search. The quantized index is measured at several nprobe settings.
+
+    Args:
+        n_vectors (int): Number of vectors in the collection.
+        dim (int): Dimensions (Nomic's is 768).
+        queries (int): Number of queries timed.
+        k (int): Results per query.
+        nprobes (List[int]): Clusters scanned per query.
+
+    Returns:
+        Dict[str, Dict[str, float]]: Results of Chroma and of the quantized index at each nprobe.
+    """
+    import chromadb
+    from langchain_chroma import Chroma
+    from quantized_store import build_quantized_store
+
+    folder = tempfile.mkdtemp()
+    vectors, query_vectors = write_synthetic_vectors(n_vectors, dim, queries)
+    np.save(os.path.join(folder, "queries.npy"), query_vectors)
+    # Exact top k by brute force, in blocks of queries
+    truth: List[set] = [set(f"v{i}" for i in np.argsort(-(query_vectors[i:i+64] @ vectors.T), axis=1)[row, :k])
+                        for i in range(0, queries, 64) for row in range(len(query_vectors[i:i+64]))]
+
+    def add_to_chroma() -> Chroma:
+        vectorstore = Chroma(collection_name="bench_vectors", persist_directory=os.path.join(folder, "chroma"))
+        batch_size = vectorstore._client.get_max_batch_size()
+        for i in range(0, n_vectors, batch_size):
+            end = min(i + batch_size, n_vectors)
+            vectorstore._collection.add(ids=[f"v{j}" for j in range(i, end)], embeddings=vectors[i:end].tolist(),
+                                        documents=[f"document {j}" for j in range(i, end)])
+        return vectorstore
+
+    def disk_mb(path: str) -> float:
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names) / 1e6
+
+    def measure(backend: str, nprobe: int = 0) -> Dict[str, float]:
+        process = subprocess.run([sys.executable, "-c", OPEN_AND_QUERY, backend, folder, str(k), str(nprobe)],
+                                 cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        latencies = result["latencies"]
+        return {
+            "heap_mb": round(result["heap_mb"], 1),
+            "mapped_mb": round(result["mapped_mb"], 1),
+            "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+            "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 3),
+            f"recall_at_{k}": round(float(np.mean([len(set(hits) & expected) / k for hits, expected in zip(result["hits"], truth)])), 4),
+        }
+
+    results: Dict[str, Dict[str, float]] = {}
+    try:
+        vectorstore, seconds = _timed(add_to_chroma)
+        results["chroma"] = {"build_seconds": round(seconds, 2), "disk_mb": round(disk_mb(os.path.join(folder, "chroma")), 1), **measure("chroma")}
+        path = os.path.join(folder, "bench_vectors.quantized")
+        # Bound with partial, not a closure, so the del below really releases the Chroma client
+        meta, seconds = _timed(partial(build_quantized_store, vectorstore, path))
+        for nprobe in nprobes:
+            results[f"quantized_nprobe_{nprobe}"] = {"build_seconds": round(seconds, 2), "disk_mb": round(disk_mb(path), 1),
+                                                     "nlist": meta["nlist"], **measure("quantized", nprobe)}
+        del vectorstore
+    finally:
+        chromadb.api.client.SharedSystemClient.clear_system_cache()
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def stub_engine(warmup: Any) -> Any:
+    """
+    Engine for serve.py without keys or network, used by the load test (SERVE_ENGINE=benchmark:stub_engine): the article
+    index of a synthetic CSV, a small in-memory style guide collection, the tag index, stubs.HashEmbeddings and
+    stubs.StubChatModel with the delays in STUB_FIRST_TOKEN_MS and STUB_TOKEN_MS. The response cache and the coalescer
+    use RESPONSE_CACHE_PATH like the real engine.
+
+    Each request can also hold its worker before the chain runs: STUB_CPU_MS of busy work, which only more cores can
+    spread, and STUB_BLOCKING_MS of synchronous waiting on the event loop, which stands for the part of a request a
+    single worker serializes without using the CPU and which more workers overlap even on one core.
+    """
+    from app import Engine
+    from article_index import ArticleIndex
+    from chain import create_chain
+    from coalesce import RequestCoalescer
+    from response_cache import ResponseCache
+    from retriever import DepartmentRetriever
+    from sources import TAG_PATH, guide_name
+    from stubs import HashEmbeddings, StubChatModel
+    from tag_index import TagIndex
+    from vector_store import create_vector_store
+    from langchain_core.documents import Document
+    from langchain_core.runnables import RunnableLambda
+
+    warmup.set_step("building the stub index")
+    folder = tempfile.mkdtemp()
+    embeddings = HashEmbeddings()
+    csv_path = os.path.join(folder, "articles.csv")
+    write_synthetic_articles_csv(csv_path, CSV_ROWS)
+    rng = random.Random(0)
+    guides = [guide_name(pdf) for pdf in ["All_Style.pdf", "DEI_Style.pdf", "34_Style.pdf", "Sports_Style.pdf"]]
+    chunks = [Document(page_content=" ".join(rng.choices(WORDS, k=120)), metadata={"guide": guides[i % len(guides)], "page": i})
+              for i in range(400)]
+    guide_retriever = create_vector_store(chunks, f"stub_{os.getpid()}", embeddings=embeddings, hybrid=True)
+    tag_retriever = TagIndex.load_or_build(os.path.join(PROJECT_ROOT, TAG_PATH), embeddings, "hash", index_dir=os.path.join(folder, "tags")).as_retriever()
+
+    llm = StubChatModel(first_token_delay=float(os.getenv('STUB_FIRST_TOKEN_MS', 0)) / 1000, token_delay=float(os.getenv('STUB_TOKEN_MS', 0)) / 1000)
+    chain = create_chain(ArticleIndex.from_csv(csv_path).as_retriever(), guide_retriever, DepartmentRetriever(base_retriever=guide_retriever),
+                         tag_retriever, api_key="", model_name="stub", embeddings=embeddings, llm=llm)
+    cpu_seconds = float(os.getenv('STUB_CPU_MS', 0)) / 1000
+    blocking_seconds = float(os.getenv('STUB_BLOCKING_MS', 0)) / 1000
+
+    def hold(inputs: Dict[str, Any]) -> Dict[str, Any]:
+        end = time.process_time() + cpu_seconds
+        while time.process_time() < end:
+            pass
+        time.sleep(blocking_seconds)
+        return inputs
+
+    async def hold_worker(inputs: Dict[str, Any]) -> Dict[str, Any]:
+        # runs on the event loop on purpose, a worker serves nothing else while it holds
+        return hold(inputs)
+
+    if cpu_seconds or blocking_seconds:
+        chain = RunnableLambda(hold, afunc=hold_worker) | chain
+    response_cache = ResponseCache(embeddings=embeddings, index_version="stub", path=os.getenv('RESPONSE_CACHE_PATH'))
+    return Engine(chain, response_cache, RequestCoalescer(path=os.getenv('RESPONSE_CACHE_PATH')))
+
+
+def bench_serving(workers: int, requests: int = 200, concurrency: int = 32, identical: int = 20,
+                  first_token_ms: float = 300.0, token_ms: float = 2.0, cpu_ms: float = 0.0, blocking_ms: float = 0.0,
+                  timeout: float = 180.0) -> Dict[str, float]:
+    """
+    Load test of serve.py with the stub engine: starts the server with the given number of workers, sends distinct
+    requests with the given concurrency, then a burst of identical requests to check that they are coalesced.
+
+    Args:
+        workers (int): Worker processes of the server.
+        requests (int): Distinct requests of the throughput run.
+        concurrency (int): Requests in flight at once.
+        identical (int): Identical requests sent at once after the throughput run.
+        first_token_ms (float): Delay of the stub LLM before its first token.
+        token_ms (float): Delay of the stub LLM between tokens.
+        cpu_ms (float): Busy CPU work of every request before the chain runs.
+        blocking_ms (float): Time every request blocks its worker's event loop before the chain runs.
+        timeout (float): Seconds to wait for every worker to warm up.
+
+    Returns:
+        Dict[str, float]: Requests per second, latency percentiles, workers that answered, and the LLM calls made for
+            the identical burst (1 when every copy was coalesced or served from the cache).
+    """
+    import httpx, socket
+
+    folder = tempfile.mkdtemp()
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port: int = sock.getsockname()[1]
+    env = {**os.environ, "SERVE_ENGINE": "benchmark:stub_engine", "RESPONSE_CACHE_PATH": os.path.join(folder, "responses.sqlite3"),
+           "STUB_FIRST_TOKEN_MS": str(first_token_ms), "STUB_TOKEN_MS": str(token_ms),
+           "STUB_CPU_MS": str(cpu_ms), "STUB_BLOCKING_MS": str(blocking_ms), "METRICS_LOG_PATH": "", "PDF_CACHE_DIR": os.path.join(folder, "pdf")}
+    server = subprocess.Popen([sys.executable, "serve.py", "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port)],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+
+    async def run() -> Dict[str, float]:
+        async with httpx.AsyncClient(base_url=base, timeout=120) as client:
+            # /health lands on any worker, wait until every one of them reported ready
+            ready, deadline = set(), time.monotonic() + timeout
+            while len(ready) < workers:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise RuntimeError(f"{workers - len(ready)} of {workers} workers not ready after {timeout:.0f}s")
+                try:
+                    # A new connection each time, a kept-alive one always lands on the same worker
+                    health = (await client.get("/health", headers={"Connection": "close"})).json()
+                    if health["ready"]:
+                        ready.add(health["pid"])
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.1)
+
+            limit = asyncio.Semaphore(concurrency)
+
+            async def send(body: Dict[str, str]) -> Dict[str, Any]:
+                async with limit:
+                    start = time.perf_counter()
+                    # A new connection per request too, so a worker that is busy does not keep getting more of them
+                    result = (await client.post("/api/optimize", json=body, headers={"Connection": "close"})).raise_for_status().json()
+                    return {**result, "seconds": time.perf_counter() - start}
+
+            words = random.Random(workers)
+            bodies = [{"dept": words.choice(DEPARTMENTS), "title": " ".join(words.choices(WORDS, k=6)).capitalize(), "content": " ".join(words.choices(WORDS, k=200)),
+                       "question": f"Suggest a slug and tags ({i})"} for i in range(requests)]
+            start = time.perf_counter()
+            results = await asyncio.gather(*(send(body) for body in bodies))
+            elapsed = time.perf_counter() - start
+            latencies = [result["seconds"] for result in results]
+
+            same = {"dept": "DP Sports", "title": "Penn beats Princeton", "content": "Football " * 100, "question": "Suggest a slug"}
+            burst = await asyncio.gather(*(send(same) for _ in range(identical)))
+            return {
+                "workers": workers,
+                "requests": requests,
+                "requests_per_second": round(requests / elapsed, 1),
+                "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 1),
+                "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 1),
+                "workers_answering": len({result["pid"] for result in results}),
+                "identical_requests": identical,
+                "identical_llm_calls": sum(result["source"] == "chain" for result in burst),
+            }
+
+    try:
+        return asyncio.run(run())
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+# What app.py imports before the UI binds its port, and what start_engine imports in the background afterwards
+UI_MODULES: List[str] = ["app", "ui"]
+WARMUP_MODULES: List[str] = ["ingest", "snapshot", "vector_store", "response_cache", "chain", "context", "langchain_nomic", "langchain_anthropic"]
+
+
+def import_profile(ui_modules: List[str] = UI_MODULES, warmup_modules: List[str] = WARMUP_MODULES, top: int = 25) -> Dict[str, Any]:
+    """
+    Measures import time per module with `python -X importtime` in a fresh interpreter, the way app.py imports them:
+    first what is needed to serve the UI, then what the background warm-up needs on top of it.
+
+    Args:
+        ui_modules (List[str]): Modules imported before the port is bound.
+        warmup_modules (List[str]): Modules imported by the warm-up.
+        top (int): Number of slowest modules listed.
+
+    Returns:
+        Dict[str, Any]: Milliseconds before the port is bound and for the warm-up imports, self time per top-level
+            package and the slowest modules by cumulative time (including what they import).
+    """
+    statement = f"import {', '.join(ui_modules)}; import {', '.join(warmup_modules)}"
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True, check=True)
+
+    phases: Dict[str, float] = {"ui": 0.0, "warmup": 0.0}
+    packages: Dict[str, float] = {}
+    modules: List[Dict[str, Any]] = []
+    for line in process.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = int(match[1]), int(match[2]), len(match[3]), match[4]
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0.0) + self_us / 1000
+        modules.append({"module": name, "cumulative_ms": cumulative_us / 1000, "self_ms": self_us / 1000})
+        # A top-level line is printed after everything it imported, modules imported by a UI module count for the UI
+        if indent == 1:
+            phases["ui" if name in ui_modules else "warmup"] += cumulative_us / 1000
+
+    return {
+        "ui_ms": round(phases["ui"], 1),
+        "warmup_ms": round(phases["warmup"], 1),
+        "packages_ms": {name: round(ms, 1) for name, ms in sorted(packages.items(), key=lambda item: -item[1]) if ms >= 1},
+        "slowest_modules": sorted(modules, key=lambda module: -module["cumulative_ms"])[:top],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Throughput benchmarks for the offline pipelines.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    tags_parser = subparsers.add_parser("tags", help="Streaming tag extraction and dedup on a synthetic export.")
+    tags_parser.add_argument("--tags", type=int, default=2_000_000, help="Number of tags in the synthetic export.")
+    tags_parser.add_argument("--batch-size", type=int, default=10_000)
+    suite_parser = subparsers.add_parser("suite", help="Ingestion and chain latency at several corpus sizes, stub embeddings and LLM.")
+    suite_parser.add_argument("--scales", default="1,10,100", help="Corpus multiples, comma separated.")
+    suite_parser.add_argument("--queries", type=int, default=20, help="chain.invoke calls timed per scale.")
+    suite_parser.add_argument("--first-token-ms", type=float, default=0.0, help="Delay of the stub LLM before its first token.")
+    suite_parser.add_argument("--token-ms", type=float, default=0.0, help="Delay of the stub LLM between tokens.")
+    suite_parser.add_argument("--output", default="benchmark_report.json", help="Where to write the JSON report.")
+    suite_parser.add_argument("--baseline", help="Earlier report to compare with, regressions are listed.")
+    suite_parser.add_argument("--tolerance", type=float, default=0.1, help="Slowdown not reported as a regression, 0.1 = 10%%.")
+    vectors_parser = subparsers.add_parser("vectors", help="Chroma against the quantized index: memory, build time, latency and recall.")
+    vectors_parser.add_argument("--vectors", type=int, default=100_000, help="Number of synthetic embeddings.")
+    vectors_parser.add_argument("--dim", type=int, default=768, help="Dimensions of the embeddings.")
+    vectors_parser.add_argument("--queries", type=int, default=200, help="Queries timed per backend.")
+    vectors_parser.add_argument("--k", type=int, default=10, help="Results per query, recall is measured at k.")
+    vectors_parser.add_argument("--nprobes", default="4,16,64", help="Clusters scanned per query by the quantized index, comma separated.")
+    serve_parser = subparsers.add_parser("serve", help="Load test of serve.py with the stub engine at several worker counts.")
+    serve_parser.add_argument("--workers", default="1,2,4", help="Worker counts, comma separated.")
+    serve_parser.add_argument("--requests", type=int, default=200, help="Distinct requests per worker count.")
+    serve_parser.add_argument("--concurrency", type=int, default=32, help="Requests in flight at once.")
+    serve_parser.add_argument("--identical", type=int, default=20, help="Identical requests sent at once to check coalescing.")
+    serve_parser.add_argument("--first-token-ms", type=float, default=300.0, help="Delay of the stub LLM before its first token.")
+    serve_parser.add_argument("--token-ms", type=float, default=2.0, help="Delay of the stub LLM between tokens.")
+    serve_parser.add_argument("--cpu-ms", type=float, default=0.0, help="Busy CPU work of every request, only more cores speed it up.")
+    serve_parser.add_argument("--blocking-ms", type=float, default=0.0,
+                              help="Time every request blocks its worker, more workers overlap it even on one core.")
+    serve_parser.add_argument("--output", help="Also write the results as JSON.")
+    startup_parser = subparsers.add_parser("startup", help="Import time per module before the UI binds its port and during warm-up.")
+    startup_parser.add_argument("--output", help="Also write the report as JSON.")
+    startup_parser.add_argument("--top", type=int, default=25, help="Number of slowest modules listed.")
+    args = parser.parse_args()
+
+    if args.command == "tags":
+        for name, value in bench_tags(args.tags, args.batch_size).items():
+            print(f"{name}: {value:,.2f}" if isinstance(value, float) else f"{name}: {value:,}")
+
+    elif args.command == "suite":
+        report = run_suite([int(scale) for scale in args.scales.split(",")], args.queries, args.first_token_ms / 1000, args.token_ms / 1000)
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        for name, scales in report["results"].items():
+            for scale, result in scales.items():
+                print(f"{name:<20} {scale:>5}  " + "  ".join(f"{key}={value:,}" for key, value in result.items()))
+        print(f"Report written to {args.output}")
+
+        if args.baseline:
+            with open(args.baseline, 'r', encoding='utf-8') as file:
+                regressions = compare_reports(json.load(file), report, args.tolerance)
+            print("\n".join(["Regressions:"] + regressions) if regressions else "No regressions against the baseline")
+
+    elif args.command == "vectors":
+        results = bench_vectors(args.vectors, args.dim, args.queries, args.k, [int(nprobe) for nprobe in args.nprobes.split(",")])
+        for name, result in results.items():
+            print(f"{name:<22} " + "  ".join(f"{key}={value:,}" for key, value in result.items()))
+
+    elif args.command == "serve":
+        results = [bench_serving(int(workers), args.requests, args.concurrency, args.identical, args.first_token_ms, args.token_ms,
+                                 args.cpu_ms, args.blocking_ms)
+                   for workers in args.workers.split(",")]
+        for result in results:
+            print("  ".join(f"{key}={value:,}" for key, value in result.items()))
+        if args.output:
+            os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+            with open(args.output, 'w', encoding='utf-8') as file:
+                json.dump({"machine": {"cpus": os.cpu_count()}, "results": results}, file, indent=2)
+
+    elif args.command == "startup":
+        report = import_profile(top=args.top)
+        print(f"Imports before the UI binds its port: {report['ui_ms']:,.0f} ms")
+        print(f"Imports during background warm-up:    {report['warmup_ms']:,.0f} ms\n")
+        print("Self time by package:")
+        for name, ms in list(report["packages_ms"].items())[:args.top]:
+            print(f"  {name:<40} {ms:>8,.1f} ms")
+        print("\nSlowest modules (cumulative):")
+        for module in report["slowest_modules"]:
+            print(f"  {module['module']:<60} {module['cumulative_ms']:>8,.1f} ms")
+        if args.output:
+            os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+            with open(args.output, 'w', encoding='utf-8') as file:
+                json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+from collections import Counter, defaultdict
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStoreRetriever
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio, math, os, re
+import numpy as np
+
+"""
+Lexical (BM25) index of a collection and the hybrid retriever that fuses it with dense search.
+
+Dense similarity misses chunks that hinge on one exact term ("Penn", "Wharton", a sport abbreviation). The BM25 index
+is built at ingest time from the chunks stored in Chroma, keyed by their Chroma ids, and saved next to the collection
+as <collection>.bm25.npz. The two rankings are fused with reciprocal-rank fusion, which needs no score calibration.
+"""
+
+# Reciprocal-rank fusion constant from the original paper (Cormack et al. 2009), damps the weight of the top ranks
+RRF_K: int = 60
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits a text into lower-cased word tokens for BM25.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        List[str]: The tokens, in order.
+    """
+    return re.findall(r"\w+", text.lower())
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a fixed set of documents. Postings are stored as flat NumPy arrays (one slice per term),
+    so a query scores all matching documents with a few vector operations.
+    """
+
+    def __init__(self, ids: List[str], vocabulary: List[str], offsets: np.ndarray, doc_indices: np.ndarray,
+                 term_freqs: np.ndarray, doc_lengths: np.ndarray, k1: float = 1.5, b: float = 0.75):
+        """
+        Args:
+            ids (List[str]): Id of every document (the Chroma id of the chunk).
+            vocabulary (List[str]): Every term, the postings of vocabulary[t] are offsets[t]:offsets[t+1].
+            offsets (np.ndarray): Start of the postings of each term, plus the total length at the end.
+            doc_indices (np.ndarray): Document of each posting.
+            term_freqs (np.ndarray): Number of occurrences of the term in the document of each posting.
+            doc_lengths (np.ndarray): Number of tokens of each document.
+            k1 (float): Term frequency saturation.
+            b (float): Document length normalization.
+        """
+        self.ids = ids
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.doc_indices = doc_indices
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+
+        self._terms: Dict[str, int] = {term: i for i, term in enumerate(vocabulary)}
+        average_length = float(doc_lengths.mean()) if len(doc_lengths) else 1.0
+        # Length normalization of each document, the part of the BM25 denominator that doesn't depend on the query
+        self._norms = (k1 * (1 - b + b * doc_lengths / (average_length or 1.0))).astype(np.float32)
+
+    @classmethod
+    def build(cls, ids: List[str], texts: List[str], k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        """
+        Builds the index of a list of documents.
+
+        Args:
+            ids (List[str]): Id of every document.
+            texts (List[str]): Text of every document.
+            k1 (float): Term frequency saturation.
+            b (float): Document length normalization.
+
+        Returns:
+            BM25Index: The index.
+        """
+        # Flat (term, document, count) triples, grouped by term with one stable sort at the end
+        term_ids: Dict[str, int] = {}
+        postings_terms: List[int] = []
+        postings_counts: List[int] = []
+        docs_per_text = np.zeros(len(texts), dtype=np.int64)
+        doc_lengths = np.zeros(len(texts), dtype=np.int32)
+        for i, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths[i] = len(tokens)
+            counts = Counter(tokens)
+            docs_per_text[i] = len(counts)
+            postings_terms.extend(term_ids.setdefault(term, len(term_ids)) for term in counts)
+            postings_counts.extend(counts.values())
+
+        # Vocabulary in sorted order, term ids renumbered to match
+        vocabulary: List[str] = sorted(term_ids)
+        rank = np.empty(len(term_ids), dtype=np.int64)
+        rank[[term_ids[term] for term in vocabulary]] = np.arange(len(vocabulary))
+        terms = rank[np.asarray(postings_terms, dtype=np.int64)] if postings_terms else np.zeros(0, dtype=np.int64)
+        order = np.argsort(terms, kind="stable")
+
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(terms, minlength=len(vocabulary)))
+        doc_indices = np.repeat(np.arange(len(texts), dtype=np.int32), docs_per_text)[order]
+        term_freqs = np.asarray(postings_counts, dtype=np.float32)[order]
+        return cls(list(ids), vocabulary, offsets, doc_indices, term_freqs, doc_lengths, k1, b)
+
+    def save(self, path: str) -> None:
+        """
+        Saves the index to a .npz file. The file is replaced atomically.
+
+        Args:
+            path (str): Path of the file.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            np.savez(
+                file, ids=np.asarray(self.ids, dtype=str), vocabulary=np.asarray(self.vocabulary, dtype=str),
+                offsets=self.offsets, doc_indices=self.doc_indices, term_freqs=self.term_freqs,
+                doc_lengths=self.doc_lengths, params=np.asarray([self.k1, self.b]),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """
+        Loads an index saved with save.
+
+        Args:
+            path (str): Path of the file.
+
+        Returns:
+            BM25Index: The index.
+        """
+        with np.load(path) as data:
+            k1, b = data["params"].tolist()
+            return cls(data["ids"].tolist(), data["vocabulary"].tolist(), data["offsets"], data["doc_indices"],
+                       data["term_freqs"], data["doc_lengths"], k1, b)
+
+    def scores(self, query: str) -> np.ndarray:
+        """
+        Returns the BM25 score of every document for a query (0 for documents without any query term).
+
+        Args:
+            query (str): The query text.
+
+        Returns:
+            np.ndarray: One score per document, in the order of ids.
+        """
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term, count in Counter(tokenize(query)).items():
+            t = self._terms.get(term)
+            if t is None:
+                continue
+            start, end = self.offsets[t], self.offsets[t+1]
+            docs, freqs = self.doc_indices[start:end], self.term_freqs[start:end]
+            idf = math.log(1 + (len(self.ids) - (end - start) + 0.5) / ((end - start) + 0.5))
+            scores[docs] += count * idf * freqs * (self.k1 + 1) / (freqs + self._norms[docs])
+        return scores
+
+    def search(self, query: str, k: int = 4) -> List[Tuple[str, float]]:
+        """
+        Returns the k documents with the highest BM25 score for a query. Documents without any query term are never returned.
+
+        Args:
+            query (str): The query text.
+            k (int): Maximum number of documents to return.
+
+        Returns:
+            List[Tuple[str, float]]: Document ids and their scores, best first.
+        """
+        scores = self.scores(query)
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        matched = matched[np.argsort(-scores[matched], kind="stable")]
+        return [(self.ids[i], float(scores[i])) for i in matched]
+
+
+def bm25_path(persist_directory: str, collection_name: str) -> str:
+    """
+    Returns where the BM25 index of a collection is saved.
+    """
+    return os.path.join(persist_directory, f"{collection_name}.bm25.npz")
+
+
+def build_bm25_index(vectorstore: Any, batch_size: int = 5000) -> BM25Index:
+    """
+    Builds the BM25 index of everything stored in a Chroma collection, read back page by page.
+
+    Args:
+        vectorstore (Chroma): The vector store.
+        batch_size (int): Number of chunks read per call.
+
+    Returns:
+        BM25Index: The index, keyed by Chroma ids.
+    """
+    ids: List[str] = []
+    texts: List[str] = []
+    while True:
+        page = vectorstore.get(include=["documents"], limit=batch_size, offset=len(ids))
+        if not page["ids"]:
+            break
+        ids.extend(page["ids"])
+        texts.extend(text or "" for text in page["documents"])
+    return BM25Index.build(ids, texts)
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int, rrf_k: int = RRF_K) -> List[str]:
+    """
+    Fuses several rankings of ids: every id scores the sum of 1 / (rrf_k + rank) over the rankings it appears in.
+
+    Args:
+        rankings (List[List[str]]): Ids ordered best first, one list per ranker.
+        k (int): Number of ids to return.
+        rrf_k (int): Fusion constant.
+
+    Returns:
+        List[str]: The k ids with the highest fused score, best first.
+    """
+    scores: Dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] += 1.0 / (rrf_k + rank + 1)
+    return sorted(scores, key=lambda doc_id: -scores[doc_id])[:k]
+
+
+class HybridRetriever(VectorStoreRetriever):
+    """
+    Retriever over a Chroma collection that fuses dense similarity and BM25 with reciprocal-rank fusion.
+    Behaves like the VectorStoreRetriever it replaces: same vectorstore and search_kwargs ({"k": ..., "filter": ...}).
+    """
+
+    bm25: Any
+    # Candidates taken from each ranker before fusion, as a multiple of k
+    fetch_factor: int = 4
+    rrf_k: int = RRF_K
+
+    def search_by_vector(self, query: str, vector: List[float]) -> List[Document]:
+        return self.search_by_vectors([query], [vector])[0]
+
+    def search_by_vectors(self, queries: List[str], vectors: List[List[float]]) -> List[List[Document]]:
+        """
+        Searches with several queries at once: one Chroma query for all dense searches and one get for all lexical matches.
+        """
+        k: int = self.search_kwargs.get("k", 4)
+        fetch_k: int = max(k * self.fetch_factor, 20)
+        where: Optional[Dict] = self.search_kwargs.get("filter")
+
+        dense = self.vectorstore._collection.query(
+            query_embeddings=list(vectors), n_results=fetch_k, where=where, include=["documents", "metadatas"]
+        )
+        found: Dict[str, Document] = {}
+        rankings: List[List[str]] = []
+        for query, ids, texts, metadatas in zip(queries, dense["ids"], dense["documents"], dense["metadatas"]):
+            for doc_id, text, metadata in zip(ids, texts, metadatas):
+                found.setdefault(doc_id, Document(page_content=text, metadata=metadata or {}))
+            lexical: List[str] = [doc_id for doc_id, _ in self.bm25.search(query, fetch_k)]
+            # The BM25 index covers the whole collection, with a filter its matches outside the filter are dropped
+            # below, so more fused candidates are kept to still return k
+            rankings.append(reciprocal_rank_fusion([list(ids), lexical], fetch_k if where else k, self.rrf_k))
+
+        missing: List[str] = list(dict.fromkeys(doc_id for fused in rankings for doc_id in fused if doc_id not in found))
+        if missing:
+            # The filter is applied again, lexical matches outside it are dropped
+            rows = self.vectorstore._collection.get(ids=missing, where=where, include=["documents", "metadatas"])
+            for doc_id, text, metadata in zip(rows["ids"], rows["documents"], rows["metadatas"]):
+                found[doc_id] = Document(page_content=text, metadata=metadata or {})
+        return [[found[doc_id] for doc_id in fused if doc_id in found][:k] for fused in rankings]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.search_by_vector(query, self.vectorstore.embeddings.embed_query(query))
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        vector: List[float] = await self.vectorstore.embeddings.aembed_query(query)
+        return await asyncio.get_running_loop().run_in_executor(None, self.search_by_vector, query, vector)
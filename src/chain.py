@@ -1,49 +1,196 @@
-from langchain_anthropic import ChatAnthropic
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.outputs import LLMResult
+from langchain_core.runnables import RunnableLambda
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.vectorstores import VectorStoreRetriever
 from prompt import get_prompt
+from context import ContextAssembler
+from retriever import create_multi_retriever
+from vector_store import get_embeddings
+from metrics import REGISTRY, add_fields, log_event, record, span
+from typing import Any, Dict, List, Optional, Union
+from uuid import UUID
+import threading, time
+
+# Anthropic beta that enables cache_control breakpoints on the API version used by langchain_anthropic 0.2
+PROMPT_CACHING_BETA: str = "prompt-caching-2024-07-31"
+
+class UsageTracker(BaseCallbackHandler):
+    """
+    Reports the input tokens of every Claude call split into cached, newly cached and uncached tokens, and keeps totals.
+    Also records the time to the first streamed token and the total time of every call as stages of the current trace.
+    """
+    # Called in the thread of the chain run, so the stages land in the trace of the request
+    run_inline: bool = True
+
+    def __init__(self):
+        self.requests: int = 0
+        self.cache_read: int = 0
+        self.cache_creation: int = 0
+        self.uncached: int = 0
+        self.output: int = 0
+        self._lock = threading.Lock()
+        self._started: Dict[UUID, float] = {}
+        self._first_token: Dict[UUID, bool] = {}
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID, **kwargs: Any) -> None:
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        if run_id in self._started and not self._first_token.get(run_id):
+            self._first_token[run_id] = True
+            record("llm.first_token", time.perf_counter() - self._started[run_id])
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._started.pop(run_id, None)
+        self._first_token.pop(run_id, None)
+        REGISTRY.increment("llm_errors")
+
+    def on_llm_end(self, response: LLMResult, *, run_id: Optional[UUID] = None, **kwargs: Any) -> None:
+        started: Optional[float] = self._started.pop(run_id, None)
+        self._first_token.pop(run_id, None)
+        if started is not None:
+            record("llm.total", time.perf_counter() - started)
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if not usage:
+                    continue
+                details = usage.get("input_token_details") or {}
+                cache_read: int = details.get("cache_read") or 0
+                cache_creation: int = details.get("cache_creation") or 0
+                uncached: int = usage["input_tokens"] - cache_read - cache_creation
+                with self._lock:
+                    self.requests += 1
+                    self.cache_read += cache_read
+                    self.cache_creation += cache_creation
+                    self.uncached += uncached
+                    self.output += usage["output_tokens"]
+                REGISTRY.increment("llm_input_tokens_cached", cache_read)
+                REGISTRY.increment("llm_input_tokens_cache_write", cache_creation)
+                REGISTRY.increment("llm_input_tokens_uncached", uncached)
+                REGISTRY.increment("llm_output_tokens", usage["output_tokens"])
+                add_fields(input_tokens=usage["input_tokens"], cached_tokens=cache_read, cache_write_tokens=cache_creation,
+                           uncached_tokens=uncached, output_tokens=usage["output_tokens"])
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the token totals of all calls so far.
+
+        Returns:
+            Dict[str, int]: requests, cached input tokens, input tokens written to the cache, uncached input tokens, output tokens.
+        """
+        return {
+            "requests": self.requests,
+            "cache_read": self.cache_read,
+            "cache_creation": self.cache_creation,
+            "uncached": self.uncached,
+            "output": self.output,
+        }
 
 def create_chain(csv_retriever: VectorStoreRetriever, 
                  url_retriever: VectorStoreRetriever, 
                  pdf_retriever: VectorStoreRetriever, 
                  tag_retriever: VectorStoreRetriever,
-                 api_key: str, model_name: str):
+                 api_key: str, model_name: str,
+                 embeddings: Optional[Embeddings] = None,
+                 context_budgets: Optional[Dict[str, int]] = None,
+                 pinned_context: Optional[str] = None,
+                 llm: Optional[BaseChatModel] = None):
     """
-    Creates a langchain chain that retrieves data from 3 sources and passes them as context for RAG along with prompt.
+    Creates a langchain chain that retrieves data from 4 sources and passes them as context for RAG along with prompt.
+    The question is embedded once and the 4 collections are searched in parallel with that vector.
+    The retrieved chunks are deduplicated and packed into a token budget per context before they reach the prompt.
+    The fixed instructions are sent as a cached system prefix, cached and uncached input tokens are logged for every call.
+    Every stage (retrieval, context assembly, prompt build, first token, LLM) is recorded in the trace of the request, see metrics.py.
 
     Args:
         csv_retriever (VectorStoreRetriever): retrieve relevant data from CSV files.
         url_retriever (VectorStoreRetriever): retrieve relevant data from URLs.
-        pdf_retriever (VectorStoreRetriever): retrieve relevant data from PDF files.
+        pdf_retriever (VectorStoreRetriever): retrieve relevant data from PDF files (a retriever.DepartmentRetriever
+            only searches the guides of the department passed with the question).
+        tag_retriever (VectorStoreRetriever): retrieve previously-used tags.
         api_key (str): The API key for the ChatAnthropic model.
         model_name (str): The name of LLM model
+        embeddings (Optional[Embeddings]): Embedding function for the question, defaults to the one the collections were built with.
+        context_budgets (Optional[Dict[str, int]]): Token budget per context (context, context1, context2, context3), see context.DEFAULT_BUDGETS.
+        pinned_context (Optional[str]): Style guide sections always sent in the cached prefix, e.g. from context.load_pinned_pages.
+        llm (Optional[BaseChatModel]): Chat model to use instead of ChatAnthropic, e.g. stubs.StubChatModel in benchmarks.
 
     Returns:
         chain (object): Langchain chain that combines the data retrieval and processing steps. 
     """
-    def print_retrieved_tags(query: str):
-        retrieved_docs = tag_retriever.get_relevant_documents(query)
-        print("**************************************************************************************")
-        print("")
-        print("Retrieved tags:")
-        for doc in retrieved_docs:
-            print(f"- {doc.page_content}")
-        print("")
-        print("**************************************************************************************")
-        return retrieved_docs
-    
-    model_remote = ChatAnthropic(api_key=api_key, model_name=model_name)
+    def log_retrieved_tags(retrieved_docs: List[Document]):
+        log_event("retrieved_tags", tags=[doc.page_content for doc in retrieved_docs])
+
+    multi_retriever = create_multi_retriever(
+        {"context": csv_retriever, "context1": url_retriever, "context2": pdf_retriever, "context3": tag_retriever},
+        embeddings or get_embeddings(),
+    )
+
+    # The chain takes the question text, or {"question": ..., "dept": ..., "article": ..., "editor_question": ...} to search
+    # only the department's style guides and match tags and articles on the article (see retriever.create_multi_retriever)
+    def retrieve(inputs: Union[str, Dict[str, Any]]) -> Dict:
+        with span("retrieval"):
+            contexts: Dict[str, List[Document]] = multi_retriever.invoke(inputs)
+        log_retrieved_tags(contexts["context3"])
+        return {**contexts, "question": inputs if isinstance(inputs, str) else inputs["question"]}
+
+    async def aretrieve(inputs: Union[str, Dict[str, Any]]) -> Dict:
+        with span("retrieval"):
+            contexts: Dict[str, List[Document]] = await multi_retriever.ainvoke(inputs)
+        log_retrieved_tags(contexts["context3"])
+        return {**contexts, "question": inputs if isinstance(inputs, str) else inputs["question"]}
+
+    # Supports invoke/stream as well as ainvoke/astream, which the UI uses to stream tokens without blocking other requests
     chain = (
-        {
-            "context": csv_retriever,
-            "context1": url_retriever,
-            "context2": pdf_retriever,
-            "context3": RunnablePassthrough() | (lambda x: print_retrieved_tags(x)),  # Retrieve and print tags
-            "question": RunnablePassthrough()
-        }
-        | get_prompt()
+        RunnableLambda(retrieve, afunc=aretrieve)
+        | create_generation_chain(api_key, model_name, context_budgets, pinned_context, llm)
+    )
+    return chain
+
+def create_generation_chain(api_key: str, model_name: str,
+                            context_budgets: Optional[Dict[str, int]] = None,
+                            pinned_context: Optional[str] = None,
+                            llm: Optional[BaseChatModel] = None):
+    """
+    Creates the part of the chain after retrieval: context assembly, prompt and LLM. Takes the retrieved documents of
+    each context plus the question ({"context": [...], ..., "question": "..."}) and returns the response text.
+    batch.py uses it directly with documents retrieved for a whole batch of questions.
+
+    Args:
+        api_key (str): The API key for the ChatAnthropic model.
+        model_name (str): The name of LLM model
+        context_budgets (Optional[Dict[str, int]]): Token budget per context, see context.DEFAULT_BUDGETS.
+        pinned_context (Optional[str]): Style guide sections always sent in the cached prefix.
+        llm (Optional[BaseChatModel]): Chat model to use instead of ChatAnthropic.
+
+    Returns:
+        chain (object): Langchain chain from retrieved documents to the response text.
+    """
+    prompt = get_prompt(pinned_context)
+
+    def build_prompt(inputs: Dict[str, Any]) -> Any:
+        with span("prompt_build"):
+            return prompt.invoke(inputs)
+
+    if llm is not None:
+        model_remote = llm.with_config(callbacks=[UsageTracker()])
+    else:
+        # Imported here so the benchmarks and tests don't pay for the Anthropic SDK
+        from langchain_anthropic import ChatAnthropic
+
+        model_remote = ChatAnthropic(
+            api_key=api_key, model_name=model_name,
+            default_headers={"anthropic-beta": PROMPT_CACHING_BETA},
+            callbacks=[UsageTracker()],
+        )
+    return (
+        RunnableLambda(ContextAssembler(context_budgets, pinned_context=pinned_context).assemble, name="context_assembly")
+        | RunnableLambda(build_prompt, name="prompt")
         | model_remote
         | StrOutputParser()
     )
-    return chain
@@ -0,0 +1,158 @@
+from metrics import REGISTRY, log_event
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+import asyncio, logging, os, sqlite3, threading, time, uuid
+
+"""
+Coalescing of identical requests that are in flight at the same time, e.g. several editors submitting the same article.
+
+Within a process, the first request for a key runs the chain in a task of its own and every identical request that
+arrives before it finishes streams the same chunks, so only one LLM call is made. Across server processes (serve.py),
+the first worker takes a lease on the key in a SQLite file; the other workers wait until the response shows up in the
+shared response cache instead of calling the LLM themselves. If the lease holder dies its lease expires and a waiting
+worker takes over.
+"""
+
+
+class _Flight:
+    """
+    One request in flight: the chunks produced so far, and an event that is replaced every time a chunk is added.
+    """
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done: bool = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+        self.followers: int = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def notify(self) -> None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class RequestCoalescer:
+    """
+    Runs a request once per key, however many identical requests arrive while it runs.
+    """
+
+    def __init__(self, path: Optional[str] = None, lease_seconds: float = 120.0, poll_interval: float = 0.1):
+        """
+        Args:
+            path (Optional[str]): SQLite file for the leases shared by the server processes (e.g. the response cache
+                file). Requests are only coalesced within this process if None.
+            lease_seconds (float): Time after which a lease of a worker that didn't finish is taken over.
+            poll_interval (float): Seconds between two checks of a worker that waits for another one.
+        """
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.owner: str = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._flights: Dict[str, _Flight] = {}
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._db.commit()
+
+    async def stream(self, key: str, produce: Callable[[], AsyncIterator[str]],
+                     lookup: Optional[Callable[[], Awaitable[Optional[str]]]] = None,
+                     store: Optional[Callable[[str], Awaitable[None]]] = None) -> AsyncIterator[str]:
+        """
+        Streams the response of a request, produced once for all identical requests in flight.
+
+        Args:
+            key (str): Identifies identical requests, e.g. response_cache.ResponseCache.key.
+            produce (Callable[[], AsyncIterator[str]]): Starts the request, e.g. the chain's astream.
+            lookup (Optional[Callable[[], Awaitable[Optional[str]]]]): Returns the stored response, e.g. from the shared
+                response cache. Used by workers that wait for another worker's lease.
+            store (Optional[Callable[[str], Awaitable[None]]]): Stores the full response before the lease is released,
+                so waiting workers find it with lookup.
+
+        Yields:
+            str: The chunks of the response.
+
+        Raises:
+            Exception: Whatever produce raised, in every request that followed it.
+        """
+        flight: Optional[_Flight] = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            # A task of its own, so the request finishes for its followers even if the first client disconnects
+            flight.task = asyncio.create_task(self._run(key, flight, produce, lookup, store))
+        else:
+            flight.followers += 1
+            REGISTRY.increment("coalesced_requests")
+
+        position: int = 0
+        while True:
+            changed = flight.changed
+            while position < len(flight.chunks):
+                yield flight.chunks[position]
+                position += 1
+            if flight.done:
+                if flight.error is not None:
+                    raise flight.error
+                return
+            await changed.wait()
+
+    def in_flight(self, key: str) -> bool:
+        """
+        Returns whether a request for the key is running in this process.
+        """
+        return key in self._flights
+
+    async def _run(self, key: str, flight: _Flight, produce: Callable[[], AsyncIterator[str]],
+                   lookup: Optional[Callable[[], Awaitable[Optional[str]]]], store: Optional[Callable[[str], Awaitable[None]]]) -> None:
+        try:
+            # Wait while another worker holds the lease, its response lands in the shared cache
+            waited: bool = False
+            while not await asyncio.to_thread(self._acquire, key):
+                response: Optional[str] = await lookup() if lookup is not None else None
+                if response is not None:
+                    REGISTRY.increment("coalesced_requests")
+                    flight.chunks.append(response)
+                    return
+                waited = True
+                await asyncio.sleep(self.poll_interval)
+
+            try:
+                # The holder may have stored its response and released the lease between two polls
+                response = await lookup() if waited and lookup is not None else None
+                if response is not None:
+                    REGISTRY.increment("coalesced_requests")
+                    flight.chunks.append(response)
+                    return
+                async for chunk in produce():
+                    flight.chunks.append(chunk)
+                    flight.notify()
+                if store is not None:
+                    await store("".join(flight.chunks))
+            finally:
+                await asyncio.to_thread(self._release, key)
+        except Exception as e:
+            flight.error = e
+            log_event("coalesced_request_failed", level=logging.ERROR, key=key, followers=flight.followers, error=repr(e))
+        finally:
+            flight.done = True
+            del self._flights[key]
+            flight.notify()
+
+    def _acquire(self, key: str) -> bool:
+        # Takes the lease if nobody holds it or it expired
+        if self._db is None:
+            return True
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM leases WHERE key = ? AND expires_at < ?", (key, now))
+            cursor = self._db.execute("INSERT OR IGNORE INTO leases (key, owner, expires_at) VALUES (?, ?, ?)",
+                                      (key, self.owner, now + self.lease_seconds))
+        return cursor.rowcount == 1
+
+    def _release(self, key: str) -> None:
+        if self._db is None:
+            return
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, self.owner))
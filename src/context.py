@@ -0,0 +1,245 @@
+from langchain_core.documents import Document
+from data_loader import iter_pdf
+from tokens import CHARS_PER_TOKEN, estimate_tokens
+from metrics import REGISTRY, add_fields, span
+from typing import Any, Dict, List, Optional, Set
+import hashlib, os, re, threading
+
+"""
+Context assembly between the retrievers and the prompt.
+
+The retrievers return lists of Documents that would otherwise be pasted into the prompt as their repr (metadata and
+all). Here every section is turned into compact text: chunks that mostly repeat a chunk already in the prompt
+(overlapping splits, the same SEO advice on several sites) are dropped, each chunk becomes one line with a short source
+label, and chunks are packed in retrieval order into a token budget per section.
+"""
+
+# Estimated tokens per prompt section: articles (CSV), SEO advice (URLs), style guides (PDFs), previously-used tags
+DEFAULT_BUDGETS: Dict[str, int] = {"context": 1000, "context1": 1000, "context2": 1500, "context3": 150}
+
+# A chunk cut to fit the budget must keep at least this many tokens to be worth including
+MIN_PARTIAL_TOKENS: int = 64
+
+
+def parse_budgets(value: Optional[str]) -> Dict[str, int]:
+    """
+    Parses section budgets like "context=800,context2=2000". Sections that are not mentioned keep their default.
+
+    Args:
+        value (Optional[str]): The budgets, e.g. from the CONTEXT_BUDGETS environment variable.
+
+    Returns:
+        Dict[str, int]: Token budget for every section.
+    """
+    budgets: Dict[str, int] = dict(DEFAULT_BUDGETS)
+    for item in (value or "").split(","):
+        if item.strip():
+            name, tokens = item.split("=")
+            budgets[name.strip()] = int(tokens)
+    return budgets
+
+
+def shingles(text: str, size: int = 5) -> Set[int]:
+    """
+    Returns the hashed word n-grams of a text, used to measure how much two chunks overlap.
+
+    Args:
+        text (str): The text.
+        size (int): Number of words per shingle. Shorter texts are one shingle.
+
+    Returns:
+        Set[int]: The shingle hashes.
+    """
+    words: List[str] = re.findall(r"\w+", text.lower())
+    grams = [" ".join(words[i : i+size]) for i in range(max(len(words) - size + 1, 1))]
+    return {int.from_bytes(hashlib.blake2b(gram.encode('utf-8'), digest_size=8).digest(), 'big') for gram in grams}
+
+
+def source_label(document: Document) -> str:
+    """
+    Returns a short label for where a chunk comes from, e.g. "All_Style.pdf p.12" or "moz.com/learn/seo/url".
+    """
+    metadata = document.metadata or {}
+    source: str = str(metadata.get("source", ""))
+    source = re.sub(r"^https?://(www\.)?", "", source).rstrip("/") if "://" in source else os.path.basename(source)
+    if "page" in metadata:
+        source += f" p.{int(metadata['page']) + 1}"
+    elif "row" in metadata:
+        source += f" row {metadata['row']}"
+    return source
+
+
+def format_chunk(document: Document) -> str:
+    """
+    Formats a chunk as one line: its source label in brackets and its text with whitespace collapsed.
+    """
+    text: str = " ".join(document.page_content.split())
+    label: str = source_label(document)
+    return f"- [{label}] {text}" if label else f"- {text}"
+
+
+def _truncate(text: str, tokens: int) -> str:
+    # Cut at a word boundary so the model doesn't see half a word
+    limit: int = int(tokens * CHARS_PER_TOKEN) - 1
+    return text[:limit].rsplit(" ", 1)[0] + "…"
+
+
+def _fit_rows(table: str, tokens: int) -> str:
+    # The caption, the header and as many rows as fit
+    rows: List[str] = []
+    for row in table.split("\n"):
+        if estimate_tokens("\n".join(rows + [row])) > tokens:
+            break
+        rows.append(row)
+    return "\n".join(rows)
+
+
+def load_pinned_pages(spec: str) -> str:
+    """
+    Loads style guide pages to pin in the cached prompt prefix (the PDF text cache makes this cheap).
+
+    Args:
+        spec (str): Pages per file, 1-based, e.g. "files/All_Style.pdf:1-3,5;files/Sports_Style.pdf:2".
+
+    Returns:
+        str: The pages formatted like retrieved chunks, in the order of the spec.
+    """
+    wanted: Dict[str, List[int]] = {}
+    for item in spec.split(";"):
+        if not item.strip():
+            continue
+        path, pages = item.rsplit(":", 1)
+        numbers: List[int] = []
+        for part in pages.split(","):
+            first, _, last = part.partition("-")
+            numbers.extend(range(int(first) - 1, int(last or first)))
+        wanted[path.strip()] = numbers
+    if not wanted:
+        return ""
+
+    found: Dict[tuple, Document] = {
+        (doc.metadata["source"], doc.metadata["page"]): doc
+        for doc in iter_pdf(list(wanted)) if doc.metadata["page"] in wanted[doc.metadata["source"]]
+    }
+    return "\n".join(format_chunk(found[(path, page)]) for path, pages in wanted.items() for page in pages if (path, page) in found)
+
+
+class ContextAssembler:
+    """
+    Turns the retrieved documents of every prompt section into deduplicated, compact text within a token budget.
+    """
+
+    def __init__(self, budgets: Optional[Dict[str, int]] = None, similarity_threshold: float = 0.5, shingle_size: int = 5,
+                 pinned_context: Optional[str] = None):
+        """
+        Args:
+            budgets (Optional[Dict[str, int]]): Token budget per section, DEFAULT_BUDGETS if None.
+            similarity_threshold (float): Chunks whose shingle Jaccard similarity to an included chunk is at least this are dropped.
+            shingle_size (int): Words per shingle.
+            pinned_context (Optional[str]): Text that is always in the prompt. Chunks mostly contained in it are dropped.
+        """
+        self.budgets = budgets or dict(DEFAULT_BUDGETS)
+        self.similarity_threshold = similarity_threshold
+        self.shingle_size = shingle_size
+        self.requests: int = 0
+        self.tokens_before: int = 0
+        self.tokens_after: int = 0
+        self.duplicates: int = 0
+        self._pinned: Set[int] = shingles(pinned_context, shingle_size) if pinned_context else set()
+        self._lock = threading.Lock()
+
+    def assemble(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Replaces the document lists of the budgeted sections by their assembled text. Other keys (the question) pass through.
+        Sections are assembled in budget order and a chunk is dropped if it repeats one already included in any section.
+
+        Args:
+            inputs (Dict[str, Any]): Retrieved documents per section plus the other prompt variables.
+
+        Returns:
+            Dict[str, Any]: The prompt variables.
+        """
+        with span("context_assembly"):
+            return self._assemble(inputs)
+
+    def _assemble(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        outputs: Dict[str, Any] = dict(inputs)
+        included: List[Set[int]] = []
+        before, after, duplicates = 0, 0, 0
+
+        for section, budget in self.budgets.items():
+            if section not in inputs:
+                continue
+            documents: List[Document] = inputs[section] or []
+            # What the prompt contained before this stage: the repr of the document list
+            before += estimate_tokens(str(documents))
+
+            kept: List[Document] = []
+            for doc in documents:
+                doc_shingles = shingles(doc.page_content, self.shingle_size)
+                # A chunk is compared with the whole pinned text by containment, the pinned pages are longer than a chunk
+                pinned = len(doc_shingles & self._pinned) / len(doc_shingles) if self._pinned and doc_shingles else 0.0
+                if pinned >= self.similarity_threshold or any(self._similarity(doc_shingles, other) >= self.similarity_threshold for other in included):
+                    duplicates += 1
+                    continue
+                included.append(doc_shingles)
+                kept.append(doc)
+
+            text = self._pack(kept, budget)
+            after += estimate_tokens(text)
+            outputs[section] = text
+
+        with self._lock:
+            self.requests += 1
+            self.tokens_before += before
+            self.tokens_after += after
+            self.duplicates += duplicates
+        REGISTRY.increment("context_tokens_saved", before - after)
+        add_fields(context_tokens_before=before, context_tokens_after=after, duplicate_chunks=duplicates)
+        return outputs
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the token savings so far.
+
+        Returns:
+            Dict[str, float]: requests, estimated context tokens before and after assembly, tokens saved per request and duplicates dropped.
+        """
+        return {
+            "requests": self.requests,
+            "tokens_before": self.tokens_before,
+            "tokens_after": self.tokens_after,
+            "tokens_saved_per_request": (self.tokens_before - self.tokens_after) / self.requests if self.requests else 0.0,
+            "duplicates": self.duplicates,
+        }
+
+    @staticmethod
+    def _similarity(a: Set[int], b: Set[int]) -> float:
+        return len(a & b) / len(a | b) if a and b else 0.0
+
+    @staticmethod
+    def _pack(documents: List[Document], budget: int) -> str:
+        # Previously-used tags are one short line each, list them on one line
+        if documents and all("tag" in (doc.metadata or {}) for doc in documents):
+            tags: List[str] = []
+            for doc in documents:
+                if estimate_tokens(", ".join(tags + [doc.page_content])) > budget:
+                    break
+                tags.append(doc.page_content)
+            return ", ".join(tags)
+
+        lines: List[str] = []
+        remaining: int = budget
+        for doc in documents:
+            # Tables (article_index.ArticleRetriever) keep their line breaks and are cut after a whole row
+            table: bool = bool((doc.metadata or {}).get("table"))
+            line = doc.page_content if table else format_chunk(doc)
+            tokens = estimate_tokens(line) + 1
+            if tokens <= remaining:
+                lines.append(line)
+                remaining -= tokens
+                continue
+            if remaining >= MIN_PARTIAL_TOKENS:
+                lines.append(_fit_rows(line, remaining) if table else _truncate(line, remaining))
+            break
+        return "\n".join(lines)
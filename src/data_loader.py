@@ -1,11 +1,12 @@
-import os
-from langchain_community.document_loaders.csv_loader import CSVLoader
-from langchain_community.document_loaders import WebBaseLoader, PyPDFLoader
-from typing import List
+import os, hashlib, json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional, Tuple
 from langchain_core.documents import Document
-
-# Throws warning: USER_AGENT environment variable not set, consider setting it to identify your requests.
-# Don't know how to fix it, I Tried the obvious solution but that didn't fix the warning.
+from pypdf import PdfReader
+from bs4 import BeautifulSoup
+from http_cache import fetch_urls, iter_fetch_urls
+from metrics import log_event
+import logging
 
 def load_csv(csv_path: str) -> List[Document]:
     """
@@ -17,24 +18,96 @@ def load_csv(csv_path: str) -> List[Document]:
     Returns:
         List[Document]: Each row of the CSV file is translated to one document.
     """
-    loader = CSVLoader(file_path=csv_path, encoding='utf-8')
-    data: List[Document] = loader.load()
-    return data
+    return list(iter_csv(csv_path))
+
+def iter_csv(csv_path: str) -> Iterator[Document]:
+    """
+    Same as load_csv but yields one row at a time, so the whole file is never held in memory.
+
+    Args:
+        csv_path (str): The path to the CSV file.
+
+    Yields:
+        Document: One document per row of the CSV file.
+    """
+    # Imported here, langchain_community takes about a second to import and only this loader needs it
+    from langchain_community.document_loaders.csv_loader import CSVLoader
+
+    yield from CSVLoader(file_path=csv_path, encoding='utf-8').lazy_load()
 
 def load_url(url_list: List[str]) -> List[Document]:
     """
     Load all text from HTML webpages into a document format 
 
+    Pages are fetched concurrently (at most URL_MAX_WORKERS at once, 2 per host) and cached on disk in URL_CACHE_DIR.
+    A cached page is revalidated with a conditional request, so an unchanged page costs a 304 instead of a download.
+    With URL_OFFLINE=1 only cached pages are used and the network is never touched.
+
     Args:
         url_list (List[str]): A list of URLs to retrieve data from.
 
     Returns:
         List[Document]: A list of documents retrieved from the URLs.
     """
-    docs = [WebBaseLoader(web_path=url, show_progress=True).load() for url in url_list]
-    docs_list = [item for sublist in docs for item in sublist]
+    pages = fetch_urls(url_list, **_url_fetch_settings())
+
+    docs_list: List[Document] = []
+    for url, html in zip(url_list, pages):
+        doc: Optional[Document] = _html_to_document(url, html)
+        if doc is not None:
+            docs_list.append(doc)
     return docs_list
 
+def iter_url(url_list: List[str]) -> Iterator[Document]:
+    """
+    Same as load_url but yields every page as soon as it is fetched (in completion order).
+
+    Args:
+        url_list (List[str]): A list of URLs to retrieve data from.
+
+    Yields:
+        Document: One document per URL.
+    """
+    for url, html in iter_fetch_urls(url_list, **_url_fetch_settings()):
+        doc: Optional[Document] = _html_to_document(url, html)
+        if doc is not None:
+            yield doc
+
+def _url_fetch_settings() -> dict:
+    return {
+        "cache_dir": os.getenv('URL_CACHE_DIR', '.cache/urls'),
+        "max_workers": int(os.getenv('URL_MAX_WORKERS', 8)),
+        "offline": os.getenv('URL_OFFLINE', '').lower() in ('1', 'true', 'yes'),
+    }
+
+def _html_to_document(url: str, html: Optional[str]) -> Optional[Document]:
+    if html is None:
+        log_event("url_skipped", level=logging.WARNING, url=url, reason="not cached (offline) or failed to fetch")
+        return None
+    # Parsed the same way as WebBaseLoader so the documents don't change
+    soup = BeautifulSoup(html, "xml" if url.endswith(".xml") else "html.parser")
+    return Document(page_content=soup.get_text(), metadata=_build_metadata(soup, url))
+
+def _build_metadata(soup: BeautifulSoup, url: str) -> dict:
+    """
+    Builds the same metadata WebBaseLoader attaches to a page: source, title, description and language.
+
+    Args:
+        soup (BeautifulSoup): The parsed page.
+        url (str): The URL of the page.
+
+    Returns:
+        dict: Metadata of the page.
+    """
+    metadata = {"source": url}
+    if title := soup.find("title"):
+        metadata["title"] = title.get_text()
+    if description := soup.find("meta", attrs={"name": "description"}):
+        metadata["description"] = description.get("content", "No description found.")
+    if html := soup.find("html"):
+        metadata["language"] = html.get("lang", "No language found.")
+    return metadata
+
 def load_pdf(pdf_list: List[str]) -> List[Document]:
     """
     Loads data from a list of PDF files into Document objects.
@@ -45,6 +118,91 @@ def load_pdf(pdf_list: List[str]) -> List[Document]:
     Returns:
         List[Document]: A list of documents retrieved from the PDF files.
     """
-    output = [PyPDFLoader(file_path=pdf).load() for pdf in pdf_list]
-    pdfs_list = [item for sublist in output for item in sublist]
+    # iter_pdf yields pages as they finish, put them back in file and page order
+    order: Dict[str, int] = {pdf: i for i, pdf in enumerate(pdf_list)}
+    pdfs_list = sorted(iter_pdf(pdf_list), key=lambda doc: (order[doc.metadata["source"]], doc.metadata["page"]))
     return pdfs_list
+
+def iter_pdf(pdf_list: List[str], max_workers: Optional[int] = None, pages_per_task: int = 20) -> Iterator[Document]:
+    """
+    Loads PDF files page by page across a process pool and yields every page as soon as it is extracted,
+    so splitting and embedding can start before the last PDF is finished. Pages come in completion order.
+
+    The text of every file is cached in PDF_CACHE_DIR under the hash of the file, so an unchanged PDF is never parsed again.
+    Pages are the same as PyPDFLoader's: one Document per page with 'source' and 'page' metadata.
+
+    Args:
+        pdf_list (List[str]): A list of paths to PDF files.
+        max_workers (Optional[int]): Number of worker processes (defaults to the number of CPUs).
+        pages_per_task (int): Number of pages each worker extracts at a time, so large files are split across workers.
+
+    Yields:
+        Document: One document per PDF page.
+    """
+    cache_dir: str = os.getenv('PDF_CACHE_DIR', '.cache/pdf')
+    pending: Dict[str, Tuple[str, List[Optional[str]]]] = {}  # pdf -> (file hash, page texts extracted so far)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for pdf in pdf_list:
+            file_hash: str = _file_hash(pdf)
+            cached: Optional[List[str]] = _read_pdf_cache(cache_dir, file_hash)
+            if cached is not None:
+                yield from _pages_to_documents(pdf, 0, cached)
+                continue
+
+            num_pages: int = len(PdfReader(pdf).pages)
+            pending[pdf] = (file_hash, [None] * num_pages)
+            for start in range(0, num_pages, pages_per_task):
+                stop: int = min(start + pages_per_task, num_pages)
+                futures[executor.submit(_extract_pages, pdf, start, stop)] = (pdf, start)
+
+        for future in as_completed(futures):
+            pdf, start = futures[future]
+            texts: List[str] = future.result()
+            yield from _pages_to_documents(pdf, start, texts)
+
+            file_hash, pages = pending[pdf]
+            pages[start : start + len(texts)] = texts
+            if all(page is not None for page in pages):
+                _write_pdf_cache(cache_dir, file_hash, pages)
+
+def _extract_pages(pdf_path: str, start: int, stop: int) -> List[str]:
+    """
+    Extracts the text of pages [start, stop) of a PDF. Runs in a worker process.
+    Uses the same extraction settings as PyPDFLoader.
+
+    Args:
+        pdf_path (str): Path to the PDF file.
+        start (int): First page to extract.
+        stop (int): Page after the last page to extract.
+
+    Returns:
+        List[str]: The text of each page.
+    """
+    reader = PdfReader(pdf_path)
+    return [reader.pages[i].extract_text(extraction_mode="plain") for i in range(start, stop)]
+
+def _pages_to_documents(pdf_path: str, start: int, texts: List[str]) -> List[Document]:
+    return [Document(page_content=text, metadata={"source": pdf_path, "page": start + i}) for i, text in enumerate(texts)]
+
+def _file_hash(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _read_pdf_cache(cache_dir: str, file_hash: str) -> Optional[List[str]]:
+    try:
+        with open(os.path.join(cache_dir, file_hash + ".json"), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def _write_pdf_cache(cache_dir: str, file_hash: str, pages: List[str]) -> None:
+    os.makedirs(cache_dir, exist_ok=True)
+    path: str = os.path.join(cache_dir, file_hash + ".json")
+    with open(path + ".tmp", 'w', encoding='utf-8') as file:
+        json.dump(pages, file)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,201 @@
+from langchain_core.documents import Document
+from metrics import REGISTRY, log_event
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+import re, zlib
+import numpy as np
+
+"""
+Ingest-time removal of near-duplicate chunks, between text_splitter and vector_store.
+
+Several SEO pages in the corpus repeat each other almost word for word, and so do their chunks. Every chunk gets a
+MinHash signature of its word 5-grams; locality-sensitive hashing (the signature cut into bands, chunks that agree on a
+whole band are candidates) finds earlier chunks that may be near-duplicates without comparing all pairs, and a
+candidate is a duplicate if the signatures estimate a Jaccard similarity of at least the threshold. Duplicates are
+dropped, and the sources they came from are recorded on the chunk that was kept ("duplicate_sources" metadata).
+"""
+
+# Mersenne prime 2^61 - 1 of the universal hash family (a * x + b) mod p
+_PRIME: int = (1 << 61) - 1
+_MAX_HASH: int = (1 << 32) - 1
+
+# Longest "duplicate_sources" value, Chroma metadata is a flat string
+MAX_SOURCES_LENGTH: int = 1000
+
+
+def shingle_hashes(text: str, size: int = 5) -> np.ndarray:
+    """
+    Returns the 32-bit hashes of the word n-grams of a text. Hashed with CRC32, so they are the same in every process.
+
+    Args:
+        text (str): The text.
+        size (int): Number of words per shingle. Shorter texts are one shingle.
+
+    Returns:
+        np.ndarray: Unique shingle hashes (uint64).
+    """
+    words: List[str] = re.findall(r"\w+", text.lower())
+    grams = {" ".join(words[i : i+size]) for i in range(max(len(words) - size + 1, 1))}
+    return np.fromiter((zlib.crc32(gram.encode('utf-8')) for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+def lsh_bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """
+    Picks the number of bands and rows per band so that pairs at the threshold become candidates with high probability.
+    Two signatures become candidates with probability 1 - (1 - s^rows)^bands at similarity s, which rises steepest
+    around (1 / bands)^(1 / rows). The closest such point at or below the threshold is chosen.
+
+    Args:
+        num_perm (int): Length of the signatures.
+        threshold (float): Jaccard similarity of a near-duplicate.
+
+    Returns:
+        Tuple[int, int]: Bands and rows per band (bands * rows <= num_perm).
+    """
+    best: Tuple[float, int, int] = (float("inf"), 1, num_perm)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        knee = (1 / bands) ** (1 / rows)
+        if knee <= threshold and threshold - knee < best[0]:
+            best = (threshold - knee, bands, rows)
+    return best[1], best[2]
+
+
+class MinHasher:
+    """
+    MinHash signatures: for each of num_perm hash functions, the minimum hash over the shingles of a text.
+    The fraction of equal entries of two signatures estimates the Jaccard similarity of the shingle sets.
+    """
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5, seed: int = 1):
+        """
+        Args:
+            num_perm (int): Number of hash functions (signature length). More is more accurate and slower.
+            shingle_size (int): Words per shingle.
+            seed (int): Seed of the hash functions, signatures are only comparable with the same seed.
+        """
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        # a and b below 2^32 so a * x + b never overflows 64 bits for 32-bit x
+        self._a = rng.randint(1, _MAX_HASH, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, _MAX_HASH, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        """
+        Returns the MinHash signature of a text (uint32 array of length num_perm).
+        """
+        hashes = shingle_hashes(text, self.shingle_size)
+        permuted = (np.outer(hashes, self._a) + self._b) % _PRIME & _MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+
+class Deduplicator:
+    """
+    Drops chunks that are near-duplicates of an earlier chunk of the same stream. Memory grows with the number of kept
+    chunks (their signature and id, about 0.6 KB each at 128 permutations), not with the number of pairs.
+    """
+
+    def __init__(self, threshold: float = 0.85, num_perm: int = 128, shingle_size: int = 5, seed: int = 1):
+        """
+        Args:
+            threshold (float): Estimated Jaccard similarity of the word shingles above which a chunk is a duplicate.
+            num_perm (int): MinHash signature length.
+            shingle_size (int): Words per shingle.
+            seed (int): Seed of the MinHash functions.
+        """
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, shingle_size, seed)
+        self.bands, self.rows = lsh_bands(num_perm, threshold)
+        self.seen: int = 0
+        self.removed: int = 0
+
+        self._signatures = np.zeros((1024, num_perm), dtype=np.uint32)
+        self._ids: List[str] = []
+        # One table per band: band hash -> kept chunk, or the list of kept chunks once a second one lands in the bucket
+        self._buckets: List[Dict[int, Union[int, List[int]]]] = [{} for _ in range(self.bands)]
+        # Kept chunk -> sources of the chunks dropped as its duplicates
+        self._duplicate_sources: Dict[int, List[str]] = {}
+
+    def filter(self, documents: Iterable[Document], id_func: Callable[[Document], str]) -> Iterator[Document]:
+        """
+        Yields the documents that are not near-duplicates of an earlier one, lazily and in order.
+
+        Args:
+            documents (Iterable[Document]): The chunks, e.g. from text_splitter.lazy_recursive_splitter.
+            id_func (Callable[[Document], str]): Id the kept chunks are stored under, e.g. vector_store.document_id.
+
+        Yields:
+            Document: The chunks that were kept.
+        """
+        for doc in documents:
+            self.seen += 1
+            signature = self.hasher.signature(doc.page_content)
+            keys: List[int] = [hash(signature[band * self.rows : (band+1) * self.rows].tobytes()) for band in range(self.bands)]
+
+            original: Optional[int] = self._find(signature, keys)
+            if original is not None:
+                self.removed += 1
+                self._duplicate_sources.setdefault(original, []).append(_source(doc))
+                continue
+
+            index: int = len(self._ids)
+            if index == len(self._signatures):
+                self._signatures = np.concatenate([self._signatures, np.zeros_like(self._signatures)])
+            self._signatures[index] = signature
+            self._ids.append(id_func(doc))
+            for bucket, key in zip(self._buckets, keys):
+                kept = bucket.get(key)
+                if kept is None:
+                    bucket[key] = index
+                elif isinstance(kept, list):
+                    kept.append(index)
+                else:
+                    bucket[key] = [kept, index]
+            yield doc
+
+    def _find(self, signature: np.ndarray, keys: List[int]) -> Optional[int]:
+        candidates: Dict[int, None] = {}
+        for bucket, key in zip(self._buckets, keys):
+            kept = bucket.get(key)
+            if kept is not None:
+                candidates.update(dict.fromkeys(kept if isinstance(kept, list) else [kept]))
+        if not candidates:
+            return None
+        indices = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        similarity = (self._signatures[indices] == signature).mean(axis=1)
+        best = int(np.argmax(similarity))
+        return int(indices[best]) if similarity[best] >= self.threshold else None
+
+    def provenance(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the metadata to add to kept chunks that had duplicates: their sources and how many were dropped.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: Chunk id -> {"duplicate_sources": "a | b", "duplicates": n}.
+        """
+        updates: Dict[str, Dict[str, Any]] = {}
+        for index, sources in self._duplicate_sources.items():
+            unique: List[str] = list(dict.fromkeys(sources))
+            updates[self._ids[index]] = {"duplicate_sources": " | ".join(unique)[:MAX_SOURCES_LENGTH], "duplicates": len(sources)}
+        return updates
+
+    def report(self, collection_name: str) -> Dict[str, Any]:
+        """
+        Logs and returns how many chunks were removed from a collection.
+        """
+        stats = {
+            "collection": collection_name,
+            "chunks": self.seen,
+            "removed": self.removed,
+            "removed_ratio": round(self.removed / self.seen, 4) if self.seen else 0.0,
+            "threshold": self.threshold,
+        }
+        REGISTRY.increment("dedup_removed_chunks", self.removed)
+        log_event("dedup_report", **stats)
+        return stats
+
+
+def _source(doc: Document) -> str:
+    metadata = doc.metadata or {}
+    source: str = str(metadata.get("source", ""))
+    return f"{source} p.{metadata['page'] + 1}" if isinstance(metadata.get("page"), int) else source
@@ -0,0 +1,185 @@
+from collections import OrderedDict
+from langchain_core.embeddings import Embeddings
+from typing import Dict, List, Optional
+import hashlib, os, sqlite3, threading, time
+import numpy as np
+
+"""
+Embedding cache shared by every collection, by ingestion and by query-time embedding.
+
+Vectors are keyed by (embedding model, task type, hash of the text). Lookups go through a bounded in-memory LRU
+first and a SQLite file second, so identical text is embedded once across collections, requests and restarts.
+"""
+
+# Nomic embeds documents and queries with different task types, so the same text has a different vector for each
+DOCUMENT_TASK: str = "search_document"
+QUERY_TASK: str = "search_query"
+
+# A full disk tier is trimmed to this fraction of max_disk_items, so the rows are only counted again after that many
+# new vectors instead of on every write
+DISK_TRIM_RATIO: float = 0.9
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding function with a memory tier (LRU) in front of an optional persistent SQLite tier.
+    Both tiers are bounded. The least recently used vectors are evicted first.
+    """
+
+    def __init__(self, embeddings: Embeddings, model: str, path: Optional[str] = None,
+                 max_memory_items: int = 10_000, max_disk_items: int = 1_000_000):
+        """
+        Args:
+            embeddings (Embeddings): The embedding function to cache.
+            model (str): Name of the embedding model, part of every cache key.
+            path (Optional[str]): Path of the SQLite cache file. Memory-only cache if None.
+            max_memory_items (int): Maximum number of vectors kept in memory.
+            max_disk_items (int): Maximum number of vectors kept on disk. Once exceeded, the least recently used are
+                evicted down to DISK_TRIM_RATIO of it.
+        """
+        self.embeddings = embeddings
+        self.model = model
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.hits: int = 0
+        self.disk_hits: int = 0
+        self.misses: int = 0
+
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            # WAL lets several processes read the cache while one writes
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self._db.commit()
+        # Rows on disk as of the last count plus the vectors written since (an upper bound, some replace a row)
+        self._disk_count: int = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] if self._db else 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, DOCUMENT_TASK)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text], QUERY_TASK)[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds many queries at once. Misses are sent to the model in a single call when it supports it.
+
+        Args:
+            texts (List[str]): The queries.
+
+        Returns:
+            List[List[float]]: One vector per query.
+        """
+        return self._embed(texts, QUERY_TASK)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the hit and miss counters of the cache.
+
+        Returns:
+            Dict[str, float]: memory hits, disk hits, misses, hit rate and number of vectors in memory.
+        """
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_items": len(self._memory),
+        }
+
+    def _key(self, text: str, task: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{task}\0{text}".encode('utf-8')).hexdigest()
+
+    def _embed(self, texts: List[str], task: str) -> List[List[float]]:
+        keys: List[str] = [self._key(text, task) for text in texts]
+        vectors: Dict[str, np.ndarray] = {}
+
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    vectors[key] = self._memory[key]
+                    self.hits += 1
+
+        missing: List[str] = [key for key in dict.fromkeys(keys) if key not in vectors]
+        if missing and self._db is not None:
+            found = self._read_disk(missing)
+            vectors.update(found)
+            self._remember(found)
+
+        # Embed every text that is in neither tier, each distinct text once
+        to_embed: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                to_embed.setdefault(key, text)
+        if to_embed:
+            with self._lock:
+                self.misses += len(to_embed)
+            new_vectors = self._call_model(list(to_embed.values()), task)
+            embedded = {key: np.asarray(vector, dtype=np.float32) for key, vector in zip(to_embed, new_vectors)}
+            vectors.update(embedded)
+            self._remember(embedded)
+            if self._db is not None:
+                self._write_disk(embedded)
+
+        return [vectors[key].tolist() for key in keys]
+
+    def _call_model(self, texts: List[str], task: str) -> List[List[float]]:
+        if task == DOCUMENT_TASK:
+            return self.embeddings.embed_documents(texts)
+        # NomicEmbeddings can embed many queries in one request, other models get one call per query
+        if hasattr(self.embeddings, "embed"):
+            return self.embeddings.embed(texts, task_type=task)
+        return [self.embeddings.embed_query(text) for text in texts]
+
+    def _remember(self, vectors: Dict[str, np.ndarray]) -> None:
+        with self._lock:
+            for key, vector in vectors.items():
+                self._memory[key] = vector
+                self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+
+    def _read_disk(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            # SQLite limits the number of parameters per statement
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i+500]
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update({key: np.frombuffer(blob, dtype=np.float32) for key, blob in rows})
+            self.disk_hits += len(found)
+            if found:
+                now = time.time()
+                self._db.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                self._db.commit()
+        return found
+
+    def _write_disk(self, vectors: Dict[str, np.ndarray]) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, vector.tobytes(), now) for key, vector in vectors.items()]
+            )
+            self._disk_count += len(vectors)
+            if self._disk_count > self.max_disk_items:
+                # Counted again only here, other processes write to the same file
+                count: int = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                if count > self.max_disk_items:
+                    keep: int = int(self.max_disk_items * DISK_TRIM_RATIO)
+                    self._db.execute(
+                        "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                        (count - keep,)
+                    )
+                    count = keep
+                self._disk_count = count
+            self._db.commit()
@@ -0,0 +1,185 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+import hashlib, json, logging, os, threading, time
+import requests
+from metrics import log_event
+
+"""
+Concurrent HTTP fetching with a disk cache, used by data_loader.load_url.
+
+Every response is stored under a hash of its URL together with its ETag/Last-Modified headers. The next fetch sends
+a conditional request (If-None-Match / If-Modified-Since), so an unchanged page costs a 304 instead of a full download.
+In offline mode the network is not used at all and only cached pages are returned. A page that can't be fetched and
+isn't cached is logged and skipped, so one dead link doesn't stop an index build.
+"""
+
+DEFAULT_USER_AGENT: str = "Mozilla/5.0 (compatible; dp-seo-engine)"
+
+
+def _cache_path(cache_dir: str, url: str) -> str:
+    return os.path.join(cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + ".json")
+
+
+def read_cache(cache_dir: str, url: str) -> Optional[Dict]:
+    """
+    Reads the cached response of a URL.
+
+    Args:
+        cache_dir (str): Directory of the HTTP cache.
+        url (str): The URL that was fetched.
+
+    Returns:
+        Optional[Dict]: The cache entry (url, etag, last_modified, body, fetched_at) or None if the URL is not cached.
+    """
+    try:
+        with open(_cache_path(cache_dir, url), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(cache_dir: str, entry: Dict) -> None:
+    """
+    Writes a cache entry. The file is replaced atomically so concurrent readers never see a partial entry.
+
+    Args:
+        cache_dir (str): Directory of the HTTP cache.
+        entry (Dict): The cache entry, must contain the 'url' key.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_path(cache_dir, entry["url"])
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(entry, file)
+    os.replace(tmp_path, path)
+
+
+class HostLimiter:
+    """
+    Caps the number of concurrent requests per host so one site is never hit by the whole thread pool at once.
+    """
+
+    def __init__(self, per_host: int):
+        self.per_host = per_host
+        self._lock = threading.Lock()
+        self._semaphores: Dict[str, threading.Semaphore] = {}
+
+    def get(self, url: str) -> threading.Semaphore:
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.Semaphore(self.per_host)
+            return self._semaphores[host]
+
+
+def fetch_url(url: str, cache_dir: str, limiter: HostLimiter, timeout: float = 10.0, retries: int = 3, offline: bool = False) -> Optional[str]:
+    """
+    Fetches one URL through the cache. Revalidates a cached response with a conditional request and
+    retries connection errors, timeouts and 429/5xx responses with exponential backoff.
+
+    Args:
+        url (str): The URL to fetch.
+        cache_dir (str): Directory of the HTTP cache.
+        limiter (HostLimiter): Per-host concurrency limiter.
+        timeout (float): Timeout in seconds for each attempt.
+        retries (int): Number of attempts before giving up.
+        offline (bool): Only use the cache, never the network.
+
+    Returns:
+        Optional[str]: The decoded response body. None if the URL is not cached and either offline mode is on or every
+            attempt failed (e.g. a 404).
+    """
+    cached = read_cache(cache_dir, url)
+    if offline:
+        return cached["body"] if cached else None
+
+    headers = {"User-Agent": os.getenv("USER_AGENT", DEFAULT_USER_AGENT)}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    last_error: Optional[Exception] = None
+    for attempt in range(retries):
+        try:
+            with limiter.get(url):
+                response = requests.get(url, headers=headers, timeout=timeout)
+
+            if response.status_code == 304 and cached:
+                return cached["body"]
+            if response.status_code == 429 or response.status_code >= 500:
+                raise requests.HTTPError(f"{response.status_code} from {url}", response=response)
+            response.raise_for_status()
+
+            # Same decoding as WebBaseLoader (autoset_encoding)
+            response.encoding = response.apparent_encoding
+            write_cache(cache_dir, {
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "body": response.text,
+                "fetched_at": datetime.now(timezone.utc).isoformat(),
+            })
+            return response.text
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            last_error = e
+            # Client errors other than 429 won't go away by retrying
+            if isinstance(e, requests.HTTPError) and e.response is not None and 400 <= e.response.status_code < 500 and e.response.status_code != 429:
+                break
+            if attempt < retries - 1:
+                time.sleep(0.5 * 2 ** attempt)
+
+    if cached:
+        log_event("url_fetch_failed_using_cache", level=logging.WARNING, url=url, error=repr(last_error), fetched_at=cached['fetched_at'])
+        return cached["body"]
+    log_event("url_fetch_failed", level=logging.ERROR, url=url, error=repr(last_error))
+    return None
+
+
+def fetch_urls(urls: List[str], cache_dir: str, max_workers: int = 8, per_host: int = 2, timeout: float = 10.0,
+               retries: int = 3, offline: bool = False) -> List[Optional[str]]:
+    """
+    Fetches many URLs concurrently through the cache.
+
+    Args:
+        urls (List[str]): The URLs to fetch.
+        cache_dir (str): Directory of the HTTP cache.
+        max_workers (int): Size of the thread pool.
+        per_host (int): Maximum number of concurrent requests to the same host.
+        timeout (float): Timeout in seconds for each attempt.
+        retries (int): Number of attempts per URL.
+        offline (bool): Only use the cache, never the network.
+
+    Returns:
+        List[Optional[str]]: Response bodies in the same order as urls. None for URLs that failed or are missing from the
+            cache in offline mode.
+    """
+    limiter = HostLimiter(per_host)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda url: fetch_url(url, cache_dir, limiter, timeout, retries, offline), urls))
+
+
+def iter_fetch_urls(urls: List[str], cache_dir: str, max_workers: int = 8, per_host: int = 2, timeout: float = 10.0,
+                    retries: int = 3, offline: bool = False) -> Iterator[Tuple[str, Optional[str]]]:
+    """
+    Same as fetch_urls but yields every page as soon as it is fetched, in completion order.
+
+    Args:
+        urls (List[str]): The URLs to fetch.
+        cache_dir (str): Directory of the HTTP cache.
+        max_workers (int): Size of the thread pool.
+        per_host (int): Maximum number of concurrent requests to the same host.
+        timeout (float): Timeout in seconds for each attempt.
+        retries (int): Number of attempts per URL.
+        offline (bool): Only use the cache, never the network.
+
+    Yields:
+        Tuple[str, Optional[str]]: The URL and its response body (None if it failed or is missing from the cache in offline mode).
+    """
+    limiter = HostLimiter(per_host)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_url, url, cache_dir, limiter, timeout, retries, offline): url for url in urls}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
@@ -0,0 +1,291 @@
+from data_loader import iter_csv, iter_url, iter_pdf
+from text_splitter import lazy_recursive_splitter
+from vector_store import create_vector_store, delete_collection, open_vector_store, get_embeddings, nomic_login, EMBEDDING_MODEL
+from snapshot import new_version, latest_snapshot, list_snapshots, activate_snapshot, prepare_snapshot, read_manifest, write_manifest
+from tag_index import TagIndex
+from article_index import ArticleIndex
+from dedup import Deduplicator
+from quantized_store import quantized_path
+from sources import CSV_PATH, PDF_LIST, URL_LIST, TAG_PATH, guide_name
+from retriever import DepartmentRetriever
+from metrics import log_event, span, timed_iter, trace
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStoreRetriever
+import argparse, logging, os, shutil, sys
+
+"""
+Offline ingestion. Runs data_loader -> text_splitter -> vector_store once and writes a versioned index snapshot
+that app.py opens at startup, so the web process never loads, splits or embeds the corpus itself.
+
+Usage (from the project root):
+    python src/ingest.py                   # build a new snapshot and make it the active one
+    python src/ingest.py --list            # list snapshots, the active one is marked with *
+    python src/ingest.py --activate <ver>  # roll back (or forward) to another snapshot
+"""
+
+# File of the article analytics index in an index directory, its BM25 index is saved next to it as articles.bm25.npz
+ARTICLES_FILE: str = "articles.npz"
+
+# Where the vector collections are searched from: Chroma, or the int8 IVF index compiled from it (quantized_store.py)
+VECTOR_BACKENDS: Tuple[str, ...] = ("chroma", "quantized")
+
+
+def build_index(persist_directory: Optional[str] = None, hybrid: bool = True, articles: bool = True,
+                dedup_threshold: Optional[float] = None, vector_backend: Optional[str] = None) -> Tuple[Dict[str, VectorStoreRetriever], Dict[str, int]]:
+    """
+    Loads, splits and stores the whole corpus in the vector store collections, the article index and the tag index.
+    Every collection is a generator chain (load -> split -> embed -> upsert), so documents are embedded while
+    later ones are still being loaded, and neither the raw corpus nor all chunks are held in memory at once.
+    Loading, splitting and embedding run interleaved, so each is timed separately as a stage (load.csv, split.csv, ...).
+
+    Args:
+        persist_directory (Optional[str]): Directory for a persistent index. In-memory index if None
+            (the tag index is then saved next to the tag file).
+        hybrid (bool): Also build a BM25 index of each collection so retrieval fuses exact-term and dense matches.
+        articles (bool): Serve the CSV from a columnar article index (article_index.py) instead of embedding its rows.
+            Falls back to the csv_collection if the CSV lacks the URL, clicks or impressions column.
+        dedup_threshold (Optional[float]): Drop chunks whose word shingles overlap an earlier chunk of the same collection
+            by at least this Jaccard similarity (dedup.py). Defaults to DEDUP_THRESHOLD (0.85), 0 keeps every chunk.
+        vector_backend (Optional[str]): "chroma", or "quantized" to serve the collections from int8 IVF indexes
+            (quantized_store.py), which needs persist_directory. Defaults to VECTOR_BACKEND ("chroma").
+
+    Returns:
+        Tuple[Dict[str, VectorStoreRetriever], Dict[str, int]]: Retriever and chunk count (rows for the article index) for each collection.
+
+    Raises:
+        ValueError: If the vector backend is unknown.
+    """
+    if dedup_threshold is None:
+        dedup_threshold = float(os.getenv('DEDUP_THRESHOLD', 0.85))
+    vector_backend = vector_backend or os.getenv('VECTOR_BACKEND', 'chroma')
+    if vector_backend not in VECTOR_BACKENDS:
+        raise ValueError(f"Unknown vector backend {vector_backend}, expected one of {', '.join(VECTOR_BACKENDS)}")
+    quantized: bool = vector_backend == "quantized" and persist_directory is not None
+    if vector_backend == "quantized" and not quantized:
+        log_event("quantized_index_skipped", level=logging.WARNING, reason="no persist directory, serving from Chroma")
+    log_event("index_build_started", persist_directory=persist_directory, hybrid=hybrid, articles=articles, dedup_threshold=dedup_threshold)
+    retrievers: Dict[str, VectorStoreRetriever] = {}
+    chunk_counts: Dict[str, int] = {}
+
+    article_index: Optional[ArticleIndex] = None
+    if articles:
+        try:
+            with span("article_index"):
+                article_index = ArticleIndex.from_csv(CSV_PATH)
+        except ValueError as e:
+            log_event("article_index_skipped", level=logging.WARNING, reason=str(e))
+    if article_index is not None:
+        retrievers["csv_collection"] = article_index.as_retriever()
+        chunk_counts["csv_collection"] = len(article_index)
+        if persist_directory:
+            article_index.save(os.path.join(persist_directory, ARTICLES_FILE))
+            # A snapshot copied from one built before the article index still has the embedded rows
+            delete_collection(persist_directory, "csv_collection")
+    elif persist_directory:
+        for name in [ARTICLES_FILE, ARTICLES_FILE.replace(".npz", ".bm25.npz")]:
+            if os.path.isfile(os.path.join(persist_directory, name)):
+                os.remove(os.path.join(persist_directory, name))
+
+    splits: Dict[str, Iterable[Document]] = {
+        "url_collection": timed_iter("split.url", lazy_recursive_splitter(timed_iter("load.url", iter_url(URL_LIST)))),
+        "pdf_collection": timed_iter("split.pdf", lazy_recursive_splitter(timed_iter("load.pdf", with_guides(iter_pdf(PDF_LIST))))),
+    }
+    if article_index is None:
+        splits = {"csv_collection": timed_iter("split.csv", lazy_recursive_splitter(timed_iter("load.csv", iter_csv(CSV_PATH)))), **splits}
+
+    duplicates: Dict[str, int] = {}
+    for collection_name, documents in splits.items():
+        # Near-duplicate chunks (the SEO pages repeat each other) are dropped between the splitter and the vector store
+        dedup: Optional[Deduplicator] = Deduplicator(threshold=dedup_threshold) if dedup_threshold > 0 else None
+        # Includes the time spent pulling documents through the loader and splitter (the load.* and split.* stages)
+        with span(f"create_vector_store.{collection_name}"):
+            retrievers[collection_name] = create_vector_store(_count(documents, chunk_counts, collection_name), collection_name,
+                                                              persist_directory=persist_directory, hybrid=hybrid, dedup=dedup,
+                                                              quantized=quantized)
+        if dedup is not None:
+            duplicates[collection_name] = dedup.removed
+            chunk_counts[collection_name] -= dedup.removed
+    # Every style guide chunk carries its guide, so a request only searches its department's guides
+    retrievers["pdf_collection"] = DepartmentRetriever(base_retriever=retrievers["pdf_collection"])
+
+    # Tags are searched in-process from one matrix instead of a Chroma collection of one-line documents
+    with span("tag_index"):
+        tag_index = TagIndex.load_or_build(TAG_PATH, get_embeddings(), EMBEDDING_MODEL, index_dir=persist_directory)
+    retrievers["tag_collection"] = tag_index.as_retriever()
+    chunk_counts["tag_collection"] = len(tag_index.tags)
+
+    log_event("index_built", chunk_counts=chunk_counts, duplicates_removed=duplicates, embedding_cache=get_embeddings().stats())
+
+    return retrievers, chunk_counts
+
+
+def open_snapshot(path: str) -> Dict[str, VectorStoreRetriever]:
+    """
+    Opens the collections and the tag index of a snapshot built by build_snapshot. Nothing is loaded or embedded.
+
+    Args:
+        path (str): Path of the snapshot directory.
+
+    Returns:
+        Dict[str, VectorStoreRetriever]: Retriever for each collection.
+    """
+    manifest = read_manifest(path)
+    retrievers: Dict[str, VectorStoreRetriever] = {}
+    for collection_name in manifest["chunk_counts"]:
+        if collection_name == "csv_collection" and os.path.isfile(os.path.join(path, ARTICLES_FILE)):
+            retrievers[collection_name] = ArticleIndex.load(os.path.join(path, ARTICLES_FILE)).as_retriever()
+        elif collection_name == "tag_collection" and os.path.isfile(os.path.join(path, "tags.npy")):
+            retrievers[collection_name] = TagIndex.load(path, get_embeddings()).as_retriever()
+        else:
+            # Snapshots from before the tag index keep their tags in Chroma
+            retrievers[collection_name] = open_vector_store(path, collection_name)
+    # Snapshots from before the guide metadata can't be filtered by department
+    if manifest.get("guides") and "pdf_collection" in retrievers:
+        retrievers["pdf_collection"] = DepartmentRetriever(base_retriever=retrievers["pdf_collection"])
+    return retrievers
+
+
+def chroma_collections(path: str) -> List[str]:
+    """
+    Lists the collections of a snapshot that open_snapshot serves from Chroma, i.e. that every process loads a copy of
+    instead of sharing memory-mapped files (the article index, the tag index and quantized indexes).
+
+    Args:
+        path (str): Path of the snapshot directory.
+
+    Returns:
+        List[str]: The names of those collections, empty if the snapshot was built with --vector-backend quantized.
+    """
+    manifest = read_manifest(path)
+    return [collection_name for collection_name in manifest["chunk_counts"]
+            if not (collection_name == "csv_collection" and os.path.isfile(os.path.join(path, ARTICLES_FILE)))
+            and not (collection_name == "tag_collection" and os.path.isfile(os.path.join(path, "tags.npy")))
+            and not os.path.isdir(quantized_path(path, collection_name))]
+
+
+def with_guides(pages: Iterable[Document]) -> Iterator[Document]:
+    """
+    Adds the name of its style guide to every PDF page as "guide" metadata (see sources.guides_for), the chunks inherit it.
+    """
+    for page in pages:
+        page.metadata["guide"] = guide_name(page.metadata.get("source", ""))
+        yield page
+
+
+def _count(documents: Iterable[Document], counts: Dict[str, int], key: str) -> Iterator[Document]:
+    # Counts the chunks of a stream as they go by
+    counts[key] = 0
+    for doc in documents:
+        counts[key] += 1
+        yield doc
+
+
+def build_snapshot(snapshot_dir: str, from_scratch: bool = False, hybrid: bool = True, articles: bool = True,
+                   dedup_threshold: Optional[float] = None, vector_backend: Optional[str] = None) -> str:
+    """
+    Builds a new index snapshot, writes its manifest and makes it the active snapshot.
+    Unless from_scratch is set, the active snapshot is copied first so only changed chunks are embedded.
+
+    Args:
+        snapshot_dir (str): Directory that holds the snapshots.
+        from_scratch (bool): Embed the whole corpus instead of starting from the active snapshot.
+        hybrid (bool): Save a BM25 index with each collection for hybrid retrieval.
+        articles (bool): Serve the CSV from the columnar article index instead of a vector collection.
+        dedup_threshold (Optional[float]): Near-duplicate threshold, see build_index. 0 keeps every chunk.
+        vector_backend (Optional[str]): "chroma" or "quantized", see build_index.
+
+    Returns:
+        str: Version name of the new snapshot.
+    """
+    if dedup_threshold is None:
+        dedup_threshold = float(os.getenv('DEDUP_THRESHOLD', 0.85))
+    vector_backend = vector_backend or os.getenv('VECTOR_BACKEND', 'chroma')
+    version: str = new_version()
+    base: Optional[str] = None if from_scratch else latest_snapshot(snapshot_dir)
+    path: str = prepare_snapshot(snapshot_dir, version, base=base)
+    log_event("snapshot_build_started", version=version, path=path, base=base)
+
+    try:
+        _, chunk_counts = build_index(persist_directory=path, hybrid=hybrid, articles=articles,
+                                      dedup_threshold=dedup_threshold, vector_backend=vector_backend)
+    except BaseException:
+        # Don't leave a half-built snapshot behind
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+
+    write_manifest(path, {
+        "version": version,
+        "built_at": datetime.now(timezone.utc).isoformat(),
+        "embedding_model": EMBEDDING_MODEL,
+        "base_snapshot": os.path.basename(base) if base else None,
+        "sources": {
+            "csv": [CSV_PATH],
+            "pdf": PDF_LIST,
+            "url": URL_LIST,
+            "tags": [TAG_PATH],
+        },
+        "chunk_counts": chunk_counts,
+        "hybrid": hybrid,
+        "articles": os.path.isfile(os.path.join(path, ARTICLES_FILE)),
+        "guides": True,
+        "dedup_threshold": dedup_threshold or None,
+        "vector_backend": vector_backend,
+    })
+    activate_snapshot(snapshot_dir, version)
+    log_event("snapshot_activated", version=version)
+    return version
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a versioned index snapshot for the SEO engine.")
+    parser.add_argument("--snapshot-dir", default=None, help="Directory that holds the snapshots (default: SNAPSHOT_DIR env or 'snapshots').")
+    parser.add_argument("--from-scratch", action="store_true", help="Embed the whole corpus instead of reusing the active snapshot.")
+    parser.add_argument("--no-hybrid", action="store_true", help="Don't build BM25 indexes, retrieval is dense only.")
+    parser.add_argument("--csv-as-vectors", action="store_true", help="Embed the CSV rows instead of building the article index.")
+    parser.add_argument("--no-dedup", action="store_true", help="Keep near-duplicate chunks (default: drop them, see DEDUP_THRESHOLD env).")
+    parser.add_argument("--vector-backend", choices=VECTOR_BACKENDS, default=None,
+                        help="Serve the collections from Chroma or from quantized int8 indexes (default: VECTOR_BACKEND env or chroma).")
+    parser.add_argument("--list", action="store_true", help="List snapshots and exit.")
+    parser.add_argument("--activate", metavar="VERSION", help="Serve an existing snapshot (rollback) and exit.")
+    args = parser.parse_args()
+
+    load_dotenv()
+    snapshot_dir: str = args.snapshot_dir or os.getenv('SNAPSHOT_DIR', 'snapshots')
+
+    if args.list:
+        active = latest_snapshot(snapshot_dir)
+        for version in list_snapshots(snapshot_dir):
+            marker = "*" if active and os.path.basename(active) == version else " "
+            print(f"{marker} {version}")
+        return
+
+    if args.activate:
+        try:
+            activate_snapshot(snapshot_dir, args.activate)
+        except ValueError as e:
+            print(f"VALIDATION ERROR: {e}")
+            sys.exit(1)
+        print(f"Snapshot {args.activate} is now active ✅")
+        return
+
+    vector_backend: str = args.vector_backend or os.getenv('VECTOR_BACKEND', 'chroma')
+    if vector_backend not in VECTOR_BACKENDS:
+        print(f"VALIDATION ERROR: VECTOR_BACKEND must be one of {', '.join(VECTOR_BACKENDS)}")
+        sys.exit(1)
+
+    try:
+        nomic_login()
+    except EnvironmentError as e:
+        print(f"VALIDATION ERROR: {e}")
+        sys.exit(1)
+
+    with trace("ingest", snapshot_dir=snapshot_dir):
+        build_snapshot(snapshot_dir, from_scratch=args.from_scratch, hybrid=not args.no_hybrid, articles=not args.csv_as_vectors,
+                       dedup_threshold=0.0 if args.no_dedup else None, vector_backend=vector_backend)
+
+
+if __name__ == "__main__":
+    main()
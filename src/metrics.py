@@ -0,0 +1,323 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+import contextvars, json, logging, os, sys, threading, time, uuid
+
+"""
+Structured logging, per-request tracing and latency histograms.
+
+Every chat request runs inside a trace: each stage measured with span() (query embedding, the search of every collection,
+rerank, prompt build, time to first token, LLM time) is added to the trace and to a histogram, and when the request ends
+the trace is written as one JSON log line. Startup phases are measured the same way. The histograms are served in the
+Prometheus text format at /metrics next to the Gradio app.
+
+The current trace lives in a context variable, so it follows the request through async tasks. Code that hands work
+to a thread pool submits it with in_context() so the worker thread adds to the same trace.
+"""
+
+# Upper bounds of the histogram buckets in seconds, from 5 ms to 2 minutes
+BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_current_trace: ContextVar[Optional[Dict[str, Any]]] = ContextVar("trace", default=None)
+_trace_lock = threading.Lock()
+_logger: Optional[logging.Logger] = None
+_logger_lock = threading.Lock()
+
+
+class Histogram:
+    """
+    Thread-safe cumulative histogram of durations in seconds.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts: List[int] = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count: int = 0
+        self.sum: float = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile (e.g. 0.95) as the upper bound of the bucket that contains it.
+        """
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank, seen = q * self.count, 0
+            for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+                seen += count
+                if seen >= rank:
+                    return bound
+            return float("inf")
+
+
+class Registry:
+    """
+    Histograms by stage name plus counters by name.
+    """
+
+    def __init__(self):
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self.histograms.setdefault(stage, Histogram())
+        histogram.observe(seconds)
+
+    def increment(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def render(self) -> str:
+        """
+        Returns all histograms and counters in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics page.
+        """
+        lines: List[str] = [
+            "# HELP dp_stage_duration_seconds Duration of each request and startup stage.",
+            "# TYPE dp_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        for stage, histogram in histograms:
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'dp_stage_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'dp_stage_duration_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'dp_stage_duration_seconds_count{{stage="{stage}"}} {histogram.count}')
+        for name, value in counters:
+            lines.append(f"# TYPE dp_{name}_total counter")
+            lines.append(f"dp_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def get_logger() -> logging.Logger:
+    """
+    Returns the logger that writes one JSON object per line to stdout, and to METRICS_LOG_PATH if set.
+    """
+    global _logger
+    with _logger_lock:
+        if _logger is None:
+            logger = logging.getLogger("dp_seo_engine")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            handlers: List[logging.Handler] = [logging.StreamHandler(sys.stdout)]
+            if os.getenv('METRICS_LOG_PATH'):
+                os.makedirs(os.path.dirname(os.getenv('METRICS_LOG_PATH')) or '.', exist_ok=True)
+                handlers.append(logging.FileHandler(os.getenv('METRICS_LOG_PATH'), encoding='utf-8'))
+            for handler in handlers:
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                logger.addHandler(handler)
+            _logger = logger
+    return _logger
+
+
+def log_event(event: str, level: int = logging.INFO, **fields: Any) -> None:
+    """
+    Writes a structured log line, e.g. log_event("snapshot_opened", version="20240101T000000Z").
+
+    Args:
+        event (str): Name of the event.
+        level (int): Logging level.
+        **fields: JSON-serializable details.
+    """
+    record = {"ts": round(time.time(), 3), "event": event, **fields}
+    trace = _current_trace.get()
+    if trace is not None:
+        record.setdefault("request_id", trace["request_id"])
+    get_logger().log(level, json.dumps(record, default=str, ensure_ascii=False))
+
+
+def _start_trace(name: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+    return {"request_id": uuid.uuid4().hex[:12], "name": name, "stages": {}, "_start": time.perf_counter(), **fields}
+
+
+def _end_trace(current: Dict[str, Any], error: Optional[BaseException]) -> None:
+    elapsed = time.perf_counter() - current.pop("_start")
+    REGISTRY.observe(current["name"], elapsed)
+    with _trace_lock:
+        stages = {stage: round(seconds * 1000, 1) for stage, seconds in current.pop("stages").items()}
+    log_event(f"{current['name']}_trace", **current, total_ms=round(elapsed * 1000, 1), stages_ms=stages,
+              **({"error": repr(error)} if error is not None else {}))
+
+
+@contextmanager
+def trace(name: str, **fields: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Traces one request. Stages measured inside are collected, and a JSON line with all of them is logged at the end.
+
+    Args:
+        name (str): Name of the request type, e.g. "startup". Its total duration is recorded as a stage of the same name.
+        **fields: Details logged with the trace.
+
+    Yields:
+        Dict[str, Any]: The trace, add_fields() adds to it.
+    """
+    current: Dict[str, Any] = _start_trace(name, fields)
+    token = _current_trace.set(current)
+    error: Optional[BaseException] = None
+    try:
+        yield current
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _current_trace.reset(token)
+        _end_trace(current, error)
+
+
+async def trace_aiter(name: str, items: AsyncIterable[Any], **fields: Any) -> AsyncIterator[Any]:
+    """
+    Traces an async generator, e.g. a streaming chat handler, as one request. The trace is made current each time the
+    generator is resumed: the UI may resume it from a different task on every step, which would lose a context
+    variable set once inside the generator.
+
+    Args:
+        name (str): Name of the request type, e.g. "chat".
+        items (AsyncIterable[Any]): The generator.
+        **fields: Details logged with the trace.
+
+    Yields:
+        Any: The items of the generator.
+    """
+    current: Dict[str, Any] = _start_trace(name, fields)
+    iterator: AsyncIterator[Any] = items.__aiter__()
+    error: Optional[BaseException] = None
+    try:
+        while True:
+            token = _current_trace.set(current)
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                _current_trace.reset(token)
+            yield item
+    except BaseException as e:
+        error = None if isinstance(e, GeneratorExit) else e
+        raise
+    finally:
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+        _end_trace(current, error)
+
+
+def record(stage: str, seconds: float) -> None:
+    """
+    Records the duration of a stage in its histogram and in the current trace, if any.
+
+    Args:
+        stage (str): Name of the stage, e.g. "search.context2".
+        seconds (float): Duration.
+    """
+    REGISTRY.observe(stage, seconds)
+    current = _current_trace.get()
+    if current is not None:
+        with _trace_lock:
+            current["stages"][stage] = current["stages"].get(stage, 0.0) + seconds
+
+
+def add_fields(**fields: Any) -> None:
+    """
+    Adds details (e.g. token counts) to the current trace. Does nothing outside a trace.
+    """
+    current = _current_trace.get()
+    if current is not None:
+        with _trace_lock:
+            current.update(fields)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    Measures the code inside the block as a stage.
+
+    Args:
+        stage (str): Name of the stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def in_context(func: Any) -> Any:
+    """
+    Binds a function to a copy of the current context, so it adds to the current trace when a thread pool runs it.
+
+    Args:
+        func: The function to run in another thread.
+
+    Returns:
+        The bound function, e.g. pool.submit(in_context(search), ...).
+    """
+    return partial(contextvars.copy_context().run, func)
+
+
+def add_metrics_route(app: Any, path: str = "/metrics") -> None:
+    """
+    Serves the histograms and counters on a FastAPI app, e.g. the one Gradio runs on.
+
+    Args:
+        app (FastAPI): The app.
+        path (str): Path of the endpoint.
+    """
+    from fastapi.responses import PlainTextResponse
+    app.add_api_route(path, lambda: PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4"), methods=["GET"])
+
+
+_timing = threading.local()
+
+
+def timed_iter(stage: str, items: Iterable[Any]) -> Iterator[Any]:
+    """
+    Passes the items of a (lazy) iterable through and records the time spent producing them, excluding the time spent
+    in nested timed_iter stages. E.g. timed_iter("split", splitter(timed_iter("load", loader))) records loading and
+    splitting separately although they run interleaved.
+
+    Args:
+        stage (str): Name of the stage.
+        items (Iterable[Any]): The items.
+
+    Yields:
+        Any: The same items.
+    """
+    iterator = iter(items)
+    total: float = 0.0
+    stack: List[float] = _timing.__dict__.setdefault("stack", [])
+    try:
+        while True:
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed = time.perf_counter() - start
+                nested = stack.pop()
+                total += elapsed - nested
+                if stack:
+                    stack[-1] += elapsed
+            yield item
+    finally:
+        record(stage, total)
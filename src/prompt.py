@@ -1,37 +1,24 @@
+from langchain_core.messages import SystemMessage
 from langchain_core.prompts import ChatPromptTemplate
+from typing import Dict, List, Optional
 
-def get_prompt() -> ChatPromptTemplate:
-    """
-    Generates a prompt template for an editor with knowledge in search engine optimization (SEO).
-
-    The template includes placeholders for various contexts such as 
-    --> information about articles, SEO tips, and writing style guides.
-
-    Returns:
-        ChatPromptTemplate: A prompt template with placeholders for context and question.
-    """
-
-    template = """
+# Fixed editor instructions and output format. They never change between requests, so they are sent as a system
+# prefix that Anthropic can cache instead of being part of every human message.
+SYSTEM_TEMPLATE: str = """
     Pretend you are an editor for the Daily Pennsylvanian that has deep knowledge in search engine optimization and editorial wiriting.
 
-    1. Information about ALL of the Daily Pennsylvanian's articles can be found through this context: 
-    {context}
-    
-    2. Information how to search engine optimize (SEO) article titles and URL slugs can be found through: 
-    {context1}
-    
-    3. The Daily Pennsylvanian writing style guide and tips can be found through: 
-    {context2}
+    Every message gives you four contexts, followed by the editor's question:
+    1. Information about ALL of the Daily Pennsylvanian's articles.
+    2. Information how to search engine optimize (SEO) article titles and URL slugs.
+    3. The Daily Pennsylvanian writing style guide and tips.
+    4. Previously-used tags for the Daily Pennsylvanian's articles.
 
-    4. Previously-used tags for the Daily Pennsylvanian's articles can be found through:
-    {context3}
-    
     Keep these points in mind when answering the editor's question:
     1. Ensure that all of the titles and URL slugs follow the writing style guides provided.
     2. Only use relevant information from the provided contexts; disregard anything unrelated to the editor's question.
     3. Important: Mention specific short references from the context that helped you answer each part of the question. Keep these very short and to the point. i.e. any specific points used from style guides or SEO tips.
     4. If editor asks for suggestions or improvements, specifically mention DP Style Guide or SEO tip or Journalistic Practice used to make the suggestion.
-    
+
     Your response should be structured as follows (follow this structure no matter what the editor asks):
     Title Comments: [comments]
     -> comments for the inputted title: [comments] (if editor entered title doesn't need improvement say that instead and don't provide another title, otherwise provide comments based on SEO and style guides and maybe suggestions changes)
@@ -43,12 +30,75 @@ def get_prompt() -> ChatPromptTemplate:
     Suggested TAGS: [tags]
     -> reasons for the suggested tags: [reasons] (propose anywhere between 1 to 10 possible tags as you see fit. You can generate new tags, the previously-used tags are just for inspiration and context)
     ---
-    Answer to the question: 
+    Answer to the question:
     [answer] (answer anything other than the title and URL slug here)
     -> reasons for the answer: [reasons] (if the answer requires specific information from the context but that information is missing then point that out)
+"""
+
+# The parts that change with every request: the retrieved contexts and the question
+HUMAN_TEMPLATE: str = """
+    1. Information about ALL of the Daily Pennsylvanian's articles can be found through this context:
+    {context}
+
+    2. Information how to search engine optimize (SEO) article titles and URL slugs can be found through:
+    {context1}
+
+    3. The Daily Pennsylvanian writing style guide and tips can be found through:
+    {context2}
+
+    4. Previously-used tags for the Daily Pennsylvanian's articles can be found through:
+    {context3}
 
     Question by the editor: {question}.
+"""
+
+def article_text(title: str, content: str) -> str:
+    """
+    Returns the article's own text, without the wording of the question template. The tag index matches tags used
+    verbatim in it, and the response cache compares articles by its embedding.
+    """
+    return f"{title}\n\n{content}"
+
+def editor_question(dept: str, title: str, content: str, question: str) -> str:
+    """
+    Builds the question sent through the chain from the fields of the editor form (also used by batch.py).
 
+    Args:
+        dept (str): The department the article is written for, selects the writing guide.
+        title (str): The title of the article.
+        content (str): The content of the article.
+        question (str): The editor's question.
 
+    Returns:
+        str: The question text that is retrieved for and sent to the LLM.
     """
-    return ChatPromptTemplate.from_template(template)
+    return f""" I am a student journalist who writes for this department: {dept} so use the writing guide that is meant for: {dept}.
+        The title of the article that I'm thinking of is: {title}, the content of the article is: {content}. My question is: {question}"""
+
+def get_prompt(pinned_context: Optional[str] = None, cache: bool = True) -> ChatPromptTemplate:
+    """
+    Generates a prompt template for an editor with knowledge in search engine optimization (SEO).
+
+    The fixed instructions (and optionally style guide sections that are needed for most questions) form the system message,
+    marked as a prompt caching breakpoint. The human message has placeholders for the contexts and the question.
+    Anthropic only caches prefixes above a minimum length (1024 tokens for Sonnet, 2048 for Haiku); shorter prefixes are sent
+    uncached as usual, pinning style guide sections is what makes the prefix long enough.
+
+    Args:
+        pinned_context (Optional[str]): Style guide text always included in the cached prefix.
+        cache (bool): Mark the system prefix for prompt caching.
+
+    Returns:
+        ChatPromptTemplate: A prompt template with placeholders for context and question.
+    """
+    blocks: List[Dict] = [{"type": "text", "text": SYSTEM_TEMPLATE}]
+    if pinned_context:
+        blocks.append({"type": "text", "text": f"Style guide sections that apply to most questions:\n{pinned_context}"})
+    if cache:
+        # The breakpoint on the last block caches the whole system prefix
+        blocks[-1]["cache_control"] = {"type": "ephemeral"}
+
+    return ChatPromptTemplate.from_messages([
+        SystemMessage(content=blocks),
+        ("human", HUMAN_TEMPLATE),
+    ])
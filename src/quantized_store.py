@@ -0,0 +1,407 @@
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import json, mmap, os, shutil
+import numpy as np
+
+"""
+Compact vector backend that serves a collection without Chroma, for instances where memory is the limit.
+
+The vectors of a collection are L2-normalized and stored as int8 codes with one float32 scale per vector (a quarter of
+float32) in memory-mapped .npy files, grouped by an inverted file index (IVF): k-means splits the vectors into nlist
+clusters and a query only scans the codes of its nprobe closest clusters. The best `rescore` candidates are scored
+again with the float32 vectors, which stay on disk and are only read for those rows. More probes and candidates give
+better recall for more latency (nprobe = nlist scans every code). Texts and metadata are read from disk on demand.
+
+The index is compiled from a Chroma collection (build_quantized_store), so ingest.py keeps embedding incrementally into
+Chroma and the app only opens this directory. It is read-only. QuantizedCollection answers the part of Chroma's
+collection API the retrievers use (query, get and count with where clauses), so HybridRetriever, retriever.with_filter
+and the department partitions work on it unchanged.
+"""
+
+# Defaults of the recall / latency trade-off, overridden by QUANTIZED_NPROBE and QUANTIZED_RESCORE
+DEFAULT_NPROBE: int = 16
+DEFAULT_RESCORE: int = 64
+
+
+def quantized_path(persist_directory: str, collection_name: str) -> str:
+    """
+    Returns where the quantized index of a collection is saved.
+    """
+    return os.path.join(persist_directory, f"{collection_name}.quantized")
+
+
+def matches(metadata: Dict[str, Any], where: Dict[str, Any]) -> bool:
+    """
+    Evaluates a Chroma where clause on the metadata of one chunk, e.g. {"guide": {"$in": ["All_Style.pdf"]}}.
+    Supports plain values, $eq, $ne, $in, $nin, $gt, $gte, $lt, $lte, $and and $or.
+
+    Raises:
+        ValueError: For other operators.
+    """
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches(metadata, clause) for clause in condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(matches(metadata, clause) for clause in condition):
+                return False
+            continue
+        value = metadata.get(key)
+        for operator, operand in (condition.items() if isinstance(condition, dict) else [("$eq", condition)]):
+            if operator == "$eq":
+                ok = value == operand
+            elif operator == "$ne":
+                ok = value != operand
+            elif operator == "$in":
+                ok = value in operand
+            elif operator == "$nin":
+                ok = value not in operand
+            elif operator in ("$gt", "$gte", "$lt", "$lte"):
+                ok = isinstance(value, (int, float)) and {
+                    "$gt": value > operand, "$gte": value >= operand, "$lt": value < operand, "$lte": value <= operand,
+                }[operator]
+            else:
+                raise ValueError(f"Unsupported where operator {operator}")
+            if not ok:
+                return False
+    return True
+
+
+def _kmeans(vectors: np.ndarray, nlist: int, iterations: int, seed: int) -> np.ndarray:
+    """
+    Spherical k-means on a sample of the (normalized) vectors. Returns nlist normalized centroids.
+    """
+    rng = np.random.RandomState(seed)
+    count = len(vectors)
+    sample = np.asarray(vectors[np.sort(rng.choice(count, size=min(count, nlist * 64), replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _assign(sample, centroids)
+        order = np.argsort(assignments, kind="stable")
+        sizes = np.bincount(assignments, minlength=nlist)
+        filled = np.flatnonzero(sizes)
+        centroids[filled] = np.add.reduceat(sample[order], np.concatenate([[0], np.cumsum(sizes)[:-1]])[filled])
+        # An empty cluster restarts from a random sample vector
+        empty = np.flatnonzero(sizes == 0)
+        centroids[empty] = sample[rng.choice(len(sample), size=len(empty))]
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, block_size: int = 8192) -> np.ndarray:
+    # Closest centroid of every vector, in blocks so the score matrix stays small
+    return np.concatenate([
+        np.argmax(np.asarray(vectors[i : i+block_size], dtype=np.float32) @ centroids.T, axis=1)
+        for i in range(0, len(vectors), block_size)
+    ] or [np.zeros(0, dtype=np.int64)])
+
+
+def build_quantized_store(vectorstore: Any, path: str, nlist: Optional[int] = None, float_vectors: bool = True,
+                          iterations: int = 10, seed: int = 0, batch_size: int = 5000) -> Dict[str, Any]:
+    """
+    Compiles everything stored in a Chroma collection into a quantized index directory, replacing an earlier one.
+    Vectors are streamed page by page into memory-mapped files, so the whole collection is never held in memory.
+
+    Args:
+        vectorstore (Chroma): The vector store, e.g. the one built by vector_store.create_vector_store.
+        path (str): Directory of the index, see quantized_path.
+        nlist (Optional[int]): Number of IVF clusters. Defaults to 2 * sqrt(count).
+        float_vectors (bool): Keep the float32 vectors on disk to rescore the candidates. Without them the int8
+            scores are final and the index is four times smaller on disk.
+        iterations (int): k-means iterations.
+        seed (int): Seed of the k-means sample and initialization.
+        batch_size (int): Chunks read from Chroma per call.
+
+    Returns:
+        Dict[str, Any]: The index metadata (count, dim, nlist, float_vectors).
+    """
+    collection = vectorstore._collection
+    count: int = collection.count()
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    ids: List[str] = []
+    offsets: List[int] = [0]
+    vectors: Optional[np.ndarray] = None
+    with open(os.path.join(tmp_path, "documents.jsonl"), 'wb') as documents:
+        while len(ids) < count:
+            page = collection.get(include=["embeddings", "documents", "metadatas"], limit=batch_size, offset=len(ids))
+            if not len(page["ids"]):
+                break
+            block = np.asarray(page["embeddings"], dtype=np.float32)
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(os.path.join(tmp_path, "vectors.npy"), mode='w+', dtype=np.float32,
+                                                    shape=(count, block.shape[1]))
+            vectors[len(ids) : len(ids)+len(block)] = block / np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)
+            for doc_id, text, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+                line = json.dumps([doc_id, text or "", metadata or {}], ensure_ascii=False).encode('utf-8') + b"\n"
+                documents.write(line)
+                offsets.append(offsets[-1] + len(line))
+                ids.append(doc_id)
+
+    count = len(ids)
+    dim: int = vectors.shape[1] if vectors is not None else 0
+    if vectors is None:
+        vectors = np.lib.format.open_memmap(os.path.join(tmp_path, "vectors.npy"), mode='w+', dtype=np.float32, shape=(0, 0))
+    vectors = vectors[:count]
+    nlist = min(nlist or max(1, int(round(2 * np.sqrt(count)))), count)
+
+    # Rows are grouped by cluster, so the codes of a cluster are one contiguous slice
+    centroids = _kmeans(vectors, nlist, iterations, seed) if count else np.zeros((0, dim), dtype=np.float32)
+    assignments = _assign(vectors, centroids) if count else np.zeros(0, dtype=np.int64)
+    rows = np.argsort(assignments, kind="stable")
+    list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=nlist))]).astype(np.int64)
+
+    codes = np.lib.format.open_memmap(os.path.join(tmp_path, "codes.npy"), mode='w+', dtype=np.int8, shape=(count, dim))
+    scales = np.zeros(count, dtype=np.float32)
+    for i in range(0, count, batch_size):
+        chunk = rows[i : i+batch_size]
+        # Read in file order, then put back in cluster order
+        order = np.argsort(chunk)
+        block = np.empty((len(chunk), dim), dtype=np.float32)
+        block[order] = vectors[chunk[order]]
+        block_scales = np.abs(block).max(axis=1) / 127
+        block_scales[block_scales == 0] = 1.0
+        codes[i : i+len(block)] = np.rint(block / block_scales[:, None]).astype(np.int8)
+        scales[i : i+len(block)] = block_scales
+    codes.flush()
+    del codes
+
+    np.save(os.path.join(tmp_path, "scales.npy"), scales)
+    np.save(os.path.join(tmp_path, "centroids.npy"), centroids)
+    np.save(os.path.join(tmp_path, "list_offsets.npy"), list_offsets)
+    np.save(os.path.join(tmp_path, "rows.npy"), rows.astype(np.int64))
+    np.save(os.path.join(tmp_path, "document_offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    # Sorted ids for get(ids=...) by binary search
+    id_array = np.char.encode(np.asarray(ids), 'utf-8') if ids else np.zeros(0, dtype="S1")
+    id_order = np.argsort(id_array, kind="stable")
+    np.save(os.path.join(tmp_path, "ids.npy"), id_array[id_order])
+    np.save(os.path.join(tmp_path, "id_rows.npy"), id_order.astype(np.int64))
+    if isinstance(vectors, np.memmap):
+        vectors.flush()
+    del vectors
+    if not float_vectors:
+        os.remove(os.path.join(tmp_path, "vectors.npy"))
+
+    meta = {"count": count, "dim": dim, "nlist": nlist, "float_vectors": float_vectors,
+            "collection_metadata": collection.metadata or {}}
+    with open(os.path.join(tmp_path, "meta.json"), 'w', encoding='utf-8') as file:
+        json.dump(meta, file)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return meta
+
+
+class QuantizedCollection:
+    """
+    A quantized index directory opened for search. Every array is memory-mapped, the operating system pages in
+    what queries touch.
+    """
+
+    def __init__(self, path: str, nprobe: int = DEFAULT_NPROBE, rescore: int = DEFAULT_RESCORE):
+        """
+        Args:
+            path (str): Directory written by build_quantized_store.
+            nprobe (int): Clusters scanned per query, at least. More are scanned while fewer than `rescore` candidates match.
+            rescore (int): Candidates rescored with the float32 vectors (only when the index kept them).
+        """
+        self.path = path
+        self.nprobe = nprobe
+        self.rescore = rescore
+        with open(os.path.join(path, "meta.json"), 'r', encoding='utf-8') as file:
+            self.meta: Dict[str, Any] = json.load(file)
+        self.metadata: Dict[str, Any] = self.meta.get("collection_metadata", {})
+
+        def load(name: str) -> np.ndarray:
+            return np.load(os.path.join(path, name), mmap_mode='r')
+
+        self.codes, self.scales, self.rows = load("codes.npy"), load("scales.npy"), load("rows.npy")
+        self.centroids, self.list_offsets = np.load(os.path.join(path, "centroids.npy")), np.load(os.path.join(path, "list_offsets.npy"))
+        self.vectors: Optional[np.ndarray] = load("vectors.npy") if self.meta["float_vectors"] else None
+        self._ids, self._id_rows, self._document_offsets = load("ids.npy"), load("id_rows.npy"), load("document_offsets.npy")
+        with open(os.path.join(path, "documents.jsonl"), 'rb') as file:
+            self._documents = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(file.name) else b""
+        # Where clause -> which document rows match, computed once per clause (one per department partition)
+        self._masks: Dict[str, np.ndarray] = {}
+
+    def count(self) -> int:
+        return self.meta["count"]
+
+    def document(self, row: int) -> Tuple[str, str, Dict[str, Any]]:
+        """
+        Returns the id, text and metadata of a document row.
+        """
+        return tuple(json.loads(self._documents[self._document_offsets[row] : self._document_offsets[row + 1]]))
+
+    def _mask(self, where: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        if not where:
+            return None
+        key: str = json.dumps(where, sort_keys=True)
+        if key not in self._masks:
+            self._masks[key] = np.fromiter((matches(self.document(row)[2], where) for row in range(self.count())),
+                                           dtype=bool, count=self.count())
+        return self._masks[key]
+
+    def search(self, vector: Sequence[float], k: int = 4, where: Optional[Dict[str, Any]] = None) -> List[Tuple[int, float]]:
+        """
+        Returns the k document rows most similar to a query vector.
+
+        Args:
+            vector (Sequence[float]): The query embedding.
+            k (int): Number of rows to return.
+            where (Optional[Dict[str, Any]]): Only rows whose metadata matches this Chroma where clause.
+
+        Returns:
+            List[Tuple[int, float]]: Document rows and their cosine similarity, most similar first.
+        """
+        if not self.count() or k <= 0:
+            return []
+        # A copy, the caller's array stays as it was
+        query = np.array(vector, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        mask: Optional[np.ndarray] = self._mask(where)
+        wanted: int = max(k, self.rescore)
+
+        positions: List[np.ndarray] = []
+        scores: List[np.ndarray] = []
+        found: int = 0
+        for probed, cluster in enumerate(np.argsort(-(self.centroids @ query))):
+            if probed >= self.nprobe and found >= wanted:
+                break
+            start, end = int(self.list_offsets[cluster]), int(self.list_offsets[cluster + 1])
+            if start == end:
+                continue
+            list_scores = (self.codes[start:end] @ query) * self.scales[start:end]
+            list_positions = np.arange(start, end)
+            if mask is not None:
+                keep = mask[self.rows[start:end]]
+                list_positions, list_scores = list_positions[keep], list_scores[keep]
+            positions.append(list_positions)
+            scores.append(list_scores)
+            found += len(list_positions)
+        if not found:
+            return []
+
+        candidate_positions, candidate_scores = np.concatenate(positions), np.concatenate(scores)
+        top = np.argpartition(-candidate_scores, min(wanted, found) - 1)[:wanted]
+        rows, final_scores = self.rows[candidate_positions[top]], candidate_scores[top]
+        if self.vectors is not None:
+            # Sorted rows read the memory-mapped float vectors front to back
+            rows = np.sort(rows)
+            final_scores = self.vectors[rows] @ query
+        best = np.argsort(-final_scores, kind="stable")[:k]
+        return [(int(rows[i]), float(final_scores[i])) for i in best]
+
+    def query(self, query_embeddings: Sequence[Sequence[float]], n_results: int = 10, where: Optional[Dict[str, Any]] = None,
+              include: Iterable[str] = ("documents", "metadatas", "distances")) -> Dict[str, Any]:
+        """
+        Same as chromadb Collection.query. Distances are cosine distances (1 - similarity).
+        """
+        include = set(include)
+        results: Dict[str, List[List[Any]]] = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for vector in query_embeddings:
+            hits = self.search(vector, n_results, where)
+            documents = [self.document(row) for row, _ in hits]
+            results["ids"].append([doc_id for doc_id, _, _ in documents])
+            results["documents"].append([text for _, text, _ in documents])
+            results["metadatas"].append([metadata or None for _, _, metadata in documents])
+            results["distances"].append([1 - score for _, score in hits])
+        return {key: value if key == "ids" or key in include else None for key, value in results.items()}
+
+    def get(self, ids: Optional[Sequence[str]] = None, where: Optional[Dict[str, Any]] = None, limit: Optional[int] = None,
+            offset: Optional[int] = None, include: Iterable[str] = ("documents", "metadatas")) -> Dict[str, Any]:
+        """
+        Same as chromadb Collection.get (without embeddings).
+        """
+        include = set(include)
+        if ids is not None:
+            keys = np.char.encode(np.asarray(list(ids)), 'utf-8') if len(ids) else np.zeros(0, dtype="S1")
+            found = np.searchsorted(self._ids, keys)
+            rows = [int(self._id_rows[i]) for i, key in zip(found, keys) if i < len(self._ids) and self._ids[i] == key]
+        else:
+            rows = range(self.count())
+        mask: Optional[np.ndarray] = self._mask(where)
+        if mask is not None:
+            rows = [row for row in rows if mask[row]]
+        rows = list(rows)[offset or 0 : (offset or 0) + limit if limit is not None else None]
+
+        documents = [self.document(row) for row in rows]
+        return {
+            "ids": [doc_id for doc_id, _, _ in documents],
+            "documents": [text for _, text, _ in documents] if "documents" in include else None,
+            "metadatas": [metadata or None for _, _, metadata in documents] if "metadatas" in include else None,
+        }
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the size of the index: rows, clusters, MB of int8 codes (scanned) and of float vectors (read to rescore).
+        """
+        return {
+            "count": self.count(),
+            "nlist": self.meta["nlist"],
+            "codes_mb": round((self.codes.nbytes + self.scales.nbytes) / 1e6, 2),
+            "float_vectors_mb": round(self.vectors.nbytes / 1e6, 2) if self.vectors is not None else 0.0,
+        }
+
+
+class QuantizedVectorStore(VectorStore):
+    """
+    LangChain vector store over a QuantizedCollection, so vector_store._as_retriever wraps it like a Chroma store.
+    """
+
+    def __init__(self, collection: QuantizedCollection, embedding: Optional[Embeddings] = None):
+        self._collection = collection
+        self._embedding = embedding
+
+    @classmethod
+    def load(cls, path: str, embedding: Optional[Embeddings] = None, nprobe: Optional[int] = None,
+             rescore: Optional[int] = None) -> "QuantizedVectorStore":
+        """
+        Opens a quantized index directory.
+
+        Args:
+            path (str): Directory written by build_quantized_store.
+            embedding (Optional[Embeddings]): Embeds queries that are not given as vectors.
+            nprobe (Optional[int]): Clusters scanned per query. Defaults to QUANTIZED_NPROBE (16).
+            rescore (Optional[int]): Candidates rescored with float vectors. Defaults to QUANTIZED_RESCORE (64).
+
+        Returns:
+            QuantizedVectorStore: The vector store.
+        """
+        nprobe = nprobe or int(os.getenv('QUANTIZED_NPROBE', DEFAULT_NPROBE))
+        rescore = rescore or int(os.getenv('QUANTIZED_RESCORE', DEFAULT_RESCORE))
+        return cls(QuantizedCollection(path, nprobe=nprobe, rescore=rescore), embedding)
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embedding
+
+    def get(self, ids: Optional[Sequence[str]] = None, where: Optional[Dict[str, Any]] = None, limit: Optional[int] = None,
+            offset: Optional[int] = None, include: Iterable[str] = ("documents", "metadatas")) -> Dict[str, Any]:
+        return self._collection.get(ids=ids, where=where, limit=limit, offset=offset, include=include)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self._embedding.embed_query(query), k=k, filter=filter)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, filter: Optional[Dict[str, Any]] = None,
+                                    **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k=k, filter=filter)]
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4,
+                                               filter: Optional[Dict[str, Any]] = None) -> List[Tuple[Document, float]]:
+        results: List[Tuple[Document, float]] = []
+        for row, score in self._collection.search(embedding, k, filter):
+            _, text, metadata = self._collection.document(row)
+            results.append((Document(page_content=text, metadata=metadata or {}), score))
+        return results
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        raise NotImplementedError("The quantized index is read-only, it is rebuilt from Chroma by ingest.py")
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, **kwargs: Any) -> "QuantizedVectorStore":
+        raise NotImplementedError("Build the index from a Chroma collection with build_quantized_store")
@@ -0,0 +1,32 @@
+import threading, time
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter for requests per minute (token bucket). acquire() blocks until a request may be sent.
+    Allows short bursts of up to `burst` requests, then spaces requests evenly.
+    """
+
+    def __init__(self, requests_per_minute: float, burst: int = 1):
+        """
+        Args:
+            requests_per_minute (float): Sustained request rate.
+            burst (int): Number of requests that may be sent back to back.
+        """
+        self.interval: float = 60.0 / requests_per_minute
+        self.burst = burst
+        self._tokens: float = burst
+        self._last: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) / self.interval)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * self.interval
+            time.sleep(wait)
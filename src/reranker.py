@@ -0,0 +1,215 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from functools import lru_cache
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+from bm25 import BM25Index
+from metrics import REGISTRY, log_event
+from typing import Any, Dict, List, Optional
+import hashlib, logging, os, threading
+
+"""
+Local reranking, the offline alternative to CohereRerank.
+
+A reranker scores (query, chunk) pairs on this machine. The multi-retriever collects the candidates of every
+collection and scores them in one batched call. Scores are cached per (query, candidates), and if scoring takes
+longer than the latency budget the candidates are returned in vector order (the late scores still fill the cache).
+Scorings run in a pool with a thread per concurrent request, and a scoring still queued at its deadline is dropped.
+"""
+
+
+class Reranker(ABC):
+    """
+    Base class of the local rerankers. Subclasses implement score().
+    """
+
+    def __init__(self, budget: Optional[float] = 0.5, cache_size: int = 1024, workers: int = 16):
+        """
+        Args:
+            budget (Optional[float]): Seconds scoring may take before falling back to vector order. No limit if None.
+            cache_size (int): Number of scored candidate lists kept.
+            workers (int): Scorings that run at once, e.g. the number of requests served concurrently. With fewer,
+                requests wait for each other's scoring and exceed the budget.
+        """
+        self.budget = budget
+        self.cache_size = cache_size
+        self.hits: int = 0
+        self.misses: int = 0
+        self.timeouts: int = 0
+
+        self._cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reranker")
+
+    @abstractmethod
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        """
+        Scores how relevant each text is to the query, higher is better.
+
+        Args:
+            query (str): The query text.
+            texts (List[str]): The candidate texts.
+
+        Returns:
+            List[float]: One score per text.
+        """
+
+    def rerank(self, query: str, documents: List[Document], top_n: int) -> List[Document]:
+        """
+        Reorders documents by relevance to the query and keeps the top_n.
+
+        Args:
+            query (str): The query text.
+            documents (List[Document]): The candidates, in vector order.
+            top_n (int): Number of documents to keep.
+
+        Returns:
+            List[Document]: The top_n documents, most relevant first.
+        """
+        return self.rerank_many(query, [documents], [top_n])[0]
+
+    def rerank_many(self, query: str, candidates: List[List[Document]], top_ns: List[int]) -> List[List[Document]]:
+        """
+        Reranks the candidates of several collections with a single scoring call.
+
+        Args:
+            query (str): The query text.
+            candidates (List[List[Document]]): Candidates of each collection, in vector order.
+            top_ns (List[int]): Number of documents to keep for each collection.
+
+        Returns:
+            List[List[Document]]: The kept documents of each collection, most relevant first.
+                The first top_n candidates in vector order if scoring exceeded the latency budget.
+        """
+        texts: List[str] = [doc.page_content for documents in candidates for doc in documents]
+        scores: Optional[List[float]] = self._scores(query, texts) if texts else []
+        if scores is None:
+            return [documents[:top_n] for documents, top_n in zip(candidates, top_ns)]
+
+        reranked: List[List[Document]] = []
+        start: int = 0
+        for documents, top_n in zip(candidates, top_ns):
+            collection_scores = scores[start : start+len(documents)]
+            start += len(documents)
+            # sorted is stable, equal scores keep their vector order
+            order = sorted(range(len(documents)), key=lambda i: -collection_scores[i])
+            reranked.append([documents[i] for i in order[:top_n]])
+        return reranked
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the cache and latency budget counters.
+
+        Returns:
+            Dict[str, int]: cache hits, cache misses and scorings that exceeded the budget.
+        """
+        return {"hits": self.hits, "misses": self.misses, "timeouts": self.timeouts}
+
+    def _scores(self, query: str, texts: List[str]) -> Optional[List[float]]:
+        key = hashlib.sha256("\0".join([query, *texts]).encode('utf-8')).hexdigest()
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+
+        future: Future = self._pool.submit(self.score, query, texts)
+        future.add_done_callback(lambda done: self._remember(key, done))
+        try:
+            return future.result(timeout=self.budget)
+        except TimeoutError:
+            # Not started yet: nobody waits for it any more, don't let it hold up later requests
+            future.cancel()
+            with self._lock:
+                self.timeouts += 1
+            REGISTRY.increment("rerank_timeouts")
+            log_event("rerank_budget_exceeded", level=logging.WARNING, budget_s=self.budget)
+            return None
+
+    def _remember(self, key: str, future: Future) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self._lock:
+            self._cache[key] = future.result()
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+class LexicalReranker(Reranker):
+    """
+    Scores candidates with BM25 computed over the candidates themselves. Needs no model and takes about a millisecond.
+    """
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        return BM25Index.build([str(i) for i in range(len(texts))], texts).scores(query).tolist()
+
+
+class CrossEncoderReranker(Reranker):
+    """
+    Scores candidates with a sentence-transformers cross-encoder on the CPU. Requires `pip install sentence-transformers`.
+    """
+
+    def __init__(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2", batch_size: int = 32, **kwargs: Any):
+        """
+        Args:
+            model_name (str): Hugging Face name of the cross-encoder.
+            batch_size (int): Pairs scored per forward pass.
+            **kwargs: Budget, cache size and workers, see Reranker.
+        """
+        super().__init__(**kwargs)
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError:
+            raise ImportError("RERANKER=cross-encoder needs the sentence-transformers package: pip install sentence-transformers")
+        self.model = CrossEncoder(model_name)
+        self.batch_size = batch_size
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        return self.model.predict([(query, text) for text in texts], batch_size=self.batch_size).tolist()
+
+
+@lru_cache(maxsize=None)
+def get_reranker() -> Reranker:
+    """
+    Returns the local reranker shared by every collection, chosen by the RERANKER environment variable
+    ('lexical' by default or 'cross-encoder'), with a latency budget of RERANK_BUDGET_MS milliseconds and a scoring
+    thread per request the UI serves at once (CONCURRENCY_LIMIT).
+
+    Returns:
+        Reranker: The reranker.
+    """
+    budget: float = float(os.getenv('RERANK_BUDGET_MS', 500)) / 1000
+    workers: int = int(os.getenv('CONCURRENCY_LIMIT', 16))
+    if os.getenv('RERANKER', 'lexical') == 'cross-encoder':
+        return CrossEncoderReranker(os.getenv('CROSS_ENCODER_MODEL', "cross-encoder/ms-marco-MiniLM-L-6-v2"), budget=budget, workers=workers)
+    return LexicalReranker(budget=budget, workers=workers)
+
+
+class RerankedRetriever(BaseRetriever):
+    """
+    Retrieves k_pre candidates with the base retriever and keeps the top_n after local reranking.
+    In the multi-retriever the candidates of all RerankedRetrievers are reranked together in one call.
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    base_retriever: BaseRetriever
+    reranker: Any
+    top_n: int = 5
+
+    def search_by_vector(self, query: str, vector: List[float]) -> List[Document]:
+        # Imported here because retriever.py imports this module
+        from retriever import search_by_vector
+        return self.reranker.rerank(query, search_by_vector(self.base_retriever, query, vector), self.top_n)
+
+    def search_by_vectors(self, queries: List[str], vectors: List[List[float]]) -> List[List[Document]]:
+        from retriever import search_by_vectors
+        candidates: List[List[Document]] = search_by_vectors(self.base_retriever, queries, vectors)
+        return [self.reranker.rerank(query, documents, self.top_n) for query, documents in zip(queries, candidates)]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.reranker.rerank(query, self.base_retriever.invoke(query), self.top_n)
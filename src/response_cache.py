@@ -0,0 +1,250 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from langchain_core.embeddings import Embeddings
+from text import normalize
+from typing import Callable, Dict, Optional, Tuple
+import hashlib, os, sqlite3, threading, time
+import numpy as np
+
+"""
+Cache for chat responses, in front of the RAG chain.
+
+An exact hit needs the same (department, title, content, question) after normalizing case, unicode and whitespace.
+A near-duplicate hit needs the same department, the same question (normalized) and an embedding of the article with
+cosine similarity above the threshold: an edited draft gets the earlier answer, a follow-up question about the same
+article doesn't.
+Entries expire after a TTL, the least recently used entry is evicted when the cache is full, and the whole cache
+is dropped when the index version changes (the answers were built from the old index).
+
+Given a path, responses are also written to a SQLite file that several server processes share (serve.py), so a
+response generated by one worker is a hit in all of them. The in-memory LRU stays in front of it.
+"""
+
+
+@dataclass
+class CacheEntry:
+    response: str
+    dept: str
+    question: str
+    vector: Optional[np.ndarray]
+    created_at: float
+
+
+class ResponseCache:
+    """
+    LRU + TTL cache of chat responses with exact and near-duplicate (embedding similarity) lookup.
+    """
+
+    def __init__(self, embeddings: Optional[Embeddings] = None, max_items: int = 1000, ttl: float = 24 * 3600,
+                 threshold: float = 0.97, index_version: Optional[str] = None, clock: Callable[[], float] = time.time,
+                 path: Optional[str] = None):
+        """
+        Args:
+            embeddings (Optional[Embeddings]): Embeds the query for near-duplicate lookup. Exact matches only if None.
+            max_items (int): Maximum number of cached responses.
+            ttl (float): Seconds a response stays valid.
+            threshold (float): Minimum cosine similarity for a near-duplicate hit.
+            index_version (Optional[str]): Version of the index the responses are built from.
+            clock (Callable[[], float]): Time source, replaceable in tests.
+            path (Optional[str]): SQLite file shared with other processes. Memory-only cache if None.
+        """
+        self.embeddings = embeddings
+        self.max_items = max_items
+        self.ttl = ttl
+        self.threshold = threshold
+        self.index_version = index_version
+        self.clock = clock
+        self.exact_hits: int = 0
+        self.semantic_hits: int = 0
+        self.misses: int = 0
+
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            # WAL lets the other workers read while one writes
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, dept TEXT NOT NULL, question TEXT, vector BLOB, "
+                             "response TEXT NOT NULL, index_version TEXT, created_at REAL NOT NULL)")
+            # Files written before the question column was added: their rows only serve exact hits
+            if "question" not in [row[1] for row in self._db.execute("PRAGMA table_info(responses)")]:
+                self._db.execute("ALTER TABLE responses ADD COLUMN question TEXT")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_dept ON responses (dept)")
+            self._db.commit()
+
+    @staticmethod
+    def key(dept: str, title: str, content: str, question: str) -> str:
+        """
+        Returns the exact-match key of a request.
+        """
+        fields = "\0".join(normalize(field) for field in (dept, title, content, question))
+        return hashlib.sha256(fields.encode('utf-8')).hexdigest()
+
+    def set_index_version(self, version: str) -> None:
+        """
+        Drops every cached response if the index changed since they were cached.
+
+        Args:
+            version (str): Version of the index that is now served.
+        """
+        with self._lock:
+            if version != self.index_version:
+                self._entries.clear()
+                self.index_version = version
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses WHERE index_version IS NOT ?", (version,))
+                self._db.commit()
+
+    def get(self, dept: str, title: str, content: str, question: str, query_text: Optional[str] = None) -> Optional[str]:
+        """
+        Looks up a response, first by exact key and then by article similarity within the same department and question.
+
+        Args:
+            dept (str): Department of the article.
+            title (str): Title of the article.
+            content (str): Content of the article.
+            question (str): The editor's question.
+            query_text (Optional[str]): Embedded for the near-duplicate lookup: the article's title and content, not the
+                templated prompt (which is mostly the same for every question about an article).
+
+        Returns:
+            Optional[str]: The cached response or None.
+        """
+        key = self.key(dept, title, content, question)
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry.response
+            # Another process may have cached it
+            entry = self._read_disk(key)
+            if entry is not None:
+                self._remember(key, entry)
+                self.exact_hits += 1
+                return entry.response
+            has_candidates = (any(entry.vector is not None and (entry.dept, entry.question) == (normalize(dept), normalize(question))
+                                  for entry in self._entries.values())
+                              or self._disk_candidates(normalize(dept), normalize(question)) > 0)
+
+        if self.embeddings is not None and query_text and has_candidates:
+            vector = self._embed(query_text)
+            with self._lock:
+                if self._db is not None:
+                    # The file has every entry of every process, the memory entries included
+                    match = self._most_similar_on_disk(vector, normalize(dept), normalize(question))
+                    if match is not None:
+                        self._remember(*match)
+                        self.semantic_hits += 1
+                        return match[1].response
+                else:
+                    match = self._most_similar(vector, normalize(dept), normalize(question))
+                    if match is not None:
+                        self._entries.move_to_end(match)
+                        self.semantic_hits += 1
+                        return self._entries[match].response
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, dept: str, title: str, content: str, question: str, response: str, query_text: Optional[str] = None) -> None:
+        """
+        Caches a response.
+
+        Args:
+            dept (str): Department of the article.
+            title (str): Title of the article.
+            content (str): Content of the article.
+            question (str): The editor's question.
+            response (str): The response to cache.
+            query_text (Optional[str]): Embedded for the near-duplicate lookup: the article's title and content.
+        """
+        vector = self._embed(query_text) if self.embeddings is not None and query_text else None
+        key = self.key(dept, title, content, question)
+        entry = CacheEntry(response=response, dept=normalize(dept), question=normalize(question), vector=vector, created_at=self.clock())
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is not None:
+                self._write_disk(key, entry)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the hit and miss counters of the cache.
+
+        Returns:
+            Dict[str, float]: exact hits, near-duplicate hits, misses, hit rate and number of cached responses.
+        """
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+            "items": len(self._entries),
+        }
+
+    def _remember(self, key: str, entry: CacheEntry) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_items:
+            self._entries.popitem(last=False)
+
+    def _read_disk(self, key: str) -> Optional[CacheEntry]:
+        if self._db is None:
+            return None
+        row = self._db.execute("SELECT dept, question, vector, response, created_at FROM responses WHERE key = ? AND index_version IS ? AND created_at >= ?",
+                               (key, self.index_version, self.clock() - self.ttl)).fetchone()
+        return self._entry(*row) if row else None
+
+    def _disk_candidates(self, dept: str, question: str) -> int:
+        if self._db is None:
+            return 0
+        return self._db.execute("SELECT COUNT(*) FROM responses WHERE dept = ? AND question = ? AND vector IS NOT NULL AND index_version IS ? AND created_at >= ?",
+                                (dept, question, self.index_version, self.clock() - self.ttl)).fetchone()[0]
+
+    def _most_similar_on_disk(self, vector: np.ndarray, dept: str, question: str) -> Optional[Tuple[str, CacheEntry]]:
+        rows = self._db.execute("SELECT key, dept, question, vector, response, created_at FROM responses "
+                                "WHERE dept = ? AND question = ? AND vector IS NOT NULL AND index_version IS ? AND created_at >= ?",
+                                (dept, question, self.index_version, self.clock() - self.ttl)).fetchall()
+        if not rows:
+            return None
+        similarities = np.stack([np.frombuffer(row[3], dtype=np.float32) for row in rows]) @ vector
+        best = int(np.argmax(similarities))
+        return (rows[best][0], self._entry(*rows[best][1:])) if similarities[best] >= self.threshold else None
+
+    def _write_disk(self, key: str, entry: CacheEntry) -> None:
+        self._db.execute("INSERT OR REPLACE INTO responses (key, dept, question, vector, response, index_version, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (key, entry.dept, entry.question, entry.vector.tobytes() if entry.vector is not None else None, entry.response,
+                          self.index_version, entry.created_at))
+        self._db.execute("DELETE FROM responses WHERE created_at < ?", (self.clock() - self.ttl,))
+        self._db.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                         (self.max_items,))
+        self._db.commit()
+
+    @staticmethod
+    def _entry(dept: str, question: Optional[str], vector: Optional[bytes], response: str, created_at: float) -> CacheEntry:
+        return CacheEntry(response=response, dept=dept, question=question or "", vector=np.frombuffer(vector, dtype=np.float32) if vector is not None else None,
+                          created_at=created_at)
+
+    def _embed(self, text: str) -> np.ndarray:
+        vector = np.asarray(self.embeddings.embed_query(text), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _expire(self) -> None:
+        # Entries are in LRU order, not creation order, so check them all. The cache is small.
+        now = self.clock()
+        for key in [key for key, entry in self._entries.items() if now - entry.created_at > self.ttl]:
+            del self._entries[key]
+
+    def _most_similar(self, vector: np.ndarray, dept: str, question: str) -> Optional[str]:
+        keys = [key for key, entry in self._entries.items()
+                if entry.vector is not None and entry.dept == dept and entry.question == question]
+        if not keys:
+            return None
+        similarities = np.stack([self._entries[key].vector for key in keys]) @ vector
+        best = int(np.argmax(similarities))
+        return keys[best] if similarities[best] >= self.threshold else None
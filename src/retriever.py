@@ -0,0 +1,259 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import Runnable, RunnableLambda
+from langchain_core.vectorstores import VectorStoreRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from pydantic import ConfigDict, PrivateAttr
+from reranker import RerankedRetriever
+from tag_index import TagRetriever
+from article_index import ArticleRetriever
+from metrics import in_context, span
+from sources import guides_for
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+
+def search_by_vector(retriever: BaseRetriever, query: str, vector: List[float], article: Optional[str] = None,
+                     editor_question: Optional[str] = None) -> List[Document]:
+    """
+    Runs a retriever with a query vector that was already computed, instead of letting it embed the query again.
+    Retrievers that can't search by vector are invoked with the query text.
+
+    Args:
+        retriever (BaseRetriever): A retriever returned by vector_store.create_vector_store (or any other retriever).
+        query (str): The query text, used for reranking and by retrievers that can't search by vector.
+        vector (List[float]): The embedding of the query.
+        article (Optional[str]): Title and content of the article, where the tag index looks for tags used verbatim
+            and the article index for the article's topic.
+        editor_question (Optional[str]): The question as the editor typed it, without the prompt template and the
+            article. The article index ranks by what it asks for.
+
+    Returns:
+        List[Document]: The retrieved documents.
+    """
+    if isinstance(retriever, TagRetriever):
+        return retriever.search_by_vector(query, vector, article)
+    if isinstance(retriever, ArticleRetriever):
+        return retriever.search_by_vector(query, vector, article, editor_question)
+    # Our own retrievers know how to search with a precomputed vector
+    if hasattr(retriever, "search_by_vector"):
+        return retriever.search_by_vector(query, vector)
+
+    # Search the base retriever by vector, then rerank with the query text as usual.
+    # A ContextualCompressionRetriever, checked by its fields so langchain.retrievers isn't imported just for this
+    if hasattr(retriever, "base_compressor") and hasattr(retriever, "base_retriever"):
+        docs = search_by_vector(retriever.base_retriever, query, vector)
+        return list(retriever.base_compressor.compress_documents(docs, query)) if docs else []
+
+    if isinstance(retriever, VectorStoreRetriever) and retriever.search_type == "similarity":
+        return retriever.vectorstore.similarity_search_by_vector(vector, **retriever.search_kwargs)
+
+    return retriever.invoke(query)
+
+
+def search_by_vectors(retriever: BaseRetriever, queries: List[str], vectors: List[List[float]],
+                      articles: Optional[List[Optional[str]]] = None,
+                      editor_questions: Optional[List[Optional[str]]] = None) -> List[List[Document]]:
+    """
+    Same as search_by_vector for a batch of queries. Chroma collections are searched with one query for the whole
+    batch and the tag index with one matrix product, other retrievers are searched query by query.
+
+    Args:
+        retriever (BaseRetriever): A retriever returned by vector_store.create_vector_store (or any other retriever).
+        queries (List[str]): The query texts.
+        vectors (List[List[float]]): The embedding of each query.
+        articles (Optional[List[Optional[str]]]): Title and content of each query's article, see search_by_vector.
+        editor_questions (Optional[List[Optional[str]]]): Each query's question as the editor typed it.
+
+    Returns:
+        List[List[Document]]: The retrieved documents of each query.
+    """
+    if isinstance(retriever, TagRetriever):
+        return retriever.search_by_vectors(queries, vectors, articles)
+    if isinstance(retriever, ArticleRetriever):
+        return [retriever.search_by_vector(query, vector, article, editor_question) for query, vector, article, editor_question
+                in zip(queries, vectors, articles or [None] * len(queries), editor_questions or [None] * len(queries))]
+    if hasattr(retriever, "search_by_vectors"):
+        return retriever.search_by_vectors(queries, vectors)
+
+    if isinstance(retriever, VectorStoreRetriever) and retriever.search_type == "similarity" and hasattr(retriever.vectorstore, "_collection"):
+        results = retriever.vectorstore._collection.query(
+            query_embeddings=list(vectors), n_results=retriever.search_kwargs.get("k", 4),
+            where=retriever.search_kwargs.get("filter"), include=["documents", "metadatas"],
+        )
+        return [[Document(page_content=text, metadata=metadata or {}) for text, metadata in zip(texts, metadatas)]
+                for texts, metadatas in zip(results["documents"], results["metadatas"])]
+
+    return [search_by_vector(retriever, query, vector) for query, vector in zip(queries, vectors)]
+
+
+def embed_queries(embeddings: Embeddings, queries: List[str]) -> List[List[float]]:
+    """
+    Embeds a batch of queries, in one model call if the embeddings support it (embedding_cache.CachedEmbeddings does).
+    """
+    if hasattr(embeddings, "embed_queries"):
+        return embeddings.embed_queries(queries)
+    return [embeddings.embed_query(query) for query in queries]
+
+
+def with_filter(retriever: BaseRetriever, where: Dict[str, Any]) -> BaseRetriever:
+    """
+    Returns a copy of a retriever whose Chroma searches only match chunks with the given metadata (a Chroma where clause).
+    Rerankers and compressors around the vector store retriever are kept. Other retrievers are returned unchanged.
+
+    Args:
+        retriever (BaseRetriever): A retriever returned by vector_store.create_vector_store.
+        where (Dict[str, Any]): E.g. {"guide": {"$in": ["All_Style.pdf", "Sports_Style.pdf"]}}.
+
+    Returns:
+        BaseRetriever: The filtered retriever.
+    """
+    if isinstance(retriever, RerankedRetriever) or (hasattr(retriever, "base_compressor") and hasattr(retriever, "base_retriever")):
+        return retriever.model_copy(update={"base_retriever": with_filter(retriever.base_retriever, where)})
+    if isinstance(retriever, VectorStoreRetriever):
+        return retriever.model_copy(update={"search_kwargs": {**retriever.search_kwargs, "filter": where}})
+    return retriever
+
+
+class DepartmentRetriever(BaseRetriever):
+    """
+    Retriever over the style guide collection that only searches the guides of the request's department plus the
+    general guides (sources.guides_for), through a Chroma filter on the "guide" metadata set at ingest.
+    The multi-retriever picks the partition of each request with for_department; invoked directly it searches every guide.
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    base_retriever: BaseRetriever
+    _partitions: Dict[Tuple[str, ...], BaseRetriever] = PrivateAttr(default_factory=dict)
+
+    def for_department(self, dept: Optional[str]) -> BaseRetriever:
+        """
+        Returns the retriever for a department, the unfiltered one if the department is unknown.
+        """
+        guides: Optional[List[str]] = guides_for(dept)
+        if guides is None:
+            return self.base_retriever
+        key = tuple(guides)
+        if key not in self._partitions:
+            self._partitions[key] = with_filter(self.base_retriever, {"guide": {"$in": guides}})
+        return self._partitions[key]
+
+    def search_by_vector(self, query: str, vector: List[float]) -> List[Document]:
+        return search_by_vector(self.base_retriever, query, vector)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.base_retriever.invoke(query)
+
+
+def _request_fields(inputs: Union[str, Dict[str, Any]]) -> Tuple[str, Optional[str], Optional[str], Optional[str]]:
+    # The retrievers take the question text, or {"question": ..., "dept": ..., "article": ..., "editor_question": ...}
+    # to search the department's partitions, and to match tags and articles on the article's and editor's own words
+    if isinstance(inputs, str):
+        return inputs, None, None, None
+    return inputs["question"], inputs.get("dept"), inputs.get("article"), inputs.get("editor_question")
+
+
+def create_multi_retriever(retrievers: Dict[str, BaseRetriever], embeddings: Embeddings, max_workers: int = 32) -> Runnable:
+    """
+    Creates a runnable that embeds the query once and searches all collections in parallel with that vector.
+    This replaces one embedding round trip per retriever with a single one per request.
+    Candidates of locally reranked collections (reranker.RerankedRetriever) are reranked together in one batched call.
+    Department-partitioned collections (DepartmentRetriever) only search the partitions of the request's department.
+    The query embedding, the search of each collection and the rerank are recorded as stages of the current trace.
+
+    Args:
+        retrievers (Dict[str, BaseRetriever]): Retriever for each prompt variable, e.g. {"context": csv_retriever, ...}.
+        embeddings (Embeddings): The embedding function the collections were built with.
+        max_workers (int): Threads shared by all requests for the searches (each request uses one per collection).
+
+    Returns:
+        Runnable: Takes the query text, or {"question": ..., "dept": ..., "article": ..., "editor_question": ...}
+            (article: title and content, see prompt.article_text; editor_question: the question as typed), and returns
+            the retrieved documents for each prompt variable. Supports invoke and ainvoke, the async version doesn't block the event loop while searching.
+            Its retrieve_batch(queries) function returns the documents of many queries with one embedding call
+            and one search per collection (and department).
+    """
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="retriever")
+
+    def resolve(dept: Optional[str]) -> Dict[str, BaseRetriever]:
+        return {name: retriever.for_department(dept) if isinstance(retriever, DepartmentRetriever) else retriever
+                for name, retriever in retrievers.items()}
+
+    def searched(retriever: BaseRetriever) -> BaseRetriever:
+        # Reranked collections are searched without reranking, then all their candidates are reranked in one call
+        return retriever.base_retriever if isinstance(retriever, RerankedRetriever) else retriever
+
+    def search(name: str, retriever: BaseRetriever, query: str, vector: List[float], article: Optional[str],
+               editor_question: Optional[str]) -> List[Document]:
+        with span(f"search.{name}"):
+            return search_by_vector(searched(retriever), query, vector, article, editor_question)
+
+    def rerank(resolved: Dict[str, BaseRetriever], query: str, results: Dict[str, List[Document]]) -> Dict[str, List[Document]]:
+        if not any(isinstance(retriever, RerankedRetriever) for retriever in resolved.values()):
+            return results
+        with span("rerank"):
+            return _rerank(resolved, query, results)
+
+    def _rerank(resolved: Dict[str, BaseRetriever], query: str, results: Dict[str, List[Document]]) -> Dict[str, List[Document]]:
+        groups: Dict[int, List[str]] = {}
+        for name, retriever in resolved.items():
+            if isinstance(retriever, RerankedRetriever):
+                groups.setdefault(id(retriever.reranker), []).append(name)
+        for names in groups.values():
+            reranker = resolved[names[0]].reranker
+            reranked = reranker.rerank_many(query, [results[name] for name in names], [resolved[name].top_n for name in names])
+            results.update(zip(names, reranked))
+        return results
+
+    def retrieve_batch(inputs: List[Union[str, Dict[str, Any]]]) -> List[Dict[str, List[Document]]]:
+        questions, depts, articles, editor_questions = zip(*map(_request_fields, inputs)) if inputs else ((), (), (), ())
+        with span("embed_query"):
+            vectors: List[List[float]] = embed_queries(embeddings, list(questions))
+
+        # Queries of the same department share a filter and are searched together
+        groups: Dict[Optional[str], List[int]] = {}
+        for i, dept in enumerate(depts):
+            groups.setdefault(dept, []).append(i)
+        partitions: Dict[Optional[str], Dict[str, BaseRetriever]] = {dept: resolve(dept) for dept in groups}
+
+        def search_batch(name: str) -> List[List[Document]]:
+            results: List[List[Document]] = [[] for _ in questions]
+            with span(f"search.{name}"):
+                for dept, rows in groups.items():
+                    found = search_by_vectors(searched(partitions[dept][name]), [questions[i] for i in rows], [vectors[i] for i in rows],
+                                              [articles[i] for i in rows], [editor_questions[i] for i in rows])
+                    for i, documents in zip(rows, found):
+                        results[i] = documents
+            return results
+
+        futures = {name: pool.submit(in_context(search_batch), name) for name in retrievers}
+        results: Dict[str, List[List[Document]]] = {name: future.result() for name, future in futures.items()}
+        return [rerank(partitions[depts[i]], question, {name: results[name][i] for name in retrievers})
+                for i, question in enumerate(questions)]
+
+    def retrieve(inputs: Union[str, Dict[str, Any]]) -> Dict[str, List[Document]]:
+        query, dept, article, editor_question = _request_fields(inputs)
+        resolved = resolve(dept)
+        with span("embed_query"):
+            vector: List[float] = embeddings.embed_query(query)
+        futures = {name: pool.submit(in_context(search), name, retriever, query, vector, article, editor_question) for name, retriever in resolved.items()}
+        return rerank(resolved, query, {name: future.result() for name, future in futures.items()})
+
+    async def aretrieve(inputs: Union[str, Dict[str, Any]]) -> Dict[str, List[Document]]:
+        query, dept, article, editor_question = _request_fields(inputs)
+        resolved = resolve(dept)
+        with span("embed_query"):
+            vector: List[float] = await embeddings.aembed_query(query)
+        loop = asyncio.get_running_loop()
+        # run_in_executor doesn't carry the context over to the thread like asyncio.to_thread does
+        results = await asyncio.gather(*(
+            loop.run_in_executor(pool, in_context(search), name, retriever, query, vector, article, editor_question) for name, retriever in resolved.items()
+        ))
+        return await loop.run_in_executor(pool, in_context(rerank), resolved, query, dict(zip(resolved, results)))
+
+    multi_retriever = RunnableLambda(retrieve, afunc=aretrieve, name="multi_retriever")
+    # Used by batch.py: one embedding call and one search per collection for a whole batch of queries
+    multi_retriever.retrieve_batch = retrieve_batch
+    return multi_retriever
@@ -0,0 +1,158 @@
+from metrics import add_metrics_route, log_event, trace_aiter
+from warmup import Warmup
+from dotenv import load_dotenv
+from typing import Any, AsyncIterator, Callable, Dict
+import argparse, importlib, logging, os, sys
+
+"""
+Multi-worker serving of the SEO engine as an HTTP API, to use more than one core.
+
+Every worker is a separate process (uvicorn --workers) that opens the same active index snapshot read-only. The
+article index, the tag index and the quantized vector indexes are memory-mapped, so the workers share one copy of them
+in the page cache. Chroma collections would be loaded by every worker, so with more than one worker the snapshot has to
+be built with --vector-backend quantized (or pass --allow-chroma to accept a copy per worker). The embedding cache
+and the response cache are SQLite files shared by all workers, and identical requests in flight are coalesced across
+workers (coalesce.py), so several editors submitting the same article at once cost one LLM call.
+
+Each worker binds its port right away and warms up in the background like app.py. The Gradio UI stays in app.py
+(one process): its queue keeps per-session state in the process, which a pool of workers can't share.
+
+Usage (from the project root):
+    python src/serve.py --workers 4 --port 8000
+    curl -X POST localhost:8000/api/optimize -H 'Content-Type: application/json' \\
+         -d '{"dept": "DP Sports", "title": "...", "content": "...", "question": "Suggest a slug", "stream": false}'
+"""
+
+# Shared by the workers unless RESPONSE_CACHE_PATH is set
+DEFAULT_RESPONSE_CACHE_PATH: str = ".cache/responses.sqlite3"
+
+
+def default_engine(warmup: Warmup) -> Any:
+    """
+    Starts the engine of app.py with the API key and model from the environment.
+
+    Raises:
+        EnvironmentError: If the API key or the model name is missing.
+    """
+    from app import start_engine
+
+    api_key, model_name = os.getenv('ANTHROPIC_API_KEY'), os.getenv('LLM_MODEL_NAME')
+    if not api_key or not model_name:
+        raise EnvironmentError("Please provide an API key and model name in env file")
+    return start_engine(api_key, model_name, warmup)
+
+
+def load_engine_factory(spec: str) -> Callable[[Warmup], Any]:
+    """
+    Imports an engine factory given as "module:function", e.g. "benchmark:stub_engine" for the load test.
+    """
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def create_app() -> Any:
+    """
+    Creates the API of one worker: POST /api/optimize, GET /health and GET /metrics. The engine named by SERVE_ENGINE
+    (default: serve:default_engine) starts in the background when the worker starts.
+
+    Returns:
+        FastAPI: The app, for uvicorn.
+    """
+    from fastapi import FastAPI, HTTPException
+    from fastapi.responses import StreamingResponse
+    from pydantic import BaseModel
+
+    load_dotenv()
+    warmup: Warmup = Warmup(load_engine_factory(os.getenv('SERVE_ENGINE', 'serve:default_engine')))
+    app = FastAPI(title="DP SEO Optimizer")
+
+    class OptimizeRequest(BaseModel):
+        question: str
+        dept: str = ""
+        title: str = ""
+        content: str = ""
+        # Stream the response as plain text instead of returning it as JSON when it's done
+        stream: bool = False
+
+    @app.on_event("startup")
+    def start_warmup() -> None:
+        warmup.start()
+
+    @app.get("/health")
+    def health() -> Dict[str, Any]:
+        return {"ready": warmup.ready, "step": warmup.step, "pid": os.getpid()}
+
+    @app.post("/api/optimize")
+    async def optimize(request: OptimizeRequest) -> Any:
+        from app import answer
+
+        try:
+            engine = await warmup.await_ready()
+        except RuntimeError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+
+        info: Dict[str, Any] = {}
+        chunks: AsyncIterator[str] = trace_aiter("api", answer(engine, request.question, request.dept, request.title, request.content, info),
+                                                 dept=request.dept, pid=os.getpid())
+        if request.stream:
+            return StreamingResponse(chunks, media_type="text/plain; charset=utf-8")
+        response: str = "".join([chunk async for chunk in chunks])
+        return {"response": response, "source": info.get("source"), "pid": os.getpid()}
+
+    add_metrics_route(app)
+    return app
+
+
+def check_shared_snapshot(allow_chroma: bool = False) -> None:
+    """
+    Exits unless the workers can share the active snapshot: it must exist (otherwise every worker builds the index) and
+    have no Chroma collections (every worker would load its own copy), unless allow_chroma is set.
+    """
+    from ingest import chroma_collections
+    from snapshot import latest_snapshot
+
+    snapshot_path = latest_snapshot(os.getenv('SNAPSHOT_DIR', 'snapshots'))
+    if snapshot_path is None:
+        print("VALIDATION ERROR: No index snapshot found, build one for the workers to share: python src/ingest.py --vector-backend quantized")
+        sys.exit(1)
+    collections = chroma_collections(snapshot_path)
+    if collections and not allow_chroma:
+        print(f"VALIDATION ERROR: {', '.join(collections)} of snapshot {os.path.basename(snapshot_path)} are served from Chroma, "
+              "which every worker loads separately. Rebuild with: python src/ingest.py --vector-backend quantized "
+              "(or pass --allow-chroma to accept a copy per worker)")
+        sys.exit(1)
+    if collections:
+        log_event("serve_chroma_per_worker", level=logging.WARNING, collections=collections, snapshot=os.path.basename(snapshot_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the SEO engine API with several worker processes.")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: SERVE_WORKERS env or the number of CPUs).")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=None, help="Port (default: PORT env or 8000).")
+    parser.add_argument("--allow-chroma", action="store_true",
+                        help="Start several workers even if the snapshot has Chroma collections, each worker loads its own copy.")
+    args = parser.parse_args()
+
+    load_dotenv()
+    workers: int = args.workers or int(os.getenv('SERVE_WORKERS', os.cpu_count() or 1))
+    port: int = args.port or int(os.getenv('PORT', 8000))
+    if os.getenv('SERVE_ENGINE', 'serve:default_engine') == 'serve:default_engine':
+        if not (os.getenv('ANTHROPIC_API_KEY') and os.getenv('LLM_MODEL_NAME')):
+            print("VALIDATION ERROR: Please provide an API key and model name in env file")
+            sys.exit(1)
+        if workers > 1:
+            check_shared_snapshot(args.allow_chroma)
+    # The workers inherit the environment, so they all open the same cache files
+    os.environ.setdefault('RESPONSE_CACHE_PATH', DEFAULT_RESPONSE_CACHE_PATH)
+    os.environ.setdefault('EMBEDDING_CACHE_PATH', '.cache/embeddings.sqlite3')
+
+    import uvicorn
+
+    log_event("serve_starting", workers=workers, port=port, engine=os.getenv('SERVE_ENGINE', 'serve:default_engine'))
+    uvicorn.run("serve:create_app", factory=True, host=args.host, port=port, workers=workers,
+                app_dir=os.path.dirname(os.path.abspath(__file__)), log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
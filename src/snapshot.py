@@ -0,0 +1,135 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import json, os, shutil
+
+"""
+Versioned index snapshots written by ingest.py and opened by app.py.
+
+Layout:
+    <snapshot_dir>/
+    ├── LATEST                   # name of the snapshot the app serves
+    ├── 20241018T120000Z/        # one directory per build
+    │   ├── chroma.sqlite3 ...   # persisted Chroma collections
+    │   └── manifest.json        # sources, chunk counts, embedding model, build time
+    └── ...
+"""
+
+MANIFEST_FILE: str = "manifest.json"
+LATEST_FILE: str = "LATEST"
+
+
+def new_version() -> str:
+    """
+    Returns a new snapshot version name based on the current UTC time. Names sort in build order.
+
+    Returns:
+        str: Version name such as '20241018T120000Z'.
+    """
+    return datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def list_snapshots(snapshot_dir: str) -> List[str]:
+    """
+    Lists all complete snapshots (the ones that have a manifest), oldest first.
+
+    Args:
+        snapshot_dir (str): Directory that holds the snapshots.
+
+    Returns:
+        List[str]: Snapshot version names.
+    """
+    if not os.path.isdir(snapshot_dir):
+        return []
+    return sorted(
+        name for name in os.listdir(snapshot_dir)
+        if os.path.isfile(os.path.join(snapshot_dir, name, MANIFEST_FILE))
+    )
+
+
+def latest_snapshot(snapshot_dir: str) -> Optional[str]:
+    """
+    Returns the path of the active snapshot. This is the one named in LATEST, or the newest complete snapshot if LATEST is missing.
+
+    Args:
+        snapshot_dir (str): Directory that holds the snapshots.
+
+    Returns:
+        Optional[str]: Path of the snapshot directory, None if no snapshot was built yet.
+    """
+    latest_path = os.path.join(snapshot_dir, LATEST_FILE)
+    if os.path.isfile(latest_path):
+        with open(latest_path, 'r', encoding='utf-8') as file:
+            version = file.read().strip()
+        if os.path.isfile(os.path.join(snapshot_dir, version, MANIFEST_FILE)):
+            return os.path.join(snapshot_dir, version)
+
+    versions = list_snapshots(snapshot_dir)
+    return os.path.join(snapshot_dir, versions[-1]) if versions else None
+
+
+def activate_snapshot(snapshot_dir: str, version: str) -> None:
+    """
+    Points LATEST at the given snapshot. Used after a build and to roll back to an earlier index.
+    The pointer file is replaced atomically so a starting app never reads a half-written name.
+
+    Args:
+        snapshot_dir (str): Directory that holds the snapshots.
+        version (str): The snapshot version to serve.
+    """
+    if version not in list_snapshots(snapshot_dir):
+        raise ValueError(f"Snapshot '{version}' does not exist in {snapshot_dir}")
+
+    tmp_path = os.path.join(snapshot_dir, LATEST_FILE + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(version + '\n')
+    os.replace(tmp_path, os.path.join(snapshot_dir, LATEST_FILE))
+
+
+def prepare_snapshot(snapshot_dir: str, version: str, base: Optional[str] = None) -> str:
+    """
+    Creates the directory for a new snapshot. If a base snapshot is given its collections are copied in first,
+    so the build only has to embed chunks that changed since the base.
+
+    Args:
+        snapshot_dir (str): Directory that holds the snapshots.
+        version (str): Version name of the new snapshot.
+        base (Optional[str]): Path of a snapshot to start from.
+
+    Returns:
+        str: Path of the new snapshot directory.
+    """
+    path = os.path.join(snapshot_dir, version)
+    if os.path.exists(path):
+        raise ValueError(f"Snapshot '{version}' already exists in {snapshot_dir}")
+
+    if base:
+        shutil.copytree(base, path, ignore=shutil.ignore_patterns(MANIFEST_FILE))
+    else:
+        os.makedirs(path)
+    return path
+
+
+def write_manifest(path: str, manifest: Dict) -> None:
+    """
+    Writes the manifest of a snapshot. The manifest is written last, so a snapshot without one is an unfinished build.
+
+    Args:
+        path (str): Path of the snapshot directory.
+        manifest (Dict): Sources, chunk counts, embedding model and build time of the snapshot.
+    """
+    with open(os.path.join(path, MANIFEST_FILE), 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+
+
+def read_manifest(path: str) -> Dict:
+    """
+    Reads the manifest of a snapshot.
+
+    Args:
+        path (str): Path of the snapshot directory.
+
+    Returns:
+        Dict: The manifest.
+    """
+    with open(os.path.join(path, MANIFEST_FILE), 'r', encoding='utf-8') as file:
+        return json.load(file)
@@ -0,0 +1,77 @@
+from typing import Dict, List, Optional
+import os
+
+# Corpus used for RAG. Shared by the ingest CLI and the app so both build the index from the same sources.
+
+CSV_PATH: str = "files/organic_search.csv"
+
+PDF_LIST: List[str] = [
+    'files/34_Style.pdf',
+    'files/All_Style.pdf',
+    'files/DEI_Style.pdf',
+    'files/Sports_Style.pdf'
+]
+
+# Style guides that apply to every department, searched together with the department's own guide
+GENERAL_GUIDES: List[str] = ['All_Style.pdf', 'DEI_Style.pdf']
+
+# Own style guides of each department (lower-cased names as in the UI), chunks carry their guide as "guide" metadata
+DEPARTMENT_GUIDES: Dict[str, List[str]] = {
+    "34th street": ['34_Style.pdf'],
+    "dp sports": ['Sports_Style.pdf'],
+    "under the button": [],
+    "dp general": [],
+}
+
+URL_LIST: List[str] = [
+    'https://yoast.com/slug/',
+    'https://www.semrush.com/blog/what-is-a-url-slug/?kw=&cmp=US_SRCH_DSA_Blog_EN&label=dsa_pagefeed&Network=g&Device=c&kwid=dsa-2185834088336&cmpid=18348486859&agpid=156019556762&BU=Core&extid=97592280163&adpos=',
+    'https://www.upwork.com/resources/how-to-write-seo-content',
+    'https://authorservices.wiley.com/author-resources/Journal-Authors/Prepare/writing-for-seo.html',
+    'https://www.semrush.com/blog/seo-writing/',
+    'https://www.semrush.com/kb/839-how-to-write-seo-articles-four-steps',
+    'https://www.flowmatters.com/blog/a-practical-guide-on-how-to-write-seo-articles/',
+    'https://www.maropost.com/how-to-combine-seo-and-email-marketing-for-better-rankings/',
+    'https://www.webfx.com/seo/learn/email-marketing-tips-to-improve-seo/',
+    'https://sendgrid.com/en-us/blog/seo-and-email-marketing',
+    'https://www.emailonacid.com/blog/article/email-marketing/seo-connections/',
+    'https://coalitiontechnologies.com/blog/strategic-seo-tips-for-email-marketing',
+    'https://optinmonster.com/101-email-subject-lines-your-subscribers-cant-resist/',
+    'https://www.wordstream.com/blog/ws/2014/03/31/email-subject-lines',
+    'https://www.constantcontact.com/blog/good-email-subject-lines/',
+    'https://blog.hubspot.com/marketing/best-email-subject-lines-list',
+    'https://www.google.com/search/howsearchworks/how-search-works/ranking-results/#:~:text=To%20give%20you%20the%20most,the%20nature%20of%20your%20query.',
+    'https://www.semrush.com/blog/google-search-algorithm/',
+    'https://www.seomechanic.com/google-search-algorithm-work/',
+    'https://developers.google.com/search/docs/fundamentals/how-search-works',
+    'https://ahrefs.com/blog/google-search-algorithm/',
+    'https://www.shopify.com/blog/google-algorithm',
+    'https://www.webfx.com/seo/glossary/what-is-a-google-algorithm/',
+    'https://www.purplepublish.com/en/blog/seo-for-publishers',
+    'https://www.webceo.com/blog/how-to-do-seo-for-news-websites/',
+    'https://www.stanventures.com/blog/seo-for-journalist/',
+    'https://blog.replug.io/what-is-a-url-slug-and-how-to-optimize-it/'
+]
+
+TAG_PATH: str = "files/final_tags.txt"
+
+
+def guide_name(source: str) -> str:
+    """
+    Returns the guide name stored with the chunks of a style guide PDF, e.g. "Sports_Style.pdf" for files/Sports_Style.pdf.
+    """
+    return os.path.basename(source)
+
+
+def guides_for(dept: Optional[str]) -> Optional[List[str]]:
+    """
+    Returns the style guides searched for a department: its own guides and the general ones.
+
+    Args:
+        dept (Optional[str]): The department as chosen in the UI, e.g. "DP Sports".
+
+    Returns:
+        Optional[List[str]]: Guide names, None if the department is unknown (every guide is searched).
+    """
+    own: Optional[List[str]] = DEPARTMENT_GUIDES.get((dept or "").strip().lower())
+    return None if own is None else own + GENERAL_GUIDES
@@ -0,0 +1,109 @@
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from tokens import estimate_tokens
+from typing import Any, AsyncIterator, Iterator, List, Optional
+import asyncio, hashlib, re, time
+import numpy as np
+
+"""
+Deterministic local stand-ins for NomicEmbeddings and ChatAnthropic, used by the offline benchmarks and the tests.
+Neither needs a key or the network, and the same input always gives the same output.
+"""
+
+# A reply in the format the prompt asks for, about as long as a real one
+CANNED_RESPONSE: str = """Title Comments: The title is clear but long for search results.
+-> comments for the inputted title: Put the main keyword first and keep it under 60 characters, per the SEO tips. Use the Wharton School on first reference (DP Style Guide).
+---
+URL SLUG:
+penn-wharton-dining-hall-hours
+-> reasons for the suggested URL slug: short, lowercase, hyphens between words and the main keyword first.
+---
+Suggested TAGS: Wharton, Dining, Student Life
+-> reasons for the suggested tags: previously-used tags that match the topic of the article.
+---
+Answer to the question:
+Lead with the news and the keyword in the first paragraph.
+-> reasons for the answer: the SEO context recommends keywords early in the article."""
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Embeds texts as hashed bags of words: every word adds +1 or -1 to one of `size` dimensions, then the vector is
+    L2-normalized. Texts that share words are similar, so retrieval behaves sensibly, and embedding costs microseconds.
+    """
+
+    def __init__(self, size: int = 768):
+        """
+        Args:
+            size (int): Number of dimensions (Nomic's is 768).
+        """
+        self.size = size
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.size, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            digest = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'big')
+            vector[digest % self.size] += 1.0 if digest >> 63 else -1.0
+        norm = float(np.linalg.norm(vector))
+        return (vector / norm if norm else vector).tolist()
+
+
+class StubChatModel(BaseChatModel):
+    """
+    Chat model that answers every prompt with a canned response, streamed word by word. The delays simulate the time
+    to the first token and the generation speed of a real model. Usage metadata is reported like ChatAnthropic does.
+    """
+
+    response: str = CANNED_RESPONSE
+    # Seconds before the first token and between two tokens
+    first_token_delay: float = 0.0
+    token_delay: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub-chat"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        tokens: List[str] = self._tokens()
+        time.sleep(self.first_token_delay + self.token_delay * max(len(tokens) - 1, 0))
+        message = AIMessage(content=self.response, usage_metadata=self._usage(messages))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        for i, token in enumerate(self._tokens()):
+            time.sleep(self.token_delay if i else self.first_token_delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(messages)))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        for i, token in enumerate(self._tokens()):
+            await asyncio.sleep(self.token_delay if i else self.first_token_delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(messages)))
+
+    def _tokens(self) -> List[str]:
+        # Words with their trailing whitespace, joined they give the response back
+        return re.findall(r"\S+\s*|\s+", self.response)
+
+    def _usage(self, messages: List[BaseMessage]) -> dict:
+        input_tokens: int = sum(estimate_tokens(str(message.content)) for message in messages)
+        output_tokens: int = estimate_tokens(self.response)
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
@@ -0,0 +1,255 @@
+from bisect import bisect_left
+from collections import defaultdict
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+import hashlib, json, os, re
+import numpy as np
+
+"""
+In-process index of previously-used tags, replacing the Chroma tag_collection.
+
+All tag vectors live in one contiguous, L2-normalized float32 matrix that is saved next to the tag file
+(final_tags.npy + final_tags.json) and memory-mapped on load. Top-k is a single matrix-vector product, and a
+prefix index plus a character trigram index give exact and fuzzy lexical matches without any embedding call.
+The tags are only embedded again when the tag file or the embedding model changes.
+"""
+
+
+def _trigrams(text: str) -> Set[str]:
+    padded = f"  {text.lower()} "
+    return {padded[i : i+3] for i in range(len(padded) - 2)}
+
+
+class TagIndex:
+    """
+    Dense + lexical index over a list of tags.
+    """
+
+    def __init__(self, tags: List[str], vectors: np.ndarray, embeddings: Optional[Embeddings] = None):
+        """
+        Args:
+            tags (List[str]): The tags, row i of vectors belongs to tags[i].
+            vectors (np.ndarray): L2-normalized float32 matrix of shape (len(tags), dim). May be memory-mapped.
+            embeddings (Optional[Embeddings]): Embeds queries for retrievers that are not given a vector.
+        """
+        self.tags = tags
+        self.vectors = vectors
+        self.embeddings = embeddings
+
+        # Lexical indexes: lower-cased exact lookup, sorted list for prefix search, trigram postings for fuzzy search
+        self._exact: Dict[str, int] = {}
+        for i, tag in enumerate(tags):
+            self._exact.setdefault(tag.lower(), i)
+        self._sorted: List[Tuple[str, int]] = sorted((tag.lower(), i) for i, tag in enumerate(tags))
+        self._sorted_keys: List[str] = [key for key, _ in self._sorted]
+        postings: Dict[str, List[int]] = defaultdict(list)
+        self._gram_counts = np.zeros(len(tags), dtype=np.int32)
+        for i, tag in enumerate(tags):
+            grams = _trigrams(tag)
+            self._gram_counts[i] = len(grams)
+            for gram in grams:
+                postings[gram].append(i)
+        self._trigrams: Dict[str, np.ndarray] = {gram: np.asarray(ids, dtype=np.int32) for gram, ids in postings.items()}
+        self._max_words: int = max((len(tag.split()) for tag in tags), default=0)
+
+    @classmethod
+    def load_or_build(cls, tag_path: str, embeddings: Embeddings, model: str, index_dir: Optional[str] = None,
+                      batch_size: int = 1000) -> "TagIndex":
+        """
+        Loads the saved tag index, or embeds the tags and saves the index if the tag file or the model changed.
+
+        Args:
+            tag_path (str): Text file with one tag per line.
+            embeddings (Embeddings): Embedding function for the tags and the queries.
+            model (str): Name of the embedding model, a saved index for another model is rebuilt.
+            index_dir (Optional[str]): Directory for the index files (tags.npy, tags.json). Next to the tag file if None.
+            batch_size (int): Number of tags embedded per call when building.
+
+        Returns:
+            TagIndex: The tag index.
+        """
+        if index_dir:
+            matrix_path, meta_path = os.path.join(index_dir, "tags.npy"), os.path.join(index_dir, "tags.json")
+        else:
+            base = os.path.splitext(tag_path)[0]
+            matrix_path, meta_path = base + ".npy", base + ".json"
+
+        with open(tag_path, 'rb') as file:
+            source_hash: str = hashlib.sha256(file.read()).hexdigest()
+
+        if os.path.isfile(matrix_path) and os.path.isfile(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as file:
+                meta = json.load(file)
+            if meta.get("model") == model and meta.get("source_hash") == source_hash:
+                return cls(meta["tags"], np.load(matrix_path, mmap_mode='r'), embeddings)
+
+        tags: List[str] = []
+        with open(tag_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                tag = line.strip()
+                if tag:
+                    tags.append(tag)
+
+        vectors = np.zeros((len(tags), 0), dtype=np.float32)
+        if tags:
+            vectors = np.concatenate([
+                np.asarray(embeddings.embed_documents(tags[i : i+batch_size]), dtype=np.float32)
+                for i in range(0, len(tags), batch_size)
+            ])
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        # Both files are replaced atomically, the metadata last, so a reader never maps a half-written matrix
+        os.makedirs(os.path.dirname(matrix_path) or '.', exist_ok=True)
+        tmp_path = f"{matrix_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            np.save(file, vectors)
+        os.replace(tmp_path, matrix_path)
+        tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({"model": model, "source_hash": source_hash, "tags": tags}, file)
+        os.replace(tmp_path, meta_path)
+        return cls(tags, np.load(matrix_path, mmap_mode='r'), embeddings)
+
+    @classmethod
+    def load(cls, index_dir: str, embeddings: Optional[Embeddings] = None) -> "TagIndex":
+        """
+        Loads a tag index saved in a directory (e.g. an index snapshot) as it is, without checking the tag file.
+
+        Args:
+            index_dir (str): Directory with tags.npy and tags.json.
+            embeddings (Optional[Embeddings]): Embeds queries for retrievers that are not given a vector.
+
+        Returns:
+            TagIndex: The tag index.
+        """
+        with open(os.path.join(index_dir, "tags.json"), 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        return cls(meta["tags"], np.load(os.path.join(index_dir, "tags.npy"), mmap_mode='r'), embeddings)
+
+    def search(self, vector: List[float], k: int = 4) -> List[Tuple[str, float]]:
+        """
+        Returns the k tags most similar to a query vector.
+
+        Args:
+            vector (List[float]): The query embedding.
+            k (int): Number of tags to return.
+
+        Returns:
+            List[Tuple[str, float]]: Tags and their cosine similarity, most similar first.
+        """
+        return self.search_many([vector], k)[0]
+
+    def search_many(self, vectors: List[List[float]], k: int = 4) -> List[List[Tuple[str, float]]]:
+        """
+        Same as search for several query vectors, scored with a single matrix product.
+
+        Args:
+            vectors (List[List[float]]): The query embeddings.
+            k (int): Number of tags to return per query.
+
+        Returns:
+            List[List[Tuple[str, float]]]: Tags and their cosine similarity for each query, most similar first.
+        """
+        if not self.tags or k <= 0 or not len(vectors):
+            return [[] for _ in vectors]
+        queries = np.asarray(vectors, dtype=np.float32)
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        scores = queries @ self.vectors.T
+        k = min(k, len(self.tags))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results: List[List[Tuple[str, float]]] = []
+        for row, candidates in zip(scores, top):
+            candidates = candidates[np.argsort(-row[candidates])]
+            results.append([(self.tags[i], float(row[i])) for i in candidates])
+        return results
+
+    def prefix(self, prefix: str, limit: int = 10) -> List[str]:
+        """
+        Returns tags that start with the given text (case-insensitive), in alphabetical order.
+        """
+        prefix = prefix.lower()
+        position = bisect_left(self._sorted_keys, prefix)
+        matches: List[str] = []
+        while position < len(self._sorted) and len(matches) < limit and self._sorted_keys[position].startswith(prefix):
+            matches.append(self.tags[self._sorted[position][1]])
+            position += 1
+        return matches
+
+    def fuzzy(self, term: str, limit: int = 10, min_similarity: float = 0.5) -> List[Tuple[str, float]]:
+        """
+        Returns tags that are spelled similarly to the term, by Jaccard similarity of character trigrams.
+
+        Args:
+            term (str): The (possibly misspelled) tag.
+            limit (int): Maximum number of tags to return.
+            min_similarity (float): Minimum trigram similarity.
+
+        Returns:
+            List[Tuple[str, float]]: Tags and their similarity, most similar first.
+        """
+        grams = _trigrams(term)
+        hits = [self._trigrams[gram] for gram in grams if gram in self._trigrams]
+        if not hits:
+            return []
+        shared = np.bincount(np.concatenate(hits), minlength=len(self.tags))
+        similarity = shared / (len(grams) + self._gram_counts - shared)
+        candidates = np.flatnonzero(similarity >= min_similarity)
+        candidates = candidates[np.argsort(-similarity[candidates], kind="stable")][:limit]
+        return [(self.tags[i], float(similarity[i])) for i in candidates]
+
+    def find_in_text(self, text: str) -> List[str]:
+        """
+        Returns the tags mentioned word for word in a text (case-insensitive), in order of appearance.
+
+        Args:
+            text (str): E.g. the article title and content.
+
+        Returns:
+            List[str]: The tags found in the text.
+        """
+        words: List[str] = re.findall(r"[\w'&.-]+", text.lower())
+        found: Dict[int, None] = {}
+        for start in range(len(words)):
+            for length in range(1, min(self._max_words, len(words) - start) + 1):
+                i = self._exact.get(" ".join(words[start : start+length]))
+                if i is not None:
+                    found.setdefault(i)
+        return [self.tags[i] for i in found]
+
+    def as_retriever(self, k: int = 4) -> "TagRetriever":
+        return TagRetriever(index=self, k=k)
+
+
+class TagRetriever(BaseRetriever):
+    """
+    Retriever over a TagIndex. Returns tags mentioned verbatim in the article first, then the most similar tags.
+    The article (title and content) is passed apart from the query, whose prompt wording ("student", "writing") would
+    otherwise match tags on every request; without it, nothing is matched verbatim.
+    Documents look like the ones of the old tag_collection: the tag as page_content and {"tag": tag} as metadata.
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    index: Any
+    k: int = 4
+
+    def search_by_vector(self, query: str, vector: List[float], article: Optional[str] = None) -> List[Document]:
+        return self.search_by_vectors([query], [vector], [article])[0]
+
+    def search_by_vectors(self, queries: List[str], vectors: List[List[float]],
+                          articles: Optional[List[Optional[str]]] = None) -> List[List[Document]]:
+        results: List[List[Document]] = []
+        for article, similar in zip(articles or [None] * len(queries), self.index.search_many(vectors, self.k)):
+            tags: Dict[str, None] = dict.fromkeys(self.index.find_in_text(article)[: self.k] if article else [])
+            for tag, _ in similar:
+                if len(tags) >= self.k:
+                    break
+                tags.setdefault(tag)
+            results.append([Document(page_content=tag, metadata={"tag": tag}) for tag in tags])
+        return results
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.search_by_vector(query, self.index.embeddings.embed_query(query))
@@ -0,0 +1,19 @@
+import re, unicodedata
+from typing import Optional
+
+"""
+Text normalization shared by the response cache (exact-match keys) and the tag cleaner (tag deduplication).
+"""
+
+
+def normalize(text: Optional[str]) -> str:
+    """
+    Normalizes a field for the exact-match key: unicode NFKC, lower case and collapsed whitespace.
+
+    Args:
+        text (Optional[str]): The field entered by the editor.
+
+    Returns:
+        str: The normalized field.
+    """
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', text or '')).strip().casefold()
@@ -1,6 +1,6 @@
 from langchain.text_splitter import CharacterTextSplitter
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from typing import List
+from typing import Iterable, Iterator, List
 from langchain_core.documents import Document
 
 
@@ -36,19 +36,40 @@ def recursive_splitter(data_list: List[Document]) -> List[Document]:
     Returns:
         List[Document]: A list of documents split into smaller chunks.
     """
+    return list(lazy_recursive_splitter(data_list))
+
+def lazy_recursive_splitter(data_list: Iterable[Document]) -> Iterator[Document]:
+    """
+    Same as recursive_splitter but splits one document at a time as they arrive, so it can sit between
+    a streaming loader and the vector store without holding all documents or chunks in memory.
+
+    Args:
+        data_list (Iterable[Document]): Documents to be split, e.g. a loader generator.
+
+    Yields:
+        Document: Chunks of the documents, in input order.
+    """
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=2000, chunk_overlap=100
     )
-    return text_splitter.split_documents(data_list)
+    for doc in data_list:
+        yield from text_splitter.split_documents([doc])
 
 def txt_to_documents(file_path: str) -> List[Document]:
-    documents = []
-    
+    return list(iter_txt_documents(file_path))
+
+def iter_txt_documents(file_path: str) -> Iterator[Document]:
+    """
+    Yields one Document per non-empty line of a text file (used for the tag file), with the line as 'tag' metadata.
+
+    Args:
+        file_path (str): The path to the text file.
+
+    Yields:
+        Document: One document per line.
+    """
     with open(file_path, 'r') as file:
         for line in file:
             tag = line.strip()
             if tag:
-                doc = Document(page_content=tag, metadata={"tag": tag})
-                documents.append(doc)   
-
-    return documents
+                yield Document(page_content=tag, metadata={"tag": tag})
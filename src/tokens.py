@@ -0,0 +1,19 @@
+import math
+
+# Claude doesn't ship a local tokenizer. English prose averages about 4 characters per token,
+# which is close enough for budgeting batches and prompt sections.
+CHARS_PER_TOKEN: float = 4.0
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of LLM tokens in a text.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: Estimated number of tokens (at least 1 for non-empty text).
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
@@ -1,6 +1,19 @@
 import gradio as gr
+from typing import Callable, Optional, Tuple
 
-def create_ui(chat_fn):
+def create_ui(chat_fn, concurrency_limit: int = 16, status_fn: Optional[Callable[[], Tuple[str, bool]]] = None):
+    """
+    Creates the Gradio UI.
+
+    Args:
+        chat_fn: Handler for the SEND button. Can be an async generator that yields partial chat histories to stream the response.
+        concurrency_limit (int): Maximum number of chat requests processed at the same time, the rest wait in the queue.
+        status_fn (Optional[Callable[[], Tuple[str, bool]]]): Returns a status line (e.g. "warming up") and whether it is final.
+            The line is shown under the header and polled every second until it is final.
+
+    Returns:
+        gr.Blocks: The UI, with its request queue enabled.
+    """
     theme = gr.themes.Base(
         primary_hue="red",
         secondary_hue="red",
@@ -10,6 +23,16 @@ def create_ui(chat_fn):
     with gr.Blocks(theme=theme, title="DP SEO Optimizer") as demo:
         gr.Markdown("<h1><center>The Daily Pennsylvanian SEO Optimizer</center></h1>")
         gr.Markdown("<div style='text-align: center;'>A project created by DP Business Analytics</div>")
+        if status_fn is not None:
+            # Evaluated on every page load, then refreshed by the timer until startup finished
+            status = gr.Markdown(lambda: status_fn()[0])
+            timer = gr.Timer(1.0)
+
+            def poll_status():
+                text, final = status_fn()
+                return text, gr.Timer(active=not final)
+
+            timer.tick(poll_status, outputs=[status, timer], queue=False)
 
         chatbot = gr.Chatbot()
         title = gr.Textbox(placeholder="Insert article title here", label="Article Title")
@@ -23,8 +46,10 @@ def create_ui(chat_fn):
         reset_chat = gr.Button("RESET CHAT HISTORY")
         gr.Markdown("<a href = 'https://forms.gle/GWXTSeykKMPHm6DY9'><center>Submit Bugs or Feedback Here!</a>")
 
-        submit.click(chat_fn, inputs=[input_box, dept, title, content, state], outputs=[chatbot, state, input_box, dept, title, content])
+        submit.click(chat_fn, inputs=[input_box, dept, title, content, state], outputs=[chatbot, state, input_box, dept, title, content],
+                     concurrency_limit=concurrency_limit)
         clear.click(lambda: ([], None, None, None, [], []), inputs=None, outputs=[chatbot, input_box, dept, title, content, state], queue=False)
         reset_chat.click(lambda: ([]), inputs=None, outputs=[chatbot], queue=False)
 
+    demo.queue(default_concurrency_limit=concurrency_limit)
     return demo
@@ -1,47 +1,355 @@
 from langchain_chroma import Chroma
-from langchain_nomic import NomicEmbeddings
-from langchain_core.vectorstores import VectorStoreRetriever
+import chromadb
+from langchain_core.vectorstores import VectorStore, VectorStoreRetriever
+from langchain_core.embeddings import Embeddings
 from langchain_core.documents import Document
-from langchain.retrievers import ContextualCompressionRetriever
-from langchain.retrievers.document_compressors import CohereRerank
-from typing import List, Optional
-import os
+from embedding_cache import CachedEmbeddings
+from bm25 import BM25Index, HybridRetriever, bm25_path, build_bm25_index
+from reranker import RerankedRetriever, get_reranker
+from dedup import Deduplicator
+from quantized_store import QuantizedVectorStore, build_quantized_store, quantized_path
+from metrics import log_event
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from functools import lru_cache
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import hashlib, json, os, shutil
 
+# Name of the embedding model. It is part of every chunk id so switching models re-embeds everything.
+EMBEDDING_MODEL: str = "nomic-embed-text-v1"
 
-def create_vector_store(documents: List[Document], collection_name: str, k_pre: Optional[int] = None, k_post: Optional[int] = None) -> VectorStoreRetriever:
+
+def nomic_login() -> None:
+    """
+    Logs in to the Nomic embedding API with NOMIC_LOGIN_KEY from the environment. Runs in-process (the same call
+    `nomic login` makes), an API key (nk-...) is stored without a network round trip.
+
+    Raises:
+        EnvironmentError: If the key is missing or invalid.
+    """
+    nomic_login_key = os.getenv('NOMIC_LOGIN_KEY')
+    if not nomic_login_key:
+        raise EnvironmentError("Nomic login key not found in env file. Please provide a login key to use Nomic vector embeddings")
+    # Imported here, the nomic package takes close to a second to import
+    import nomic
+    try:
+        nomic.login(nomic_login_key)
+    except Exception as e:
+        raise EnvironmentError("Nomic login key is invalid. Please provide a valid login key to use Nomic vector embeddings") from e
+
+
+@lru_cache(maxsize=None)
+def get_embeddings() -> Embeddings:
+    """
+    Returns the embedding function used for every collection. It is created once and shared, so ingestion and
+    all retrievers go through the same embedding cache (memory LRU + SQLite file at EMBEDDING_CACHE_PATH).
+
+    Returns:
+        Embeddings: Cached Nomic embedding model named by EMBEDDING_MODEL.
+    """
+    from langchain_nomic import NomicEmbeddings
+
+    return CachedEmbeddings(
+        NomicEmbeddings(model=EMBEDDING_MODEL),
+        model=EMBEDDING_MODEL,
+        path=os.getenv('EMBEDDING_CACHE_PATH', '.cache/embeddings.sqlite3'),
+    )
+
+
+def document_id(document: Document, model: str = EMBEDDING_MODEL) -> str:
+    """
+    Computes a stable id for a chunk from its content, metadata and the embedding model.
+    The same chunk embedded with the same model always gets the same id, so it only has to be embedded once.
+
+    Args:
+        document (Document): The chunk to identify.
+        model (str): The name of the embedding model used for the chunk.
+
+    Returns:
+        str: sha256 hex digest of the chunk and model.
+    """
+    payload = json.dumps(
+        {"model": model, "text": document.page_content, "metadata": document.metadata},
+        sort_keys=True, default=str
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get_max_batch_size(vectorstore: Chroma) -> int:
+    """
+    Asks Chroma for the maximum number of records it accepts in one call (depends on the SQLite build, e.g. 166 on some machines).
+    Larger batches throw ValueError: Batch size 1573 exceeds maximum batch size 166.
+
+    Args:
+        vectorstore (Chroma): The vector store.
+
+    Returns:
+        int: The maximum batch size.
+    """
+    return vectorstore._client.get_max_batch_size()
+
+
+def sync_documents(vectorstore: Chroma, documents: Iterable[Document], batch_size: Optional[int] = None, max_pending: int = 4) -> Tuple[int, int]:
+    """
+    Makes the collection contain exactly the given documents. Only documents whose content hash is not
+    already stored are embedded, and stored documents that are no longer in the stream are deleted.
+
+    Documents are consumed lazily. Batches of new documents are embedded on one background thread and upserted on another,
+    so loading/splitting, embedding and upserting overlap. At most max_pending batches wait at each stage, which bounds memory.
+
+    Args:
+        vectorstore (Chroma): The vector store to update.
+        documents (Iterable[Document]): The full, current stream of documents for this collection.
+        batch_size (Optional[int]): Documents embedded and upserted per call. Defaults to Chroma's maximum batch size.
+        max_pending (int): Maximum number of batches in flight per stage.
+
+    Returns:
+        Tuple[int, int]: Number of documents added and number of documents deleted.
+    """
+    batch_size = batch_size or get_max_batch_size(vectorstore)
+    embeddings: Embeddings = vectorstore.embeddings
+    existing_ids: Set[str] = set(vectorstore.get(include=[])["ids"])
+    seen_ids: Set[str] = set()
+    added: int = 0
+
+    def new_documents() -> Iterator[Tuple[str, Document]]:
+        for doc in documents:
+            doc_id: str = document_id(doc)
+            # Identical chunks share an id, keep the first one only
+            if doc_id in seen_ids:
+                continue
+            seen_ids.add(doc_id)
+            if doc_id not in existing_ids:
+                yield doc_id, doc
+
+    with ThreadPoolExecutor(max_workers=1) as embed_pool, ThreadPoolExecutor(max_workers=1) as upsert_pool:
+        embedding: Deque[Tuple[List[str], List[Document], Future]] = deque()
+        upserting: Deque[Future] = deque()
+
+        def drain(limit: int) -> None:
+            # Hand finished embeddings to the upsert thread, waiting while too many batches are in flight
+            while len(embedding) > limit:
+                ids, docs, vectors = embedding.popleft()
+                upserting.append(upsert_pool.submit(_upsert, vectorstore, ids, docs, vectors.result()))
+                while len(upserting) > limit:
+                    upserting.popleft().result()
+
+        batch: List[Tuple[str, Document]] = []
+        for item in new_documents():
+            batch.append(item)
+            if len(batch) == batch_size:
+                embedding.append(_submit_embedding(embed_pool, embeddings, batch))
+                added += len(batch)
+                batch = []
+                drain(max_pending)
+        if batch:
+            embedding.append(_submit_embedding(embed_pool, embeddings, batch))
+            added += len(batch)
+        drain(0)
+        while upserting:
+            upserting.popleft().result()
+
+    stale_ids: List[str] = list(existing_ids - seen_ids)
+    for i in range(0, len(stale_ids), batch_size):
+        vectorstore.delete(ids=stale_ids[i : i+batch_size])
+
+    return added, len(stale_ids)
+
+
+def _submit_embedding(pool: ThreadPoolExecutor, embeddings: Embeddings, batch: List[Tuple[str, Document]]) -> Tuple[List[str], List[Document], Future]:
+    ids: List[str] = [doc_id for doc_id, _ in batch]
+    docs: List[Document] = [doc for _, doc in batch]
+    return ids, docs, pool.submit(embeddings.embed_documents, [doc.page_content for doc in docs])
+
+
+def _upsert(vectorstore: Chroma, ids: List[str], docs: List[Document], vectors: List[List[float]]) -> None:
+    vectorstore._collection.upsert(
+        ids=ids,
+        embeddings=vectors,
+        documents=[doc.page_content for doc in docs],
+        # Chroma rejects empty metadata dicts but accepts None
+        metadatas=[doc.metadata or None for doc in docs],
+    )
+
+
+def create_vector_store(documents: Iterable[Document], collection_name: str, k_pre: Optional[int] = None, k_post: Optional[int] = None,
+                        persist_directory: Optional[str] = None, hybrid: bool = False,
+                        embeddings: Optional[Embeddings] = None, dedup: Optional[Deduplicator] = None,
+                        quantized: bool = False) -> VectorStoreRetriever:
     """
     Creates a vector store from a list of documents and returns a retriever for querying the store.
     Documentation for Chroma: https://python.langchain.com/docs/integrations/vectorstores/chroma/
 
+    If persist_directory is given the collection is kept on disk and reused on the next start. Each chunk is
+    stored under a content hash, so only new or changed chunks are embedded and chunks whose source was removed are deleted.
+
+    With hybrid=True a BM25 index of the collection is built as well (and saved next to it if persist_directory is given),
+    and the retriever fuses lexical and dense rankings.
+
+    With quantized=True the collection is also compiled into an int8 IVF index (quantized_store.py) next to it, and the
+    retriever searches that index instead of Chroma. Chroma stays the source for the next incremental build.
+
     Args:
-        documents (List[Document]): A list of documents to be stored in the vector store.
+        documents (Iterable[Document]): Documents to be stored in the vector store. Can be a generator, it is consumed lazily.
         collection_name (str): The name of the collection to be created in the vector store.
         k_pre (Optional[int]): The number of documents that the vector store should retrieve before any post-processing.
         k_pre (bool): The number of documents that should be left after any post-processing.
+        persist_directory (Optional[str]): Directory for a persistent index. In-memory index if None.
+        hybrid (bool): Fuse BM25 and dense search instead of dense search only.
+        embeddings (Optional[Embeddings]): Embedding function, get_embeddings() if None (e.g. stubs.HashEmbeddings in benchmarks).
+        dedup (Optional[Deduplicator]): Drops near-duplicate chunks before they are embedded. The kept chunks get the
+            sources of their duplicates as metadata.
+        quantized (bool): Serve the collection from a quantized index. Needs persist_directory.
 
     Returns:
         VectorStoreRetriever: A retriever object for querying the vector store.
+
+    Raises:
+        ValueError: If quantized is set without a persist_directory.
     """
+    if quantized and not persist_directory:
+        raise ValueError("A quantized index needs a persist_directory")
 
     vectorstore = Chroma(
         collection_name=collection_name,
-        embedding_function=NomicEmbeddings(model="nomic-embed-text-v1"),
+        embedding_function=embeddings or get_embeddings(),
+        persist_directory=persist_directory,
+        collection_metadata={"embedding_model": EMBEDDING_MODEL},
     )
-    
-    # Maximum batch size otherwise throws error in site-packages\chromadb\api\types.py", line 571, in validate_batch
-    # --> raise ValueError(ValueError: Batch size 1573 exceeds maximum batch size 166)
-    batch_size: int = 166
-    for i in range(0, len(documents), batch_size):
-        batch_docs: List[Document] = documents[i : i+batch_size]
-        vectorstore.add_documents(batch_docs)
-    
+
+    if dedup is not None:
+        documents = dedup.filter(documents, document_id)
+    added, deleted = sync_documents(vectorstore, documents)
+    log_event("collection_synced", collection=collection_name, embedded=added, deleted=deleted)
+    if dedup is not None:
+        provenance: Dict[str, Dict[str, Any]] = dedup.provenance()
+        # Chunks of an earlier build whose duplicates are gone lose their provenance
+        for doc_id in vectorstore._collection.get(where={"duplicates": {"$gt": 0}}, include=[])["ids"]:
+            provenance.setdefault(doc_id, {"duplicate_sources": "", "duplicates": 0})
+        update_metadata(vectorstore, provenance)
+        dedup.report(collection_name)
+
+    bm25: Optional[BM25Index] = None
+    if hybrid:
+        bm25 = build_bm25_index(vectorstore)
+        if persist_directory:
+            bm25.save(bm25_path(persist_directory, collection_name))
+    elif persist_directory and os.path.isfile(bm25_path(persist_directory, collection_name)):
+        # A BM25 index left from an earlier hybrid build would no longer match the collection
+        os.remove(bm25_path(persist_directory, collection_name))
+
+    if quantized:
+        meta = build_quantized_store(vectorstore, quantized_path(persist_directory, collection_name))
+        log_event("quantized_index_built", collection=collection_name, count=meta["count"], nlist=meta["nlist"])
+        return _as_retriever(QuantizedVectorStore.load(quantized_path(persist_directory, collection_name), vectorstore.embeddings),
+                             k_pre, k_post, bm25)
+    if persist_directory and os.path.isdir(quantized_path(persist_directory, collection_name)):
+        # Same for a quantized index of an earlier build
+        shutil.rmtree(quantized_path(persist_directory, collection_name))
+
+    return _as_retriever(vectorstore, k_pre, k_post, bm25)
+
+
+def open_vector_store(persist_directory: str, collection_name: str, k_pre: Optional[int] = None, k_post: Optional[int] = None,
+                      hybrid: Optional[bool] = None, quantized: Optional[bool] = None) -> VectorStoreRetriever:
+    """
+    Opens a collection of an index that was already built (e.g. by ingest.py) and returns a retriever for it.
+    Nothing is loaded or embedded, the collection is used as it is on disk.
+
+    Args:
+        persist_directory (str): Directory of the persisted index.
+        collection_name (str): The name of the collection to open.
+        k_pre (Optional[int]): The number of documents that the vector store should retrieve before any post-processing.
+        k_post (Optional[int]): The number of documents that should be left after any post-processing.
+        hybrid (Optional[bool]): Fuse BM25 and dense search. If None, hybrid whenever the collection has a saved BM25 index.
+        quantized (Optional[bool]): Search the quantized index instead of Chroma, which is then not opened at all.
+            If None, quantized whenever the collection has one.
+
+    Returns:
+        VectorStoreRetriever: A retriever object for querying the vector store.
+    """
+    path: str = bm25_path(persist_directory, collection_name)
+    if hybrid is None:
+        hybrid = os.path.isfile(path)
+    if quantized is None:
+        quantized = os.path.isdir(quantized_path(persist_directory, collection_name))
+    if quantized:
+        vectorstore = QuantizedVectorStore.load(quantized_path(persist_directory, collection_name), get_embeddings())
+        return _as_retriever(vectorstore, k_pre, k_post, BM25Index.load(path) if hybrid else None)
+
+    vectorstore = Chroma(
+        collection_name=collection_name,
+        embedding_function=get_embeddings(),
+        persist_directory=persist_directory,
+    )
+    return _as_retriever(vectorstore, k_pre, k_post, BM25Index.load(path) if hybrid else None)
+
+
+def update_metadata(vectorstore: Chroma, metadatas: Dict[str, Dict[str, Any]], batch_size: Optional[int] = None) -> None:
+    """
+    Adds metadata fields to stored chunks, other fields are kept. Chunk ids don't change, so nothing is embedded again.
+
+    Args:
+        vectorstore (Chroma): The vector store.
+        metadatas (Dict[str, Dict[str, Any]]): Chunk id -> fields to set.
+        batch_size (Optional[int]): Chunks updated per call. Defaults to Chroma's maximum batch size.
+    """
+    ids: List[str] = list(metadatas)
+    batch_size = batch_size or get_max_batch_size(vectorstore)
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i : i+batch_size]
+        vectorstore._collection.update(ids=batch, metadatas=[metadatas[doc_id] for doc_id in batch])
+
+
+def delete_collection(persist_directory: str, collection_name: str) -> bool:
+    """
+    Deletes a collection of a persisted index if it exists, e.g. one that was replaced by another kind of index.
+
+    Args:
+        persist_directory (str): Directory of the persisted index.
+        collection_name (str): The name of the collection.
+
+    Returns:
+        bool: Whether the collection existed.
+    """
+    try:
+        chromadb.PersistentClient(path=persist_directory).delete_collection(collection_name)
+    except ValueError:
+        # Raised for an unknown collection
+        return False
+    path: str = bm25_path(persist_directory, collection_name)
+    if os.path.isfile(path):
+        os.remove(path)
+    shutil.rmtree(quantized_path(persist_directory, collection_name), ignore_errors=True)
+    return True
+
+
+def _as_retriever(vectorstore: VectorStore, k_pre: Optional[int], k_post: Optional[int], bm25: Optional[BM25Index] = None) -> VectorStoreRetriever:
+    """
+    Wraps a vector store in a retriever with optional k, optional BM25 fusion and optional reranking
+    (local by default, Cohere with RERANKER=cohere).
+
+    Args:
+        vectorstore (VectorStore): The vector store to retrieve from, Chroma or QuantizedVectorStore.
+        k_pre (Optional[int]): The number of documents that the vector store should retrieve before any post-processing.
+        k_post (Optional[int]): The number of documents that should be left after any post-processing.
+        bm25 (Optional[BM25Index]): BM25 index of the collection, hybrid retrieval if given.
+
+    Returns:
+        VectorStoreRetriever: A retriever object for querying the vector store.
+    """
     # Create retrieval with optional k param, k determines how many documents are retrieved
-    if k_pre is not None:
-        retriever : VectorStoreRetriever = vectorstore.as_retriever(search_kwargs={"k": k_pre})
+    search_kwargs = {"k": k_pre} if k_pre is not None else {}
+    if bm25 is not None:
+        retriever : VectorStoreRetriever = HybridRetriever(vectorstore=vectorstore, bm25=bm25, search_kwargs=search_kwargs)
     else:
-        retriever : VectorStoreRetriever = vectorstore.as_retriever()
+        retriever : VectorStoreRetriever = vectorstore.as_retriever(search_kwargs=search_kwargs)
     
-    if k_post:
+    if k_post and os.getenv('RERANKER', 'lexical') == 'cohere':
+        # Imported here, langchain.retrievers pulls in most of langchain and is only needed for Cohere
+        from langchain.retrievers import ContextualCompressionRetriever
+        from langchain.retrievers.document_compressors import CohereRerank
+
         compressor = CohereRerank(
             cohere_api_key=os.getenv('COHERE_API_KEY'),
             top_n=k_post if k_post is not None else 5,  # Default to getting top 5 reranked results
@@ -52,5 +360,8 @@ def create_vector_store(documents: List[Document], collection_name: str, k_pre:
             base_compressor=compressor,
             base_retriever=retriever
         )
+    elif k_post:
+        # Rerank on this machine (RERANKER=lexical or cross-encoder), no network round trip per request
+        retriever : VectorStoreRetriever = RerankedRetriever(base_retriever=retriever, reranker=get_reranker(), top_n=k_post)
 
-    return retriever
\ No newline at end of file
+    return retriever
@@ -0,0 +1,119 @@
+from metrics import log_event
+from typing import Callable, Generic, List, Optional, Tuple, TypeVar
+import asyncio, logging, threading, time
+
+"""
+Background startup. The UI binds its port right away while the slow part of startup (importing langchain and Chroma,
+the Nomic login, opening the index, creating the chain) runs in a thread. Requests that arrive before it finishes wait
+for it, and the UI shows a "warming up" status until then.
+"""
+
+T = TypeVar("T")
+
+
+class Warmup(Generic[T]):
+    """
+    Runs a startup function once, in a background thread or in the calling thread, and hands its result to requests.
+    """
+
+    def __init__(self, func: Callable[["Warmup[T]"], T]):
+        """
+        Args:
+            func (Callable[[Warmup], T]): The startup function. It gets this object to report its current step with set_step.
+        """
+        self.func = func
+        self.step: str = "starting"
+        self.error: Optional[BaseException] = None
+        self._result: Optional[T] = None
+        self._done = threading.Event()
+        self._started_at: float = time.monotonic()
+        self._thread: Optional[threading.Thread] = None
+        self._callbacks: List[Callable[["Warmup[T]"], None]] = []
+        self._callbacks_lock = threading.Lock()
+
+    def start(self) -> "Warmup[T]":
+        """
+        Runs the startup function in a daemon thread and returns immediately.
+        """
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(target=self.run, name="warmup", daemon=True)
+        self._thread.start()
+        return self
+
+    def run(self) -> None:
+        """
+        Runs the startup function in the calling thread. A failure is kept in error and raised to every waiting request.
+        """
+        try:
+            self._result = self.func(self)
+        except BaseException as e:
+            self.error = e
+            log_event("startup_failed", level=logging.ERROR, step=self.step, error=repr(e))
+        finally:
+            with self._callbacks_lock:
+                self._done.set()
+                callbacks, self._callbacks = self._callbacks, []
+            for callback in callbacks:
+                callback(self)
+
+    def add_done_callback(self, callback: Callable[["Warmup[T]"], None]) -> None:
+        """
+        Calls callback(warmup) once startup finished or failed, in the startup thread (right away if it already did),
+        e.g. to exit the process when startup failed.
+        """
+        with self._callbacks_lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_step(self, step: str) -> None:
+        """
+        Sets the step shown in the status, e.g. "opening the index".
+        """
+        self.step = step
+
+    @property
+    def ready(self) -> bool:
+        return self._done.is_set() and self.error is None
+
+    def wait(self, timeout: Optional[float] = None) -> T:
+        """
+        Blocks until startup finished and returns its result.
+
+        Args:
+            timeout (Optional[float]): Seconds to wait at most, forever if None.
+
+        Returns:
+            T: The result of the startup function.
+
+        Raises:
+            TimeoutError: If startup didn't finish in time.
+            RuntimeError: If startup failed, with the original error as its cause.
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"Startup still running ({self.step})")
+        if self.error is not None:
+            raise RuntimeError(f"Startup failed: {self.error}") from self.error
+        return self._result
+
+    async def await_ready(self) -> T:
+        """
+        Same as wait, without blocking the event loop.
+        """
+        if self._done.is_set():
+            return self.wait()
+        return await asyncio.to_thread(self.wait)
+
+    def status(self) -> Tuple[str, bool]:
+        """
+        Returns the status line for the UI and whether it is final (ready or failed), so the UI can stop polling.
+
+        Returns:
+            Tuple[str, bool]: Markdown status (empty once ready) and whether startup finished.
+        """
+        if not self._done.is_set():
+            return f"⏳ Warming up: {self.step} ({time.monotonic() - self._started_at:.0f}s). Questions sent now are answered as soon as it's done.", False
+        if self.error is not None:
+            return f"⚠️ Startup failed: {self.error}", True
+        return "", True